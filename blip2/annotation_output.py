@@ -0,0 +1,133 @@
+"""Append-only JSONL output for annotated profiles.
+
+``AnnotationWriter`` appends every finished profile as one JSON line as soon
+as it completes. Lines are flushed to the OS right away and fsynced in
+batches, so a killed job loses at most the last unsynced batch (and nothing at
+all if the process itself is killed but the node stays up). On start the
+existing file is scanned: profiles already in it are listed in ``completed``
+so the caller can skip them, and a partially written last line is cut off.
+"""
+
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any, BinaryIO, Self
+
+
+def _complete_records(f: BinaryIO) -> Iterator[tuple[dict[str, Any], int]]:
+    """Yield ``(record, line_length)`` up to the first incomplete line."""
+    for line in f:
+        if not line.endswith(b"\n"):
+            return
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        yield record, len(line)
+
+
+def iter_annotations(path: str | Path) -> Iterator[dict[str, Any]]:
+    """Yield the complete records of an annotation file."""
+    with open(path, "rb") as f:
+        for record, _ in _complete_records(f):
+            yield record
+
+
+def repair_annotations(path: str | Path) -> set[str]:
+    """Return the profile IDs in an annotation file and drop a torn tail.
+
+    A job killed in the middle of a write can leave half a line at the end,
+    everything after the last complete record is truncated.
+    """
+    path = Path(path)
+    completed: set[str] = set()
+    if not path.exists():
+        return completed
+
+    good_end = 0
+    with open(path, "rb") as f:
+        for record, length in _complete_records(f):
+            completed.add(record["profile_id"])
+            good_end += length
+
+    size = path.stat().st_size
+    if good_end < size:
+        print(f"Warning: Dropping {size - good_end} bytes of incomplete output")
+        os.truncate(path, good_end)
+    return completed
+
+
+class AnnotationWriter:
+    """Thread-safe JSONL writer with batched fsync and resume support.
+
+    Example:
+        >>> with AnnotationWriter("annotations.jsonl") as writer:
+        ...     todo = [pid for pid in profile_ids if pid not in writer.completed]
+        ...     writer.write({"profile_id": "12", "chosen": "...", "rejected": "..."})
+
+    Args:
+        path: JSONL file to append to, created if missing
+        fsync_every: Fsync after this many records
+        fsync_interval: Fsync when this many seconds passed since the last one
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        fsync_every: int = 32,
+        fsync_interval: float = 10.0,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.completed = repair_annotations(self.path)
+        self.written = 0
+        self.syncs = 0
+        self._file = self.path.open("a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.syncs += 1
+
+    def write(self, record: dict[str, Any]) -> None:
+        """Append one annotated profile, which needs a ``profile_id``."""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.completed.add(record["profile_id"])
+            self.written += 1
+            self._unsynced += 1
+            if (
+                self._unsynced >= self.fsync_every
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._unsynced:
+                self._sync()
+            self._file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+        print(
+            f"Wrote {self.written} annotations to {self.path} "
+            f"({len(self.completed)} in total, {self.syncs} fsyncs)"
+        )
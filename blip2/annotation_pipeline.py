@@ -0,0 +1,382 @@
+"""Streaming pipeline behind ``generate_annontations.py``.
+
+Every stage runs on its own thread and hands profiles to the next one through
+a bounded queue, so a profile moves on as soon as its inputs are ready and
+only a few queues' worth of profiles are held in memory:
+
+    source -> caption -> chosen -> rejected -> write
+
+- source: reads profiles and lists their images
+- caption: ``CaptionEngine``, batched across profiles. Images are decoded in
+  its thread pool and cached captions skip the model.
+- chosen: concurrent Ollama requests on an asyncio loop
+- rejected: BLIP-2 text generation, batched
+- write: hands finished records to a sink
+
+A full queue blocks its producer, so the slowest stage sets the pace. The
+periodic status line shows, per stage, how many profiles it finished, its
+queue depth and how much of its time it was busy (rather than waiting on
+input or blocked on output). The busiest stage is the bottleneck.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import AbstractContextManager
+from pathlib import Path
+from typing import Any
+
+from ollama import AsyncClient
+
+from blip2.captioning import FLUSH, CaptionEngine, ImageKey
+from blip2.image_cache import profile_image_files
+from blip2.ollama_client import GenerationStats, OllamaChatClient
+
+
+Record = dict[str, Any]
+STAGES = ("source", "caption", "chosen", "rejected", "write")
+
+_DONE = object()
+
+
+class _AbortError(Exception):
+    """Raised inside a stage when another stage failed."""
+
+
+class StageStats:
+    """Throughput and time accounting of one pipeline stage."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.start: float | None = None
+        self.end: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.start is None:
+            return 0.0
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def busy_fraction(self) -> float:
+        """Share of the time spent working, not waiting on the queues."""
+        if not self.elapsed:
+            return 0.0
+        idle = self.wait_seconds + self.blocked_seconds
+        return max(0.0, 1 - idle / self.elapsed)
+
+    @property
+    def rate(self) -> float:
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+
+class AnnotationPipeline:
+    """Caption images and generate chosen/rejected lines, one profile at a time.
+
+    Args:
+        caption_engine: Engine that captions the profile images
+        chosen_client: Ollama client for the "chosen" lines
+        chosen_prompt: Builds the Ollama prompt from a record with ``text``
+            and ``image_descriptions``
+        generate_rejected: Produces one "rejected" line per record of a batch
+        queue_size: Capacity of each queue between stages, in profiles
+        rejected_batch_size: Maximum records per ``generate_rejected`` call
+        model_lock: Lock shared with ``caption_engine`` when
+            ``generate_rejected`` uses the same model
+        report_every: Seconds between status lines, 0 disables them
+    """
+
+    def __init__(
+        self,
+        caption_engine: CaptionEngine,
+        chosen_client: OllamaChatClient,
+        chosen_prompt: Callable[[Record], str],
+        generate_rejected: Callable[[list[Record]], list[str]],
+        queue_size: int = 64,
+        rejected_batch_size: int = 8,
+        model_lock: AbstractContextManager | None = None,
+        report_every: float = 30.0,
+    ) -> None:
+        self.caption_engine = caption_engine
+        self.chosen_client = chosen_client
+        self.chosen_prompt = chosen_prompt
+        self.generate_rejected = generate_rejected
+        self.queue_size = queue_size
+        self.rejected_batch_size = rejected_batch_size
+        self.model_lock = model_lock or threading.Lock()
+        self.report_every = report_every
+
+    # Queue helpers. Queues are named after the stage that consumes them
+
+    def _get(self, stage: str) -> Any:
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return self.queues[stage].get(timeout=0.1)
+                except queue.Empty:
+                    if self._failed.is_set():
+                        raise _AbortError from None
+        finally:
+            self.stats[stage].wait_seconds += time.perf_counter() - start
+
+    def _get_nowait(self, stage: str) -> Any:
+        try:
+            return self.queues[stage].get_nowait()
+        except queue.Empty:
+            return None
+
+    def _put(self, stage: str, item: Any) -> None:
+        """Hand ``item`` from ``stage`` to the next stage."""
+        target = STAGES[STAGES.index(stage) + 1]
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    self.queues[target].put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self._failed.is_set():
+                        raise _AbortError from None
+        finally:
+            self.stats[stage].blocked_seconds += time.perf_counter() - start
+        if item is not _DONE:
+            self.stats[stage].items += 1
+
+    def _run_stage(self, stage: str, target: Callable[..., None], *args: Any) -> None:
+        self.stats[stage].start = time.perf_counter()
+        try:
+            target(*args)
+        except _AbortError:
+            pass
+        except BaseException as e:
+            with self._error_lock:
+                if self._error is None:
+                    self._error = e
+            self._failed.set()
+        finally:
+            self.stats[stage].end = time.perf_counter()
+
+    # Stages
+
+    def _source(self, profiles: Iterable[tuple[str, str]], images_dir: Path) -> None:
+        for profile_id, text in profiles:
+            self._put(
+                "source",
+                {
+                    "profile_id": profile_id,
+                    "text": text,
+                    "image_paths": [
+                        str(path)
+                        for _, path in profile_image_files(images_dir / profile_id)
+                    ],
+                },
+            )
+        self._put("source", _DONE)
+
+    def _caption(self) -> None:
+        # Profiles waiting for captions: id -> (record, captions by position)
+        pending: dict[str, tuple[Record, dict[int, str | None]]] = {}
+
+        def images() -> Iterator[tuple[ImageKey, Path] | object]:
+            while True:
+                # Hold at most a queue's worth of profiles, and have the engine
+                # caption what it holds back instead of waiting on more input
+                if pending and (
+                    len(pending) >= self.queue_size or self.queues["caption"].empty()
+                ):
+                    yield FLUSH
+                record = self._get("caption")
+                if record is _DONE:
+                    return
+                paths = record["image_paths"]
+                if not paths:
+                    record["image_descriptions"] = []
+                    self._put("caption", record)
+                    continue
+                pending[record["profile_id"]] = (record, {})
+                for position, path in enumerate(paths):
+                    yield (record["profile_id"], position), path
+
+        for (profile_id, position), caption in self.caption_engine.caption(
+            images(), yield_failures=True
+        ):
+            record, captions = pending[profile_id]
+            captions[position] = caption
+            if len(captions) == len(record["image_paths"]):
+                del pending[profile_id]
+                record["image_descriptions"] = [
+                    captions[i] for i in sorted(captions) if captions[i] is not None
+                ]
+                self._put("caption", record)
+        self._put("caption", _DONE)
+
+    def _chosen(self) -> None:
+        asyncio.run(self._chosen_loop())
+
+    async def _chosen_loop(self) -> None:
+        client = self.chosen_client
+        limit = asyncio.Semaphore(client.concurrency)
+        # Take at most this many profiles off the queue ahead of the answers,
+        # so a slow Ollama applies back pressure instead of filling memory
+        taken = asyncio.Semaphore(2 * client.concurrency)
+        tasks: set[asyncio.Task] = set()
+
+        async def choose(ollama: AsyncClient, record: Record) -> None:
+            try:
+                record["chosen"] = await client.chat(
+                    ollama, limit, self.chosen_prompt(record)
+                )
+            except Exception as e:
+                print(f"Warning: No chosen line for {record['profile_id']}: {e!r}")
+                self.stats["chosen"].failed += 1
+                return
+            finally:
+                taken.release()
+            await asyncio.to_thread(self._put, "chosen", record)
+
+        async with AsyncClient(host=client.host) as ollama:
+            while True:
+                await taken.acquire()
+                record = await asyncio.to_thread(self._get, "chosen")
+                if record is _DONE:
+                    break
+                task = asyncio.create_task(choose(ollama, record))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        self._put("chosen", _DONE)
+
+    def _rejected(self) -> None:
+        done = False
+        while not done:
+            batch = [self._get("rejected")]
+            # Batch whatever else is already waiting, never wait for more
+            while len(batch) < self.rejected_batch_size:
+                record = self._get_nowait("rejected")
+                if record is None:
+                    break
+                batch.append(record)
+            if batch[-1] is _DONE:
+                batch.pop()
+                done = True
+            if batch:
+                with self.model_lock:
+                    lines = self.generate_rejected(batch)
+                for record, line in zip(batch, lines, strict=True):
+                    record["rejected"] = line
+                    self._put("rejected", record)
+        self._put("rejected", _DONE)
+
+    def _write(self, sink: Callable[[Record], None]) -> None:
+        while (record := self._get("write")) is not _DONE:
+            sink(record)
+            self.stats["write"].items += 1
+
+    # Reporting
+
+    def status_line(self) -> str:
+        parts = []
+        for stage in STAGES:
+            stats = self.stats[stage]
+            part = f"{stage} {stats.items} ({stats.rate:.2f}/s, {stats.busy_fraction:.0%} busy"
+            if stage in self.queues:
+                part += f", q {self.queues[stage].qsize()}/{self.queue_size}"
+            parts.append(part + ")")
+        return " | ".join(parts)
+
+    def report(self) -> None:
+        print("Pipeline stages:")
+        for stage in STAGES:
+            stats = self.stats[stage]
+            print(
+                f"  {stage:<9} {stats.items:>6} profiles in {stats.elapsed:7.1f}s "
+                f"({stats.rate:6.2f}/s), busy {stats.busy_fraction:4.0%}, "
+                f"waiting on input {stats.wait_seconds:7.1f}s, "
+                f"blocked on output {stats.blocked_seconds:7.1f}s"
+                + (f", {stats.failed} failed" if stats.failed else "")
+            )
+        bottleneck = max(STAGES[1:], key=lambda s: self.stats[s].busy_fraction)
+        print(f"Bottleneck: {bottleneck}")
+        self.caption_engine.stats.report()
+        self.chosen_client.stats.report()
+
+    def run(
+        self,
+        profiles: Iterable[tuple[str, str]],
+        images_dir: str | Path,
+        sink: Callable[[Record], None],
+    ) -> None:
+        """Annotate profiles and pass each finished record to ``sink``.
+
+        Records have ``profile_id``, ``text``, ``image_paths``,
+        ``image_descriptions``, ``chosen`` and ``rejected``. They arrive in
+        completion order, not input order. Profiles whose chosen line failed
+        are reported and left out.
+
+        Args:
+            profiles: ``(profile_id, profile_text)`` pairs, consumed lazily
+            images_dir: Directory with one image folder per profile
+            sink: Called on the writer thread with every finished record
+
+        Raises:
+            The first exception raised by any stage, after all stages stopped
+        """
+        self.queues = {
+            stage: queue.Queue(maxsize=self.queue_size) for stage in STAGES[1:]
+        }
+        self.stats = {stage: StageStats(stage) for stage in STAGES}
+        self._failed = threading.Event()
+        self._error: BaseException | None = None
+        self._error_lock = threading.Lock()
+        self.chosen_client.stats = GenerationStats()
+
+        targets: dict[str, tuple] = {
+            "source": (self._source, profiles, Path(images_dir)),
+            "caption": (self._caption,),
+            "chosen": (self._chosen,),
+            "rejected": (self._rejected,),
+            "write": (self._write, sink),
+        }
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(stage, *targets[stage]),
+                name=f"annotation-{stage}",
+                daemon=True,
+            )
+            for stage in STAGES
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        last_report = time.perf_counter()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1.0)
+                    if (
+                        self.report_every
+                        and time.perf_counter() - last_report >= self.report_every
+                    ):
+                        print(self.status_line())
+                        last_report = time.perf_counter()
+        except BaseException:
+            # Interrupted (Ctrl-C, SIGTERM), let the stages wind down first so
+            # the sink is not written to while the caller cleans up
+            self._failed.set()
+            for thread in threads:
+                thread.join(timeout=10.0)
+            raise
+        finally:
+            self.chosen_client.stats.elapsed = time.perf_counter() - start
+
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,270 @@
+"""Dynamic micro-batching of concurrent generation requests.
+
+``generate_opening_line`` runs one image and one prompt per ``generate``
+call, so concurrent callers are served one after the other while the GPU
+mostly waits on the Python loop. ``BatchScheduler`` queues incoming requests
+and a single worker thread turns them into batches: a batch closes when it
+holds ``max_batch_size`` requests or ``max_wait`` seconds after its first
+request arrived, whichever comes first. Each batch becomes one batched
+vision + language model ``generate`` call, and every caller gets its own
+answer through a ``Future``.
+
+A lone request only pays ``max_wait`` extra (milliseconds, against seconds of
+generation). Under load the queue fills while a batch is generating, so the
+next batch is usually full without waiting at all.
+
+Compare throughput and latency with and without batching:
+    uv run python -m blip2.batch_scheduler --clients 16 --max-batch-sizes 1 8
+"""
+
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from typing import Any, Self
+
+
+class _Request:
+    __slots__ = ("args", "enqueued", "future", "params")
+
+    def __init__(self, args: tuple[Any, ...], params: dict[str, Any]) -> None:
+        self.args = args
+        self.params = params
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+class SchedulerStats:
+    """Batch sizes and time accounting of a scheduler."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.failed = 0
+        self.batches = 0
+        self.queue_seconds = 0.0
+        self.generate_seconds = 0.0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "failed": self.failed,
+            "batches": self.batches,
+            "mean_batch_size": self.mean_batch_size,
+            "mean_queue_seconds": (
+                self.queue_seconds / self.requests if self.requests else 0.0
+            ),
+            "generate_seconds": self.generate_seconds,
+        }
+
+    def report(self) -> None:
+        print(
+            f"Scheduler: {self.requests} requests in {self.batches} batches "
+            f"(mean batch size {self.mean_batch_size:.1f}, "
+            f"{self.generate_seconds:.1f}s generating, {self.failed} failed)"
+        )
+
+
+class BatchScheduler:
+    """Collect concurrent requests into batches for one batched function.
+
+    Example:
+        >>> scheduler = BatchScheduler(
+        ...     functools.partial(
+        ...         generate_opening_lines, model, processor, device=device
+        ...     )
+        ... )
+        >>> future = scheduler.submit(image, profile_text, temperature=1.0)
+        >>> future.result()
+        'Hey, ...'
+
+    Args:
+        generate_batch: Called as ``generate_batch(*columns, **params)``, where
+            each column lists one positional argument of every request in the
+            batch. Returns one result per request.
+        max_batch_size: Most requests per ``generate_batch`` call
+        max_wait: Seconds a batch waits for more requests after its first one
+    """
+
+    def __init__(
+        self,
+        generate_batch: Callable[..., list[Any]],
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+    ) -> None:
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = SchedulerStats()
+        self._queue: queue.Queue[_Request | None] = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="batch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, *args: Any, **params: Any) -> Future:
+        """Queue one request, results come back through the future.
+
+        Requests are only batched with others that have the same ``params``.
+        """
+        if self._closed:
+            raise RuntimeError("Scheduler is closed")
+        request = _Request(args, params)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self) -> tuple[list[_Request], bool]:
+        """Wait for the next batch, returns it and whether to stop after it."""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                # Past the deadline, still take what is already queued
+                request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _fail(self, requests: list[_Request], error: BaseException) -> None:
+        for request in requests:
+            if not request.future.done():
+                self.stats.failed += 1
+                request.future.set_exception(error)
+
+    def _generate(self, requests: list[_Request]) -> None:
+        start = time.monotonic()
+        for request in requests:
+            self.stats.queue_seconds += start - request.enqueued
+        try:
+            columns = [
+                list(column) for column in zip(*(r.args for r in requests), strict=True)
+            ]
+            results = self.generate_batch(*columns, **requests[0].params)
+            if len(results) != len(requests):
+                raise ValueError(
+                    f"generate_batch returned {len(results)} results for "
+                    f"{len(requests)} requests"
+                )
+        except Exception as e:
+            self._fail(requests, e)
+            return
+        finally:
+            self.stats.generate_seconds += time.monotonic() - start
+            self.stats.batches += 1
+            self.stats.requests += len(requests)
+        for request, result in zip(requests, results, strict=True):
+            request.future.set_result(result)
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            # Drop requests whose caller cancelled them while they waited
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            groups: dict[tuple, list[_Request]] = {}
+            for request in batch:
+                try:
+                    key = tuple(sorted(request.params.items()))
+                    groups.setdefault(key, []).append(request)
+                except TypeError as e:
+                    # Unhashable parameter values, e.g. a list, cannot be grouped
+                    self._fail([request], e)
+            for requests in groups.values():
+                # Whatever goes wrong, fail the batch and keep the worker alive
+                try:
+                    self._generate(requests)
+                except Exception as e:
+                    self._fail(requests, e)
+
+    def close(self) -> None:
+        """Finish the queued requests and stop the worker."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def main() -> None:
+    import argparse
+    import functools
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+
+    import torch
+
+    from blip2.test_finetuned import generate_opening_lines, load_finetuned_model
+
+    parser = argparse.ArgumentParser(
+        description="Measure generation throughput with micro-batching."
+    )
+    parser.add_argument("--base-model", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--adapter-path", default="./blip2_rizz_finetuned")
+    parser.add_argument(
+        "--image-path", default="data_collection/profiles/images/1/image_1.jpg"
+    )
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, processor = load_finetuned_model(args.base_model, args.adapter_path, device)
+    generate_batch = functools.partial(
+        generate_opening_lines, model, processor, device=device
+    )
+    profile_text = "Her name is Maren. She seems to love outdoor activities."
+
+    for max_batch_size in args.max_batch_sizes:
+        with BatchScheduler(
+            generate_batch, max_batch_size, args.max_wait_ms / 1000
+        ) as scheduler:
+            # Single request on an idle scheduler
+            start = time.perf_counter()
+            scheduler.submit(
+                args.image_path, profile_text, max_new_tokens=args.max_new_tokens
+            ).result()
+            single = time.perf_counter() - start
+
+            def request(_: int, scheduler: BatchScheduler = scheduler) -> float:
+                start = time.perf_counter()
+                scheduler.submit(
+                    args.image_path, profile_text, max_new_tokens=args.max_new_tokens
+                ).result()
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as pool:
+                latencies = sorted(pool.map(request, range(args.requests)))
+            elapsed = time.perf_counter() - start
+
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(
+            f"max_batch_size={max_batch_size}: single request {single:.2f}s, "
+            f"{args.clients} clients {args.requests / elapsed:.2f} requests/sec, "
+            f"latency p50 {statistics.median(latencies):.2f}s p95 {p95:.2f}s, "
+            f"mean batch size {scheduler.stats.mean_batch_size:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Persistent cache of image captions, keyed by image content.
+
+Profile images almost never change once scraped, so captioning them again on
+every run of ``generate_annontations.py`` is wasted work. ``CaptionCache``
+stores captions in SQLite under the SHA-256 of the image bytes and a key
+describing the model and generation settings. Renamed or re-downloaded
+images with the same content are still hits, and changing the model or the
+settings never returns stale captions.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any, Self
+
+
+DEFAULT_CAPTION_DB = Path("data_collection/profiles/captions.db")
+HASH_CHUNK_SIZE = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captions (
+    image_hash TEXT NOT NULL,
+    model_key TEXT NOT NULL,
+    caption TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (image_hash, model_key)
+) WITHOUT ROWID;
+"""
+
+
+def image_digest(path: str | Path) -> str:
+    """SHA-256 of an image file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def caption_model_key(model_name: str, **generation_kwargs: Any) -> str:
+    """Describe the model and generation settings a caption was made with."""
+    return json.dumps({"model": model_name, **generation_kwargs}, sort_keys=True)
+
+
+class CaptionCache:
+    """SQLite store of captions with hit/miss counters.
+
+    Example:
+        >>> cache = CaptionCache(
+        ...     "captions.db", caption_model_key("blip2", max_new_tokens=20)
+        ... )
+        >>> cache.get_many([image_digest("image_0.jpg")])
+        {}
+    """
+
+    def __init__(
+        self, db_path: str | Path = DEFAULT_CAPTION_DB, model_key: str = ""
+    ) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_key = model_key
+        # Parallel annotation shards share one database, wait for their writes.
+        # The connection is used from pipeline threads, serialised by the lock
+        self.conn = sqlite3.connect(self.db_path, timeout=60.0, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM captions WHERE model_key = ?", (self.model_key,)
+            ).fetchone()
+        return count
+
+    def get_many(self, image_hashes: Iterable[str]) -> dict[str, str]:
+        """Look up captions, returning only the hashes that are cached."""
+        image_hashes = list(dict.fromkeys(image_hashes))
+        found: dict[str, str] = {}
+        # Stay below SQLite's limit on the number of query parameters
+        with self._lock:
+            for start in range(0, len(image_hashes), 500):
+                chunk = image_hashes[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(
+                    self.conn.execute(
+                        "SELECT image_hash, caption FROM captions "
+                        f"WHERE model_key = ? AND image_hash IN ({placeholders})",
+                        (self.model_key, *chunk),
+                    )
+                )
+        self.hits += len(found)
+        self.misses += len(image_hashes) - len(found)
+        return found
+
+    def put_many(self, captions: Iterable[tuple[str, str]]) -> None:
+        """Store ``(image_hash, caption)`` pairs in one transaction."""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO captions (image_hash, model_key, caption) "
+                "VALUES (?, ?, ?)",
+                (
+                    (image_hash, self.model_key, caption)
+                    for image_hash, caption in captions
+                ),
+            )
+
+    def report(self) -> None:
+        total = self.hits + self.misses
+        print(
+            f"Caption cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hits / total if total else 0:.1%} hit rate)"
+        )
@@ -0,0 +1,351 @@
+"""Batched image captioning with BLIP-2.
+
+``CaptionEngine`` gathers images from any number of profiles into
+fixed-size batches and runs one ``generate`` call per batch, instead of one
+call per image. Images are decoded and preprocessed in a thread pool a few
+batches ahead, so the model does not wait on JPEG decoding. With a
+``CaptionCache`` (see ``blip2/caption_cache.py``) only images whose content
+was never captioned with the same settings reach the model.
+
+Caption every profile image with:
+    uv run python -m blip2.captioning
+"""
+
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from pathlib import Path
+from typing import Any
+
+import torch
+from PIL import Image
+from transformers import Blip2Processor
+
+from blip2.caption_cache import (
+    DEFAULT_CAPTION_DB,
+    CaptionCache,
+    caption_model_key,
+    image_digest,
+)
+from blip2.image_cache import iter_image_files
+from blip2.modeling import unwrap_model
+
+
+ImageKey = tuple[str, int]
+# Put in the input of ``CaptionEngine.caption`` to caption what it holds back
+FLUSH = object()
+
+
+def iter_caption_inputs(
+    images_dir: str | Path, profile_ids: Iterable[str] | None = None
+) -> Iterator[tuple[ImageKey, Path]]:
+    """Yield ``((profile_id, image_index), path)`` for the images to caption.
+
+    Args:
+        images_dir: Directory with one image folder per profile
+        profile_ids: Only yield images of these profiles
+    """
+    wanted = set(profile_ids) if profile_ids is not None else None
+    for profile_id, image_index, path in iter_image_files(images_dir):
+        if wanted is None or profile_id in wanted:
+            yield (profile_id, image_index), path
+
+
+def model_cache_key(model: Any, max_new_tokens: int = 20) -> str:
+    """Caption cache key for a model and the engine's generation settings."""
+    blip2 = unwrap_model(model)
+    return caption_model_key(
+        blip2.name_or_path,
+        max_new_tokens=max_new_tokens,
+        dtype=str(blip2.vision_model.embeddings.patch_embedding.weight.dtype),
+    )
+
+
+class CaptionStats:
+    """Counters of a captioning run."""
+
+    def __init__(self) -> None:
+        self.images = 0
+        self.cached = 0
+        self.batches = 0
+        self.failed = 0
+        self.decode_wait_seconds = 0.0
+        self.caption_seconds = 0.0
+        self.start = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    @property
+    def images_per_second(self) -> float:
+        return self.images / self.elapsed if self.elapsed else 0.0
+
+    def report(self) -> None:
+        print(
+            f"Captioned {self.images} images in {self.batches} batches in "
+            f"{self.elapsed:.1f}s ({self.images_per_second:.2f} images/sec, "
+            f"{self.cached} from cache, "
+            f"{self.caption_seconds:.1f}s generating, "
+            f"{self.decode_wait_seconds:.1f}s waiting on decoding, "
+            f"{self.failed} unreadable)"
+        )
+
+
+class CaptionEngine:
+    """Caption images in batches with a BLIP-2 model.
+
+    Args:
+        model: BLIP-2 model (or PEFT wrapper)
+        processor: Processor matching the model
+        batch_size: Number of images per ``generate`` call
+        decode_workers: Threads that decode and preprocess images
+        prefetch_batches: Number of batches decoded ahead of the one being
+            captioned
+        max_new_tokens: Maximum caption length in tokens
+        cache: Look up captions here before running the model, and store
+            new ones. Its ``model_key`` should come from ``model_cache_key``.
+        model_lock: Held around every ``generate`` call, for when other
+            threads use the same model
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        processor: Blip2Processor,
+        batch_size: int = 16,
+        decode_workers: int = 4,
+        prefetch_batches: int = 2,
+        max_new_tokens: int = 20,
+        cache: CaptionCache | None = None,
+        model_lock: AbstractContextManager | None = None,
+    ) -> None:
+        self.model = model
+        self.processor = processor
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.prefetch_batches = prefetch_batches
+        self.max_new_tokens = max_new_tokens
+        self.cache = cache
+        self.model_lock = model_lock or nullcontext()
+        self.stats = CaptionStats()
+
+        patch_embedding = unwrap_model(model).vision_model.embeddings.patch_embedding
+        self.device = patch_embedding.weight.device
+        self.dtype = patch_embedding.weight.dtype
+
+    def _chunks(
+        self, images: Iterable[tuple[ImageKey, str | Path] | object]
+    ) -> Iterator[tuple[list[tuple[ImageKey, str | Path]], bool]]:
+        """Split the input into chunks of up to ``batch_size`` images.
+
+        Yields ``(chunk, flush)``, ``flush`` is set for the chunk before a
+        ``FLUSH`` marker and for the last one.
+        """
+        chunk: list[tuple[ImageKey, str | Path]] = []
+        for item in images:
+            if item is FLUSH:
+                yield chunk, True
+                chunk = []
+                continue
+            chunk.append(item)
+            if len(chunk) == self.batch_size:
+                yield chunk, False
+                chunk = []
+        yield chunk, True
+
+    def _cached(
+        self, pool: ThreadPoolExecutor, chunk: list[tuple[ImageKey, str | Path]]
+    ) -> Iterator[tuple[ImageKey, str]]:
+        """Yield the cached captions of a chunk, collect the rest in ``_misses``.
+
+        The images are hashed in the thread pool.
+        """
+        digests = list(pool.map(image_digest, [path for _, path in chunk]))
+        cached = self.cache.get_many(digests)
+        for (key, path), digest in zip(chunk, digests, strict=True):
+            if digest in cached:
+                self.stats.cached += 1
+                yield key, cached[digest]
+            else:
+                self._digests[key] = digest
+                self._misses.append((key, path))
+
+    def _load(self, path: str | Path) -> torch.Tensor:
+        """Decode and preprocess one image, runs in the thread pool."""
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+        inputs = self.processor.image_processor(image, return_tensors="pt")
+        return inputs.pixel_values[0]
+
+    @torch.no_grad()
+    def caption_pixel_values(self, pixel_values: torch.Tensor) -> list[str]:
+        """Generate one caption per image of a preprocessed batch."""
+        with self.model_lock:
+            generated_ids = self.model.generate(
+                pixel_values=pixel_values.to(self.device, self.dtype),
+                max_new_tokens=self.max_new_tokens,
+            )
+        return [
+            caption.strip()
+            for caption in self.processor.batch_decode(
+                generated_ids, skip_special_tokens=True
+            )
+        ]
+
+    def _caption_batch(
+        self,
+        batch: list[tuple[ImageKey, str | Path, Future]],
+        yield_failures: bool,
+    ) -> Iterator[tuple[ImageKey, str | None]]:
+        """Wait for a decoded batch, caption it and yield the captions."""
+        wait_start = time.perf_counter()
+        keys, pixel_values = [], []
+        for key, path, future in batch:
+            try:
+                pixel_values.append(future.result())
+            except OSError as e:
+                print(f"Warning: Could not load {path}: {e}")
+                self.stats.failed += 1
+                if yield_failures:
+                    yield key, None
+                continue
+            keys.append(key)
+        self.stats.decode_wait_seconds += time.perf_counter() - wait_start
+        if not keys:
+            return
+
+        caption_start = time.perf_counter()
+        captions = self.caption_pixel_values(torch.stack(pixel_values))
+        self.stats.caption_seconds += time.perf_counter() - caption_start
+        self.stats.images += len(keys)
+        self.stats.batches += 1
+        if self.cache is not None:
+            self.cache.put_many(
+                (self._digests.pop(key), caption)
+                for key, caption in zip(keys, captions, strict=True)
+            )
+        yield from zip(keys, captions, strict=True)
+
+    def caption(
+        self,
+        images: Iterable[tuple[ImageKey, str | Path] | object],
+        yield_failures: bool = False,
+    ) -> Iterator[tuple[ImageKey, str | None]]:
+        """Caption images, yielding ``(key, caption)`` as they are done.
+
+        Images that need the model come out in input order. Cached captions
+        are yielded as soon as their chunk of ``batch_size`` inputs is
+        hashed, ahead of the images still being captioned. Images are
+        decoded ``prefetch_batches`` batches ahead and only full batches are
+        captioned, until the input ends or yields ``FLUSH``: then the
+        partial batch and everything decoded ahead is captioned and yielded
+        before the next input is read. Unreadable images are reported and
+        skipped, or yielded with a None caption if ``yield_failures`` is
+        set. ``self.stats`` is reset at the start of every call.
+
+        Args:
+            images: ``(key, path)`` pairs, for instance from
+                ``iter_caption_inputs``, and optionally ``FLUSH`` markers
+            yield_failures: Also yield unreadable images, so callers waiting
+                for a set of keys know when it is complete
+        """
+        self.stats = CaptionStats()
+        self._digests: dict[ImageKey, str] = {}
+        self._misses: list[tuple[ImageKey, str | Path]] = []
+        prefetched: deque[list[tuple[ImageKey, str | Path, Future]]] = deque()
+        with ThreadPoolExecutor(self.decode_workers) as pool:
+            for chunk, flush in self._chunks(images):
+                if self.cache is None:
+                    self._misses.extend(chunk)
+                else:
+                    yield from self._cached(pool, chunk)
+                while len(self._misses) >= self.batch_size or (flush and self._misses):
+                    batch = self._misses[: self.batch_size]
+                    del self._misses[: self.batch_size]
+                    prefetched.append(
+                        [
+                            (key, path, pool.submit(self._load, path))
+                            for key, path in batch
+                        ]
+                    )
+                while len(prefetched) > (0 if flush else self.prefetch_batches):
+                    yield from self._caption_batch(prefetched.popleft(), yield_failures)
+
+    def caption_all(
+        self, images: Iterable[tuple[ImageKey, str | Path]]
+    ) -> dict[ImageKey, str]:
+        """Caption all images and return the captions by key."""
+        return dict(self.caption(images))
+
+
+def captions_by_profile(captions: dict[ImageKey, str]) -> dict[str, list[str]]:
+    """Group captions per profile, ordered by image index."""
+    grouped: dict[str, list[str]] = {}
+    for profile_id, image_index in sorted(captions):
+        grouped.setdefault(profile_id, []).append(captions[profile_id, image_index])
+    return grouped
+
+
+def main() -> None:
+    import argparse
+    import json
+
+    from transformers import BitsAndBytesConfig, Blip2ForConditionalGeneration
+
+    parser = argparse.ArgumentParser(description="Caption all profile images.")
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--images-dir", default="data_collection/profiles/images")
+    parser.add_argument("--output", default="data_collection/profiles/captions.json")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--prefetch-batches", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=20)
+    parser.add_argument("--cache-db", default=str(DEFAULT_CAPTION_DB))
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Caption every image again"
+    )
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+
+    print("Loading model...")
+    processor = Blip2Processor.from_pretrained(args.model_name)
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        args.model_name,
+        dtype=torch.float16 if device == "cuda" else torch.float32,
+        device_map={"": 0} if device == "cuda" else None,
+        quantization_config=BitsAndBytesConfig(
+            load_in_8bit=True, llm_int8_threshold=6.0
+        ),
+    )
+    model.eval()
+
+    cache = None
+    if not args.no_cache:
+        cache = CaptionCache(args.cache_db, model_cache_key(model, args.max_new_tokens))
+    engine = CaptionEngine(
+        model,
+        processor,
+        batch_size=args.batch_size,
+        decode_workers=args.decode_workers,
+        prefetch_batches=args.prefetch_batches,
+        max_new_tokens=args.max_new_tokens,
+        cache=cache,
+    )
+    captions = engine.caption_all(iter_caption_inputs(args.images_dir))
+    engine.stats.report()
+    if cache is not None:
+        cache.report()
+        cache.close()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(captions_by_profile(captions), f, ensure_ascii=False, indent=2)
+    print(f"Saved captions to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
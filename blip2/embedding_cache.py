@@ -0,0 +1,205 @@
+"""In-memory LRU cache of BLIP-2 query embeddings for inference.
+
+For BLIP-2 the vision encoder, Q-Former and language projection only depend
+on the image, so the query embeddings that replace the image tokens can be
+computed once per image and reused for every prompt asked about it.
+``QueryEmbeddingCache.encode`` returns them for a batch of images, only
+running the vision pass for images it has not seen. Entries are keyed by the
+SHA-256 of the image content and evicted least recently used once the cache
+holds more than ``max_bytes``. With a ``spill_dir`` evicted entries are saved
+to disk instead of dropped, and loaded back on their next use.
+
+Generate from the embeddings with ``modeling.generate_from_query_embeds``:
+
+    >>> cache = QueryEmbeddingCache()
+    >>> query_embeds = cache.encode(model, processor, ["image_1.jpg"])
+    >>> inputs = image_prompt_inputs(processor, ["Question: ... Answer:"])
+    >>> out = generate_from_query_embeds(model, query_embeds, **inputs)
+
+InstructBLIP is not covered: its Q-Former also reads the instruction, so the
+query embeddings change with every prompt.
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any
+
+import torch
+from PIL import Image
+
+from blip2.caption_cache import image_digest
+from blip2.modeling import query_embeds_from_image_embeds, unwrap_model, vision_features
+
+
+ImageInput = str | Path | bytes | Image.Image
+
+
+def image_input_digest(image: ImageInput) -> str:
+    """SHA-256 of an image file, encoded bytes or decoded image.
+
+    Files and their bytes hash the same, a decoded image hashes its pixels and
+    gets a different key than the file it was read from.
+    """
+    if isinstance(image, Image.Image):
+        digest = hashlib.sha256(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    if isinstance(image, bytes):
+        return hashlib.sha256(image).hexdigest()
+    return image_digest(image)
+
+
+def _open_image(image: ImageInput) -> Image.Image:
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    if isinstance(image, bytes):
+        return Image.open(io.BytesIO(image)).convert("RGB")
+    return Image.open(image).convert("RGB")
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+class QueryEmbeddingCache:
+    """LRU cache of query embeddings with a memory bound and disk spill.
+
+    Args:
+        max_bytes: Memory the cached embeddings may take, on the device they
+            were computed on
+        spill_dir: Save evicted entries here instead of dropping them
+        namespace: Separates the spilled entries of different models, defaults
+            to the model's ``name_or_path`` on the first ``encode``
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 512 * 2**20,
+        spill_dir: str | Path | None = None,
+        namespace: str | None = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.namespace = namespace
+        self.entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _spill_path(self, digest: str) -> Path | None:
+        if self.spill_dir is None:
+            return None
+        namespace = hashlib.sha256((self.namespace or "").encode()).hexdigest()[:16]
+        return self.spill_dir / namespace / f"{digest}.pt"
+
+    def get(
+        self, digest: str, device: torch.device | str | None = None
+    ) -> torch.Tensor | None:
+        """Embeddings of one image, ``(num_query_tokens, hidden_size)``.
+
+        Entries loaded back from the spill directory are moved to ``device``
+        before they are cached again, so later hits need no copy.
+        """
+        with self._lock:
+            embeds = self.entries.get(digest)
+            if embeds is not None:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return embeds
+        path = self._spill_path(digest)
+        if path is not None and path.exists():
+            embeds = torch.load(path, map_location=device, weights_only=True)
+            with self._lock:
+                self.disk_hits += 1
+            self.put(digest, embeds)
+            return embeds
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, digest: str, embeds: torch.Tensor) -> None:
+        """Store the embeddings of one image, evicting old entries if needed."""
+        evicted = []
+        with self._lock:
+            if digest in self.entries:
+                self.bytes -= _nbytes(self.entries.pop(digest))
+            self.entries[digest] = embeds
+            self.bytes += _nbytes(embeds)
+            while self.bytes > self.max_bytes and self.entries:
+                old_digest, old_embeds = self.entries.popitem(last=False)
+                self.bytes -= _nbytes(old_embeds)
+                self.evictions += 1
+                evicted.append((old_digest, old_embeds))
+        for old_digest, old_embeds in evicted:
+            path = self._spill_path(old_digest)
+            if path is not None and not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(".tmp")
+                torch.save(old_embeds.cpu(), tmp_path)
+                tmp_path.replace(path)
+
+    @torch.no_grad()
+    def encode(
+        self, model: Any, processor: Any, images: Sequence[ImageInput]
+    ) -> torch.Tensor:
+        """Query embeddings of ``images``, computing only the missing ones.
+
+        Args:
+            model: BLIP-2 model (or PEFT wrapper)
+            processor: Processor with the model's image processor
+            images: Paths, encoded bytes or decoded images
+
+        Returns:
+            Tensor of shape ``(len(images), num_query_tokens, lm_hidden_size)``
+            on the model's device
+        """
+        blip2 = unwrap_model(model)
+        if self.namespace is None:
+            self.namespace = str(blip2.config.name_or_path)
+        patch_embedding = blip2.vision_model.embeddings.patch_embedding.weight
+
+        digests = [image_input_digest(image) for image in images]
+        found: dict[str, torch.Tensor] = {}
+        missing: dict[str, ImageInput] = {}
+        for digest, image in zip(digests, images, strict=True):
+            if digest in found or digest in missing:
+                continue
+            embeds = self.get(digest, patch_embedding.device)
+            if embeds is None:
+                missing[digest] = image
+            else:
+                found[digest] = embeds.to(patch_embedding.device)
+
+        if missing:
+            pixel_values = processor.image_processor(
+                [_open_image(image) for image in missing.values()],
+                return_tensors="pt",
+            )["pixel_values"].to(patch_embedding.device, patch_embedding.dtype)
+            query_embeds = query_embeds_from_image_embeds(
+                blip2, vision_features(blip2, pixel_values)
+            )
+            for digest, embeds in zip(missing, query_embeds, strict=True):
+                # Copy, a view would keep the whole batch alive
+                embeds = embeds.clone()
+                self.put(digest, embeds)
+                found[digest] = embeds
+
+        return torch.stack([found[digest] for digest in digests])
+
+    def report(self) -> None:
+        print(
+            f"Embedding cache: {len(self.entries)} images in "
+            f"{self.bytes / 2**20:.1f} MiB, {self.hits} hits, "
+            f"{self.disk_hits} from disk, {self.misses} misses, "
+            f"{self.evictions} evicted"
+        )
@@ -0,0 +1,236 @@
+"""Offline cache of frozen vision-encoder features for LoRA training.
+
+LoRA only adapts the language model, so the ViT outputs for an image never
+change during training. ``extract_vision_features`` runs the vision encoder
+once per image in the image cache (see ``blip2/image_cache.py``) and appends
+the last hidden states to a flat memory-mapped file. Training with a
+``FeatureCache`` then starts every step at the Q-Former.
+
+Extract the features with:
+    uv run python -m blip2.feature_cache
+"""
+
+import json
+import os
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+
+from blip2.image_cache import DEFAULT_CACHE_DIR as DEFAULT_IMAGE_CACHE_DIR
+from blip2.image_cache import ImageCache
+from blip2.modeling import vision_features
+
+
+DEFAULT_FEATURE_DIR = "data_collection/profiles/vision_features"
+INDEX_FILE = "index.json"
+FEATURES_FILE = "features.bin"
+
+
+class FeatureCache:
+    """Read access to features written by ``extract_vision_features``."""
+
+    def __init__(self, feature_dir: str | Path = DEFAULT_FEATURE_DIR) -> None:
+        self.feature_dir = Path(feature_dir)
+        with open(self.feature_dir / INDEX_FILE, encoding="utf-8") as f:
+            self.index: dict[str, Any] = json.load(f)
+        self.shape = tuple(self.index["shape"] or ())
+        self.dtype = np.dtype(self.index["dtype"])
+        self._features: np.memmap | None = None
+
+    @staticmethod
+    def exists(feature_dir: str | Path = DEFAULT_FEATURE_DIR) -> bool:
+        return (Path(feature_dir) / INDEX_FILE).exists()
+
+    @property
+    def features(self) -> np.memmap:
+        if self._features is None:
+            self._features = np.memmap(
+                self.feature_dir / FEATURES_FILE,
+                dtype=self.dtype,
+                mode="r",
+                shape=(self.index["rows"], *self.shape),
+            )
+        return self._features
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return f"{key[0]}/{key[1]}" in self.index["entries"]
+
+    def __len__(self) -> int:
+        return len(self.index["entries"])
+
+    def get(self, profile_id: str, image_index: int) -> np.ndarray:
+        """Return a read-only ``(seq_len, hidden_size)`` view of the features."""
+        key = f"{profile_id}/{image_index}"
+        if key not in self.index["entries"]:
+            raise KeyError(
+                f"No vision features for image {key}, rerun `python -m blip2.feature_cache`"
+            )
+        return self.features[self.index["entries"][key]["row"]]
+
+    def image_embeds(self, features: Sequence[np.ndarray]) -> torch.Tensor:
+        """Stack cached features into an ``image_embeds`` batch."""
+        return torch.from_numpy(np.stack(features))
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Reopen the memmap lazily in DataLoader workers
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+
+class CachedFeatureTransform:
+    """Dataset transform that adds the cached ``image_embeds`` of each example.
+
+    Examples need ``profile_id`` and ``image_index`` columns.
+    """
+
+    def __init__(self, cache: FeatureCache) -> None:
+        self.cache = cache
+
+    def __call__(self, batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        batch["image_embeds"] = [
+            self.cache.get(profile_id, image_index)
+            for profile_id, image_index in zip(
+                batch["profile_id"], batch["image_index"], strict=True
+            )
+        ]
+        return batch
+
+
+@torch.no_grad()
+def extract_vision_features(
+    model: Any,
+    image_cache: ImageCache,
+    feature_dir: str | Path = DEFAULT_FEATURE_DIR,
+    model_name: str = "Salesforce/blip2-opt-2.7b",
+    batch_size: int = 32,
+    dtype: str = "float16",
+) -> FeatureCache:
+    """Run the vision encoder over every cached image and store its outputs.
+
+    Images that already have features are skipped, so rerunning after adding
+    profiles only encodes the new (or changed) images.
+
+    Args:
+        model: BLIP-2 model (or PEFT wrapper) whose vision encoder to use
+        image_cache: Pre-resized images to encode
+        feature_dir: Directory to write the features and index to
+        model_name: Recorded in the index, features from different models
+            cannot share a directory
+        batch_size: Number of images per vision encoder forward pass
+        dtype: Storage dtype of the features
+
+    Returns:
+        The updated feature cache
+    """
+    feature_dir = Path(feature_dir)
+    feature_dir.mkdir(parents=True, exist_ok=True)
+    index_path = feature_dir / INDEX_FILE
+
+    index: dict[str, Any] = {
+        "model_name": model_name,
+        "dtype": dtype,
+        "shape": None,
+        "rows": 0,
+        "entries": {},
+    }
+    if index_path.exists():
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        if index["model_name"] != model_name or index["dtype"] != dtype:
+            raise ValueError(
+                f"Features in {feature_dir} were extracted with "
+                f"{index['model_name']} ({index['dtype']})"
+            )
+
+    # Encode new images and images whose source file changed since
+    todo = [
+        key
+        for key, entry in image_cache.index["entries"].items()
+        if index["entries"].get(key, {}).get("source") != entry["source"]
+    ]
+    device = next(model.parameters()).device
+    pixel_dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+    # Rows are appended to the end of the file. Drop rows written by an
+    # interrupted run that never made it into the index
+    features_path = feature_dir / FEATURES_FILE
+    if features_path.exists():
+        row_bytes = 0
+        if index["shape"] is not None:
+            row_bytes = int(np.prod(index["shape"])) * np.dtype(dtype).itemsize
+        os.truncate(features_path, index["rows"] * row_bytes)
+
+    with open(features_path, "ab") as f:
+        for start in range(0, len(todo), batch_size):
+            keys = todo[start : start + batch_size]
+            images = []
+            for key in keys:
+                profile_id, image_index = key.rsplit("/", 1)
+                images.append(image_cache.get(profile_id, int(image_index)))
+            pixel_values = image_cache.pixel_values(images).to(device, pixel_dtype)
+            features = vision_features(model, pixel_values).cpu().numpy()
+            features = features.astype(dtype, copy=False)
+
+            if index["shape"] is None:
+                index["shape"] = list(features.shape[1:])
+            f.write(features.tobytes())
+            for key in keys:
+                index["entries"][key] = {
+                    "row": index["rows"],
+                    "source": image_cache.index["entries"][key]["source"],
+                }
+                index["rows"] += 1
+
+            print(f"Encoded {start + len(keys)}/{len(todo)} images")
+
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    tmp_path.replace(index_path)
+
+    print(f"Extracted {len(todo)} new feature maps, {len(index['entries'])} in total")
+    return FeatureCache(feature_dir)
+
+
+def main() -> None:
+    """Extract features with the same quantised model used for training."""
+    import argparse
+
+    from transformers import BitsAndBytesConfig, Blip2ForConditionalGeneration
+
+    parser = argparse.ArgumentParser(description="Cache vision-encoder features.")
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--image-cache-dir", default=DEFAULT_IMAGE_CACHE_DIR)
+    parser.add_argument("--feature-dir", default=DEFAULT_FEATURE_DIR)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+
+    print("Loading model...")
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        args.model_name,
+        quantization_config=BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_threshold=6.0,
+        ),
+        device_map={"": 0} if device == "cuda" else None,
+    )
+    model.eval()
+
+    extract_vision_features(
+        model,
+        ImageCache(args.image_cache_dir),
+        args.feature_dir,
+        model_name=args.model_name,
+        batch_size=args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,139 +1,66 @@
 #ollama pls save me, generate perfect opening line but also it has to use the vision part to get description of the pictures 
 #can use the models current output as rejected "lines"
-import os
-import torch
-from PIL import Image
-from transformers import (
-    BitsAndBytesConfig,
-    Blip2ForConditionalGeneration,
-    Blip2Processor,
-)
-import json
-import ollama
+import argparse
+import signal
+import sys
 
+import torch
 
-    
+from blip2.annotation_output import AnnotationWriter
+from blip2.annotation_pipeline import AnnotationPipeline
+from blip2.caption_cache import CaptionCache
+from blip2.captioning import CaptionEngine, model_cache_key
+from blip2.cpu_backend import DEFAULT_PRECISION, PRECISIONS
+from blip2.ollama_client import OllamaChatClient
+from blip2.profile_reader import iter_profiles
+from blip2.rizzler import Rizzler
+from blip2.sharding import shard_from_env, shard_of, shard_path
+from blip2.text_generation import TextGenerator
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
-dtype = torch.float16 if device == "cuda" else torch.float32
-
-
-print("Loading model...")
-processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
-model = Blip2ForConditionalGeneration.from_pretrained(
-    "Salesforce/blip2-opt-2.7b",
-    dtype=dtype,
-    device_map={"": 0} if device == "cuda" else None,
-    quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0),
-)
-
-folder_path = "/cluster/home/kristiac/rizzai/RizzAI/data_collection/profiles/"
-json_file = "text_data.json"
-with open(str(folder_path+json_file), "r") as f:
-    data = json.load(f)
-
-profiles = {}
-
-for profile in data:
-    profiles[profile] = {
-        "text": "",
-        "image_descriptions": [],
-    }
-
-def ask_question(images, question: str) -> str:
-    inputs = processor(images=images, question=question, return_tensors="pt").to(device)
-
-    out = model.generate(**inputs, do_sample=False, num_beams=5, max_length=196, min_length=1,
-        top_p=1.0,
-        repetition_penalty=5,
-        length_penalty=1.0,
-        temperature=1,
-    )
-    answer = processor.batch_decode(out, skip_special_tokens=True)[0].strip()
-
-    return answer
-
-def ask_question_no_img(question):
-    inputs = processor(question=question, return_tensors="pt").to(device)
-    out = model.generate(
-        **inputs,
-        do_sample=False,
-        num_beams=5,
-        max_length=196,
-        min_length=1,
-        top_p=1.0,
-        repetition_penalty=5,
-        length_penalty=1.0,
-        temperature=1,
-    )
-    answer = processor.batch_decode(out, skip_special_tokens=True)[0].strip()
 
-    return answer
+CAPTION_BATCH_SIZE = 16  # images per generate call
+DECODE_WORKERS = 4  # threads decoding JPEGs while the model captions
+OLLAMA_CONCURRENCY = 4  # requests in flight, match OLLAMA_NUM_PARALLEL on the server
+QUEUE_SIZE = 64  # profiles buffered between two pipeline stages
 
 
-for profile_id in data:
-    currProf = profiles[profile_id]
-    profile = data[profile_id]
+def profile_text(profile):
+    text = ""
 
     if profile['name'] != None:
-        currProf['text'] += "Name: " + profile["name"] + ". "
+        text += "Name: " + profile["name"] + ". "
     if profile['about_me'] != None:
-        currProf['text'] += "About Me: " + profile["about_me"] + ". "
+        text += "About Me: " + profile["about_me"] + ". "
     
     # Essentials
-    currProf['text'] += "Essentials: "
+    text += "Essentials: "
     for ess in profile["essentials"]:
-        currProf['text'] += ess + ","
-    currProf['text'] += ". "
+        text += ess + ","
+    text += ". "
 
     # Basics
-    currProf['text'] += "Basics: "
+    text += "Basics: "
     for bas_prefix, bas_data in profile['basics'].items():
-        currProf['text'] += bas_prefix + ": " + bas_data + ", "
-    currProf['text'] += ". "
+        text += bas_prefix + ": " + bas_data + ", "
+    text += ". "
 
     # Lifestyle
-    currProf['text'] += "Lifestyle: "
+    text += "Lifestyle: "
     for lf_prefix, lf_data in profile["lifestyle"].items():
-        currProf['text'] += lf_prefix + ": " + lf_data + ", "
-    currProf['text'] += ". "
+        text += lf_prefix + ": " + lf_data + ", "
+    text += ". "
 
     # Interests
-    currProf['text'] += "Interests: "
+    text += "Interests: "
     for inter in profile["interests"]:
-        currProf['text'] += inter +  ", "
-    currProf['text'] += ". "
+        text += inter +  ", "
+    text += ". "
 
     # Anthem
     if profile['anthem'] != None:
-        currProf['text'] += "Anthem: " + profile['anthem']
-
-# Append image paths
-image_path = folder_path + "images"
-
-IMAGE_AMOUNT = len(os.listdir(image_path))
-
-prof_img_dict = {}
-image_description_dict={} #dictionnary containing every image descriptions for each profilepir
-for profile_id in data:
-    currProf = profiles[profile_id]
-    prof_img_dict[profile_id] = []
-    image_folder = image_path + "/" + profile_id 
-    image_description_dict[profile_id]=[]
-    for i in range(IMAGE_AMOUNT):
-        try:
-            img = Image.open(image_folder + "/image_" + i + ".jpg").convert("RGB")
-            prof_img_dict[profile_id].append(img)
-            inputs_caption = processor(images=img, return_tensors="pt").to(device, dtype=dtype)
-            generated_ids_caption = model.generate(**inputs_caption, max_new_tokens=20)
-            image_description = processor.batch_decode(generated_ids_caption, skip_special_tokens=True)[0].strip()
-            image_description_dict[profile_id].append(image_description) 
-            currProf["image_descriptions"].append(image_description)
-        except:
-            continue
-
+        text += "Anthem: " + profile['anthem']
 
+    return text
 
 
 #ollama
@@ -145,16 +72,99 @@ def data_to_prompt(data):
     
     return profile_info + ". And here is her profile info:" + data["text"] + ". Give me the perfect opening line to this woman"
 
-def create_first_message(data, l_model):
-    """
-    Create the first message for a user based on provided data.
 
-    Args:
-        data (dict): A dictionary containing message details.
-        user_id (str): The ID of the user."""
-    return ollama.chat(l_model, messages=[{'role': 'user', 'content': data_to_prompt(data)}])
+def main():
+    # Shards default to the Slurm array task, e.g. `sbatch --array=0-7 jobs/gpu/annontate.slurm`
+    env_shard_index, env_num_shards = shard_from_env()
+    parser = argparse.ArgumentParser(description="Annotate profiles with chosen/rejected opening lines.")
+    parser.add_argument("--shard-index", type=int, default=env_shard_index)
+    parser.add_argument("--num-shards", type=int, default=env_num_shards)
+    parser.add_argument("--profiles-dir", default="/cluster/home/kristiac/rizzai/RizzAI/data_collection/profiles/")
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--ollama-model", default="llama3.1")
+    parser.add_argument("--ollama-host", default=None)
+    parser.add_argument("--cpu-precision", default=DEFAULT_PRECISION, choices=PRECISIONS, help="Weights on CPU-only nodes")
+    parser.add_argument("--rejected-batch-size", type=int, default=8, help="Prompts per batched rejected generate call")
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f"--shard-index must be in [0, {args.num_shards})")
+    print(f"Shard {args.shard_index} of {args.num_shards}")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+
+    print("Loading model...")
+    # bitsandbytes 8-bit needs a GPU, on CPU use PyTorch's dynamic int8 or bf16.
+    # Built once per model and precision, later shards load the saved artifact
+    rizzler = Rizzler.get(args.model_name, device=device, precision="int8" if device == "cuda" else args.cpu_precision)
+    model, processor = rizzler.model, rizzler.processor
+
+    folder_path = args.profiles_dir
+    json_file = "text_data.json"
+
+    # The rejected line is the base model's own answer to the prompt Ollama gets, without the images.
+    # Prompts are left padded and beam searched together, one generate call per batch
+    rejected_generator = TextGenerator(model, processor, batch_size=args.rejected_batch_size)
+
+    def generate_rejected(records):
+        return rejected_generator.generate([data_to_prompt(record) for record in records])
+
+    image_path = folder_path + "images"
+
+    # Captioning and rejected generation share the BLIP-2 model, take turns on its lock
+    model_lock = rizzler.lock
+
+    # Captions are cached by image content, reruns only caption new images
+    caption_cache = CaptionCache(folder_path + "captions.db", model_cache_key(model, max_new_tokens=20))
+    engine = CaptionEngine(
+        model,
+        processor,
+        batch_size=CAPTION_BATCH_SIZE,
+        decode_workers=DECODE_WORKERS,
+        max_new_tokens=20,
+        cache=caption_cache,
+        model_lock=model_lock,
+    )
+    ollama_client = OllamaChatClient(
+        args.ollama_model, host=args.ollama_host, concurrency=OLLAMA_CONCURRENCY, timeout=120, retries=3
+    )
 
+    # Profiles stream through captioning, Ollama and BLIP-2 one by one, all stages run at the same time
+    pipeline = AnnotationPipeline(
+        engine,
+        ollama_client,
+        chosen_prompt=data_to_prompt,
+        generate_rejected=generate_rejected,
+        queue_size=QUEUE_SIZE,
+        rejected_batch_size=args.rejected_batch_size,
+        model_lock=model_lock,
+    )
 
-annontation_set = {}
-for pid in profiles:
-    annontation_set[pid] = {"chosen": create_first_message(profiles[pid], "llama3.1"), "rejected": ask_question_no_img(image_description_dict[pid])}
+    # Slurm sends SIGTERM when the time limit is reached, exit cleanly so the output gets fsynced
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    # Every annotated profile is appended as it completes, a rerun skips the profiles already in the file.
+    # Each shard writes its own file, merge them with `python -m blip2.sharding merge --num-shards N`
+    output_path = shard_path(folder_path + "annotations.jsonl", args.shard_index, args.num_shards)
+    with AnnotationWriter(output_path) as annontation_writer:
+        if annontation_writer.completed:
+            print(f"Resuming, {len(annontation_writer.completed)} profiles already annotated")
+
+        # Stream the profiles instead of loading the whole json file at once
+        pipeline.run(
+            (
+                (profile_id, profile_text(profile))
+                for profile_id, profile in iter_profiles(folder_path + json_file)
+                if shard_of(profile_id, args.num_shards) == args.shard_index
+                and profile_id not in annontation_writer.completed
+            ),
+            image_path,
+            annontation_writer.write,
+        )
+    pipeline.report()
+    rejected_generator.report()
+    caption_cache.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Pre-decoded, pre-resized image cache stored in memory-mapped shards.
+
+Decoding the profile JPEGs and resizing them to the BLIP-2 input resolution is
+done once by ``build_image_cache``. The results are stored as uint8 arrays of
+shape ``(capacity, height, width, 3)`` in shard files, with a JSON index keyed
+by profile ID and image index. ``ImageCache`` hands out zero-copy views into
+the shards, and ``ImageCache.pixel_values`` applies the processor's
+rescale/normalise step to a batch of them.
+
+Images are resized with PIL, like the slow (``use_fast=False``) image
+processor. The torchvision backend, the default in newer transformers, resizes
+tensors with its own antialiasing and gives slightly different pixels, so code
+that mixes cached and live images loads its processor with ``use_fast=False``.
+
+Build the cache with:
+    uv run python -m blip2.image_cache --images-dir data_collection/profiles/images
+"""
+
+import json
+import re
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoImageProcessor, BaseImageProcessor
+
+
+DEFAULT_CACHE_DIR = "data_collection/profiles/image_cache"
+INDEX_FILE = "index.json"
+IMAGE_PATTERN = re.compile(r"image_(\d+)\.jpg")
+
+
+def cache_key(profile_id: str, image_index: int) -> str:
+    return f"{profile_id}/{image_index}"
+
+
+def profile_image_files(profile_dir: str | Path) -> list[tuple[int, Path]]:
+    """Return ``(image_index, path)`` of a profile's images, by index."""
+    profile_dir = Path(profile_dir)
+    if not profile_dir.is_dir():
+        return []
+    images = []
+    for image_path in profile_dir.iterdir():
+        match = IMAGE_PATTERN.fullmatch(image_path.name)
+        if match:
+            images.append((int(match.group(1)), image_path))
+    return sorted(images)
+
+
+def iter_image_files(images_dir: str | Path) -> Iterator[tuple[str, int, Path]]:
+    """Yield ``(profile_id, image_index, path)`` for every profile image."""
+    for profile_dir in sorted(Path(images_dir).iterdir()):
+        for image_index, image_path in profile_image_files(profile_dir):
+            yield profile_dir.name, image_index, image_path
+
+
+class ImageCache:
+    """Read access to a cache built by ``build_image_cache``."""
+
+    def __init__(self, cache_dir: str | Path = DEFAULT_CACHE_DIR) -> None:
+        self.cache_dir = Path(cache_dir)
+        with open(self.cache_dir / INDEX_FILE, encoding="utf-8") as f:
+            self.index: dict[str, Any] = json.load(f)
+        self.height, self.width = self.index["size"]
+        self.image_mean = torch.tensor(self.index["image_mean"]).view(1, 3, 1, 1)
+        self.image_std = torch.tensor(self.index["image_std"]).view(1, 3, 1, 1)
+        self.rescale_factor: float = self.index["rescale_factor"]
+        self.resample: int = self.index["resample"]
+        self._shards: dict[int, np.memmap] = {}
+
+    @staticmethod
+    def exists(cache_dir: str | Path = DEFAULT_CACHE_DIR) -> bool:
+        return (Path(cache_dir) / INDEX_FILE).exists()
+
+    def _shard(self, shard_id: int) -> np.memmap:
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(
+                self.cache_dir / self.index["shards"][shard_id]["file"],
+                dtype=np.uint8,
+                mode="r",
+                shape=(self.index["images_per_shard"], self.height, self.width, 3),
+            )
+        return self._shards[shard_id]
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return cache_key(*key) in self.index["entries"]
+
+    def __len__(self) -> int:
+        return len(self.index["entries"])
+
+    def get(self, profile_id: str, image_index: int) -> np.ndarray:
+        """Return a read-only ``(height, width, 3)`` uint8 view of an image."""
+        entry = self.index["entries"][cache_key(profile_id, image_index)]
+        return self._shard(entry["shard"])[entry["row"]]
+
+    def load(self, profile_id: str, image_index: int, image_path: str) -> np.ndarray:
+        """Like ``get``, but decodes and resizes images missing from the cache."""
+        if (profile_id, image_index) in self:
+            return self.get(profile_id, image_index)
+        return _resize(Image.open(image_path), (self.height, self.width), self.resample)
+
+    def pixel_values(self, images: Sequence[np.ndarray]) -> torch.Tensor:
+        """Turn cached uint8 images into normalised BLIP-2 ``pixel_values``.
+
+        Matches the output of the image processor the cache was built with,
+        loaded with ``use_fast=False``.
+        """
+        batch = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float()
+        batch = batch * self.rescale_factor
+        return (batch - self.image_mean) / self.image_std
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Memmaps are reopened lazily, so the cache can be sent to DataLoader
+        # workers without pickling the shard contents
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+
+class CachedImageTransform:
+    """Dataset transform that loads images of path-backed examples from the cache.
+
+    Examples need ``profile_id``, ``image_index`` and ``image_path`` columns.
+    The ``image`` column is filled with uint8 arrays, see
+    ``ImageCache.pixel_values`` for turning them into model inputs.
+    """
+
+    def __init__(self, cache: ImageCache) -> None:
+        self.cache = cache
+
+    def __call__(self, batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        batch["image"] = [
+            self.cache.load(profile_id, image_index, image_path)
+            for profile_id, image_index, image_path in zip(
+                batch["profile_id"],
+                batch["image_index"],
+                batch["image_path"],
+                strict=True,
+            )
+        ]
+        return batch
+
+
+def load_image_processor(model_name: str) -> BaseImageProcessor:
+    """Load the PIL-backed image processor whose resize the cache reproduces."""
+    return AutoImageProcessor.from_pretrained(model_name, use_fast=False)
+
+
+def _resize(image: Image.Image, size: tuple[int, int], resample: int) -> np.ndarray:
+    height, width = size
+    resized = image.convert("RGB").resize((width, height), resample=resample)
+    return np.asarray(resized, dtype=np.uint8)
+
+
+def build_image_cache(
+    images_dir: str | Path,
+    cache_dir: str | Path = DEFAULT_CACHE_DIR,
+    image_processor: BaseImageProcessor | None = None,
+    model_name: str = "Salesforce/blip2-opt-2.7b",
+    images_per_shard: int = 1024,
+) -> ImageCache:
+    """Decode and resize all profile images into the shard cache.
+
+    Rerunning only processes images that are new or whose file changed since
+    they were cached.
+
+    Args:
+        images_dir: Directory with one folder of ``image_<n>.jpg`` per profile
+        cache_dir: Directory to write the shards and index to
+        image_processor: Processor whose resize geometry and normalisation
+            to use, with the PIL backend. Loaded from ``model_name`` if not
+            given.
+        model_name: Model to load the image processor from
+        images_per_shard: Number of images per shard file
+
+    Returns:
+        The updated cache
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if image_processor is None:
+        image_processor = load_image_processor(model_name)
+    size = (image_processor.size["height"], image_processor.size["width"])
+
+    index_path = cache_dir / INDEX_FILE
+    index: dict[str, Any]
+    if index_path.exists():
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        if tuple(index["size"]) != size:
+            raise ValueError(
+                f"Cache at {cache_dir} was built for size {index['size']}, not {size}"
+            )
+        images_per_shard = index["images_per_shard"]
+    else:
+        index = {
+            "size": list(size),
+            "images_per_shard": images_per_shard,
+            "resample": int(image_processor.resample),
+            "rescale_factor": image_processor.rescale_factor,
+            "image_mean": list(image_processor.image_mean),
+            "image_std": list(image_processor.image_std),
+            "shards": [],
+            "entries": {},
+        }
+
+    shard: np.memmap | None = None
+    added = 0
+    for profile_id, image_index, image_path in iter_image_files(images_dir):
+        key = cache_key(profile_id, image_index)
+        stat = image_path.stat()
+        source = [stat.st_size, stat.st_mtime_ns]
+        entry = index["entries"].get(key)
+        if entry is not None and entry["source"] == source:
+            continue
+
+        try:
+            array = _resize(Image.open(image_path), size, image_processor.resample)
+        except Exception as e:
+            print(f"Warning: Could not load {image_path}: {e}")
+            continue
+
+        shards = index["shards"]
+        if not shards or shards[-1]["count"] == images_per_shard:
+            shards.append({"file": f"shard_{len(shards):05d}.u8", "count": 0})
+            if shard is not None:
+                shard.flush()
+            shard = None
+        if shard is None:
+            shard_path = cache_dir / shards[-1]["file"]
+            shard = np.memmap(
+                shard_path,
+                dtype=np.uint8,
+                mode="r+" if shard_path.exists() else "w+",
+                shape=(images_per_shard, *size, 3),
+            )
+
+        row = shards[-1]["count"]
+        shard[row] = array
+        shards[-1]["count"] += 1
+        index["entries"][key] = {
+            "shard": len(shards) - 1,
+            "row": row,
+            "source": source,
+        }
+        added += 1
+
+    if shard is not None:
+        shard.flush()
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    tmp_path.replace(index_path)
+
+    print(f"Cached {added} new images, {len(index['entries'])} in total")
+    return ImageCache(cache_dir)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the image shard cache.")
+    parser.add_argument("--images-dir", default="data_collection/profiles/images")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--images-per-shard", type=int, default=1024)
+    args = parser.parse_args()
+
+    build_image_cache(
+        args.images_dir,
+        args.cache_dir,
+        model_name=args.model_name,
+        images_per_shard=args.images_per_shard,
+    )
+
+
+if __name__ == "__main__":
+    main()
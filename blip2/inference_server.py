@@ -0,0 +1,475 @@
+"""Long-lived inference service for opening-line generation.
+
+Loading the 2.7B base model, the processor and the LoRA adapters takes
+minutes, and every script used to pay that before its first token.
+``InferenceServer`` loads them once with ``load_finetuned_model`` and keeps
+them warm behind a small HTTP API, on a TCP port or a Unix socket:
+
+- ``POST /generate_opening_line``: JSON with ``profile_text`` and either
+  ``image_path`` (readable by the server) or ``image_base64`` (the image
+  bytes), optionally ``max_new_tokens`` and ``temperature``. Answers with
+  ``opening_line`` and ``latency_seconds``, 400 for an invalid request and
+  504 if there is no answer within ``request_timeout``.
+- ``GET /health``: 200 once the model is loaded, 503 while loading and 500
+  if loading failed, so callers can wait for readiness.
+- ``GET /metrics``: request counts, latency percentiles and batch sizes.
+
+The model starts loading in the background as soon as the server listens.
+Concurrent requests are grouped into batched ``generate`` calls by a
+``BatchScheduler``.
+
+Start it with:
+    uv run python -m blip2.inference_server --socket /tmp/rizz.sock
+
+and use it from another process with ``InferenceClient("unix:///tmp/rizz.sock")``
+or ``uv run python -m blip2.test_finetuned --server unix:///tmp/rizz.sock``.
+"""
+
+import base64
+import contextlib
+import functools
+import http.client
+import io
+import json
+import math
+import os
+import socket
+import statistics
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any, Self
+
+from PIL import Image
+
+from blip2.batch_scheduler import BatchScheduler
+from blip2.test_finetuned import generate_opening_lines
+
+
+DEFAULT_BASE_MODEL = "Salesforce/blip2-opt-2.7b"
+DEFAULT_ADAPTER_PATH = "./blip2_rizz_finetuned"
+LATENCY_WINDOW = 1000  # most recent requests kept for the percentiles
+
+
+class ServerStats:
+    """Request counters and latencies, shared between the handler threads."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.latencies: list[float] = []
+
+    def record(self, latency: float | None) -> None:
+        """Count a finished request, ``None`` for a failed one."""
+        with self.lock:
+            self.requests += 1
+            if latency is None:
+                self.failed += 1
+                return
+            self.latencies.append(latency)
+            del self.latencies[:-LATENCY_WINDOW]
+
+    def as_dict(self) -> dict[str, Any]:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            metrics: dict[str, Any] = {
+                "uptime_seconds": time.monotonic() - self.started,
+                "requests": self.requests,
+                "failed": self.failed,
+                "in_flight": self.in_flight,
+            }
+        if latencies:
+            n = len(latencies)
+            metrics["latency_seconds"] = {
+                "mean": statistics.fmean(latencies),
+                "p50": statistics.median(latencies),
+                "p95": latencies[min(n - 1, int(n * 0.95))],
+                "p99": latencies[min(n - 1, int(n * 0.99))],
+                "max": latencies[-1],
+            }
+        return metrics
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    """HTTP server around a warm fine-tuned model.
+
+    Example:
+        >>> loader = functools.partial(
+        ...     load_finetuned_model, DEFAULT_BASE_MODEL, DEFAULT_ADAPTER_PATH, "cuda"
+        ... )
+        >>> with InferenceServer(loader, "cuda", socket_path="/tmp/rizz.sock"):
+        ...     ...
+
+    Args:
+        load: Returns ``(model, processor)``, called once on a background thread
+        device: Device the model runs on
+        host: Interface to listen on, unless ``socket_path`` is given
+        port: Port to listen on, 0 picks a free one
+        socket_path: Listen on this Unix socket instead of TCP
+        max_batch_size: Most requests generated together
+        max_wait: Seconds a batch waits for more requests after its first one
+        request_timeout: Seconds a request may wait for its opening line
+            before it is answered with 504, below the client's timeout
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], tuple[Any, Any]],
+        device: str,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        socket_path: str | Path | None = None,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        request_timeout: float = 240.0,
+    ) -> None:
+        self.load = load
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.request_timeout = request_timeout
+        self.model: Any = None
+        self.processor: Any = None
+        self.scheduler: BatchScheduler | None = None
+        self.load_seconds: float | None = None
+        self.load_error: str | None = None
+        self.ready = threading.Event()
+        self.stats = ServerStats()
+        self.socket_path = Path(socket_path) if socket_path else None
+        if self.socket_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                self.socket_path.unlink()
+            self.server: Any = _UnixHTTPServer(
+                str(self.socket_path), self._handler_class()
+            )
+        else:
+            self.server = ThreadingHTTPServer((host, port), self._handler_class())
+            self.server.daemon_threads = True
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def url(self) -> str:
+        if self.socket_path is not None:
+            return f"unix://{self.socket_path}"
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        try:
+            self.model, self.processor = self.load()
+        except Exception:
+            self.load_error = traceback.format_exc()
+            print(f"Loading the model failed:\n{self.load_error}")
+            return
+        self.load_seconds = time.perf_counter() - start
+        self.scheduler = BatchScheduler(
+            functools.partial(
+                generate_opening_lines, self.model, self.processor, device=self.device
+            ),
+            self.max_batch_size,
+            self.max_wait,
+        )
+        print(f"Model ready after {self.load_seconds:.1f}s")
+        self.ready.set()
+
+    def health(self) -> tuple[int, dict[str, Any]]:
+        if self.ready.is_set():
+            return 200, {"status": "ready", "load_seconds": self.load_seconds}
+        if self.load_error is not None:
+            return 500, {"status": "failed", "error": self.load_error}
+        return 503, {"status": "loading"}
+
+    def metrics(self) -> dict[str, Any]:
+        metrics = {**self.stats.as_dict(), "ready": self.ready.is_set()}
+        if self.scheduler is not None:
+            metrics["scheduler"] = self.scheduler.stats.as_dict()
+        return metrics
+
+    def generate(self, request: Any) -> tuple[int, dict[str, Any]]:
+        """Produce the status and body for one ``generate_opening_line`` call."""
+        if self.scheduler is None:
+            return 503, {"error": "model is not loaded yet"}
+        if not isinstance(request, dict):
+            return 400, {"error": "bad request: the body must be a JSON object"}
+        try:
+            profile_text = request["profile_text"]
+            if not isinstance(profile_text, str):
+                raise TypeError("profile_text must be a string")
+            # Parameters group requests into batches, they must be hashable
+            max_new_tokens = int(request.get("max_new_tokens", 100))
+            temperature = float(request.get("temperature", 1.0))
+            if max_new_tokens < 1 or not (
+                math.isfinite(temperature) and temperature > 0
+            ):
+                raise ValueError("max_new_tokens and temperature must be positive")
+            if "image_base64" in request:
+                data = base64.b64decode(request["image_base64"])
+                image = Image.open(io.BytesIO(data)).convert("RGB")
+            else:
+                image = Image.open(os.fspath(request["image_path"])).convert("RGB")
+        except (KeyError, OSError, TypeError, ValueError) as e:
+            return 400, {"error": f"bad request: {e!r}"}
+
+        start = time.perf_counter()
+        with self.stats.lock:
+            self.stats.in_flight += 1
+        future = None
+        try:
+            future = self.scheduler.submit(
+                image,
+                profile_text,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+            )
+            opening_line = future.result(timeout=self.request_timeout)
+        except TimeoutError:
+            # Not generated yet, don't spend the model on an abandoned request
+            future.cancel()
+            self.stats.record(None)
+            return 504, {"error": f"no opening line after {self.request_timeout:.0f}s"}
+        except Exception as e:
+            self.stats.record(None)
+            if future is None:
+                # The scheduler is closed, the server is shutting down
+                return 503, {"error": repr(e)}
+            return 500, {"error": repr(e)}
+        finally:
+            with self.stats.lock:
+                self.stats.in_flight -= 1
+        latency = time.perf_counter() - start
+        self.stats.record(latency)
+        return 200, {"opening_line": opening_line, "latency_seconds": latency}
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        inference = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def _send_json(self, status: int, body: dict[str, Any]) -> None:
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                # The client may have given up waiting
+                with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+                    self.wfile.write(payload)
+
+            def do_GET(self) -> None:
+                if self.path == "/health":
+                    self._send_json(*inference.health())
+                elif self.path == "/metrics":
+                    self._send_json(200, inference.metrics())
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self) -> None:
+                if self.path != "/generate_opening_line":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError as e:
+                    self._send_json(400, {"error": f"invalid JSON: {e}"})
+                    return
+                self._send_json(*inference.generate(request))
+
+        return Handler
+
+    def start(self) -> Self:
+        """Listen on a background thread and start loading the model."""
+        for target in (self._load, self.server.serve_forever):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.socket_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                self.socket_path.unlink()
+
+    def __enter__(self) -> Self:
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """Client for a running ``InferenceServer``.
+
+    Example:
+        >>> client = InferenceClient("unix:///tmp/rizz.sock").wait_until_ready()
+        >>> client.generate_opening_line("Her name is Maren...", image_path="1.jpg")
+
+    Args:
+        url: ``http://host:port`` or ``unix:///path/to/socket``
+        timeout: Seconds to wait for a single response
+    """
+
+    def __init__(self, url: str, timeout: float = 300.0) -> None:
+        self.url = url
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.url.startswith("unix://"):
+            return _UnixHTTPConnection(self.url.removeprefix("unix://"), self.timeout)
+        host = self.url.removeprefix("http://").rstrip("/")
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def _request(
+        self, method: str, path: str, body: dict[str, Any] | None = None
+    ) -> tuple[int, dict[str, Any]]:
+        connection = self._connection()
+        try:
+            payload = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if payload else {}
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def health(self) -> dict[str, Any]:
+        return self._request("GET", "/health")[1]
+
+    def metrics(self) -> dict[str, Any]:
+        return self._request("GET", "/metrics")[1]
+
+    def wait_until_ready(self, timeout: float = 900.0, poll: float = 1.0) -> Self:
+        """Block until the server has loaded the model.
+
+        Raises:
+            RuntimeError: Loading failed on the server
+            TimeoutError: The model is not ready after ``timeout`` seconds
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                status, body = self._request("GET", "/health")
+            except OSError:
+                # Not listening yet
+                status, body = 0, {}
+            if status == 200:
+                return self
+            if status == 500:
+                raise RuntimeError(f"Server failed to load the model:\n{body['error']}")
+            time.sleep(poll)
+        raise TimeoutError(f"{self.url} not ready after {timeout:.0f}s")
+
+    def generate_opening_line(
+        self,
+        profile_text: str,
+        image_path: str | Path | None = None,
+        image_bytes: bytes | None = None,
+        max_new_tokens: int = 100,
+        temperature: float = 1.0,
+    ) -> str:
+        """Generate an opening line on the server.
+
+        Args:
+            profile_text: Text description of the profile
+            image_path: Path to the profile image, as seen by the server
+            image_bytes: Encoded image, instead of ``image_path``
+            max_new_tokens: Maximum number of tokens to generate
+            temperature: Sampling temperature
+
+        Returns:
+            Generated opening line
+
+        Raises:
+            RuntimeError: The server answered with an error
+        """
+        request: dict[str, Any] = {
+            "profile_text": profile_text,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+        }
+        if image_bytes is not None:
+            request["image_base64"] = base64.b64encode(image_bytes).decode()
+        elif image_path is not None:
+            request["image_path"] = os.fspath(image_path)
+        else:
+            raise ValueError("Either image_path or image_bytes is required")
+        status, body = self._request("POST", "/generate_opening_line", request)
+        if status != 200:
+            raise RuntimeError(f"Generation failed ({status}): {body['error']}")
+        return body["opening_line"]
+
+
+def main() -> None:
+    import argparse
+
+    import torch
+
+    from blip2.test_finetuned import load_finetuned_model
+
+    parser = argparse.ArgumentParser(description="Serve the fine-tuned model.")
+    parser.add_argument("--base-model", default=DEFAULT_BASE_MODEL)
+    parser.add_argument("--adapter-path", default=DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="Unix socket path")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--request-timeout", type=float, default=240.0)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+    server = InferenceServer(
+        functools.partial(
+            load_finetuned_model, args.base_model, args.adapter_path, device
+        ),
+        device,
+        host=args.host,
+        port=args.port,
+        socket_path=args.socket,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        request_timeout=args.request_timeout,
+    ).start()
+    print(f"Listening on {server.url}, loading the model...")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"Served {server.stats.requests} requests ({server.stats.failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
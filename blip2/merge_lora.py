@@ -0,0 +1,281 @@
+"""Export the fine-tuned model with its LoRA adapters merged into the weights.
+
+``PeftModel`` keeps the adapters as separate low-rank matrices, so every
+``q_proj``/``v_proj`` matmul of the language model also runs the two LoRA
+matmuls, and inference needs both the base model and the adapter on disk.
+``export_merged_model`` folds the adapters into the base weights once
+(``W + scale * B @ A``) and saves a standalone safetensors model, by default
+to ``merged/`` inside the adapter directory. ``load_finetuned_model`` picks
+the export up automatically as long as it was made from the current adapter
+weights.
+
+Merging happens in 16/32-bit precision: adapters cannot be merged losslessly
+into 8-bit weights. The merged model can still be loaded in 8-bit afterwards.
+
+Export and compare per-token latency:
+    uv run python -m blip2.merge_lora export --checkpoint latest
+    uv run python -m blip2.merge_lora benchmark
+"""
+
+import hashlib
+import json
+import re
+import time
+from pathlib import Path
+from typing import Any
+
+import torch
+from peft import PeftModel
+from PIL import Image
+from transformers import Blip2ForConditionalGeneration, Blip2Processor
+
+
+DEFAULT_BASE_MODEL = "Salesforce/blip2-opt-2.7b"
+DEFAULT_ADAPTER_PATH = "./blip2_rizz_finetuned"
+MERGED_SUBDIR = "merged"
+MERGE_INFO_FILE = "merge_info.json"
+ADAPTER_WEIGHTS = ("adapter_model.safetensors", "adapter_model.bin")
+CHECKPOINT_PATTERN = re.compile(r"checkpoint-(\d+)")
+
+
+def resolve_adapter_path(
+    adapter_path: str | Path, checkpoint: str | None = None
+) -> Path:
+    """Pick the adapter directory, or one of its ``checkpoint-*`` subdirectories.
+
+    Args:
+        adapter_path: Training output directory
+        checkpoint: ``None`` for the final adapters, ``"latest"`` for the
+            highest numbered checkpoint, or a step number / directory name
+    """
+    adapter_path = Path(adapter_path)
+    if checkpoint is None:
+        return adapter_path
+    if checkpoint == "latest":
+        steps = [
+            int(match.group(1))
+            for child in adapter_path.iterdir()
+            if (match := CHECKPOINT_PATTERN.fullmatch(child.name))
+        ]
+        if not steps:
+            raise FileNotFoundError(f"No checkpoint-* directories in {adapter_path}")
+        return adapter_path / f"checkpoint-{max(steps)}"
+    if checkpoint.isdigit():
+        return adapter_path / f"checkpoint-{checkpoint}"
+    return adapter_path / checkpoint
+
+
+def adapter_digest(adapter_path: str | Path) -> str:
+    """SHA-256 of the adapter weights, identifies what a merge was made from."""
+    for name in ADAPTER_WEIGHTS:
+        path = Path(adapter_path) / name
+        if path.exists():
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            return digest.hexdigest()
+    raise FileNotFoundError(f"No adapter weights in {adapter_path}")
+
+
+def find_merged_model(adapter_path: str | Path) -> Path | None:
+    """Return a merged export to load instead of ``adapter_path``, if any.
+
+    ``adapter_path`` may be a merged export itself, or an adapter directory
+    with an up-to-date export in its ``merged/`` subdirectory. Exports made
+    from different adapter weights are ignored with a warning.
+    """
+    adapter_path = Path(adapter_path)
+    if (adapter_path / MERGE_INFO_FILE).exists():
+        return adapter_path
+    merged_dir = adapter_path / MERGED_SUBDIR
+    if not (merged_dir / MERGE_INFO_FILE).exists():
+        return None
+    with open(merged_dir / MERGE_INFO_FILE, encoding="utf-8") as f:
+        info = json.load(f)
+    try:
+        current = adapter_digest(adapter_path)
+    except FileNotFoundError:
+        current = None
+    if current != info["adapter_digest"]:
+        print(
+            f"Warning: Ignoring {merged_dir}, it was merged from other adapter "
+            "weights. Export it again to use it."
+        )
+        return None
+    return merged_dir
+
+
+def load_unmerged(
+    base_model_name: str, adapter_path: str | Path, dtype: torch.dtype, device: str
+) -> Any:
+    """Load the base model with the adapters as a separate ``PeftModel``."""
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        base_model_name,
+        dtype=dtype,
+        device_map={"": 0} if device == "cuda" else None,
+    )
+    return PeftModel.from_pretrained(model, str(adapter_path)).eval()
+
+
+def export_merged_model(
+    base_model_name: str = DEFAULT_BASE_MODEL,
+    adapter_path: str | Path = DEFAULT_ADAPTER_PATH,
+    output_dir: str | Path | None = None,
+    dtype: torch.dtype = torch.float16,
+) -> Path:
+    """Merge the adapters into the base weights and save a standalone model.
+
+    Args:
+        base_model_name: Base BLIP-2 model the adapters were trained on
+        adapter_path: Directory with the LoRA adapters
+        output_dir: Where to save, defaults to ``merged/`` in ``adapter_path``
+        dtype: Precision to merge and save in
+
+    Returns:
+        The output directory
+    """
+    adapter_path = Path(adapter_path)
+    output_dir = Path(output_dir or adapter_path / MERGED_SUBDIR)
+    digest = adapter_digest(adapter_path)
+
+    print(f"Merging {adapter_path} into {base_model_name} ({dtype})...")
+    start = time.perf_counter()
+    model = load_unmerged(base_model_name, adapter_path, dtype, "cpu")
+    merged = model.merge_and_unload()
+    merged.save_pretrained(output_dir, safe_serialization=True)
+    # The processor next to the adapters matches the one used for training
+    processor_source = (
+        adapter_path
+        if (adapter_path / "preprocessor_config.json").exists()
+        else base_model_name
+    )
+    Blip2Processor.from_pretrained(processor_source).save_pretrained(output_dir)
+
+    with open(output_dir / MERGE_INFO_FILE, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "base_model": base_model_name,
+                "adapter_path": str(adapter_path),
+                "adapter_digest": digest,
+                "dtype": str(dtype).removeprefix("torch."),
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved merged model to {output_dir} in {time.perf_counter() - start:.0f}s")
+    return output_dir
+
+
+@torch.no_grad()
+def token_latency(
+    model: Any,
+    inputs: dict[str, torch.Tensor],
+    new_tokens: int = 32,
+    repeats: int = 3,
+) -> tuple[float, float]:
+    """Measure ``(prefill_seconds, seconds_per_decoded_token)`` of greedy generation.
+
+    Generating 1 token measures the prefill (vision pass and prompt), the
+    extra time for ``new_tokens`` tokens divided by the extra tokens is the
+    per-token decode latency.
+    """
+
+    def timed(tokens: int) -> float:
+        best = float("inf")
+        for _ in range(repeats):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model.generate(
+                **inputs,
+                do_sample=False,
+                max_new_tokens=tokens,
+                min_new_tokens=tokens,
+            )
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    timed(2)  # warm up
+    prefill = timed(1)
+    return prefill, (timed(new_tokens) - prefill) / (new_tokens - 1)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export or benchmark the merged model."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("export", "benchmark"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--base-model", default=DEFAULT_BASE_MODEL)
+        sub.add_argument("--adapter-path", default=DEFAULT_ADAPTER_PATH)
+        sub.add_argument(
+            "--checkpoint",
+            default=None,
+            help='"latest" or a step, instead of the final adapters',
+        )
+        sub.add_argument("--output-dir", default=None)
+    benchmark = subparsers.choices["benchmark"]
+    benchmark.add_argument(
+        "--image-path", default="data_collection/profiles/images/1/image_1.jpg"
+    )
+    benchmark.add_argument("--new-tokens", type=int, default=32)
+    benchmark.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    adapter_path = resolve_adapter_path(args.adapter_path, args.checkpoint)
+
+    if args.command == "export":
+        export_merged_model(args.base_model, adapter_path, args.output_dir, dtype)
+        return
+
+    merged_dir = (
+        Path(args.output_dir) if args.output_dir else find_merged_model(adapter_path)
+    )
+    if merged_dir is None:
+        merged_dir = export_merged_model(args.base_model, adapter_path, dtype=dtype)
+
+    processor = Blip2Processor.from_pretrained(merged_dir)
+    image = Image.open(args.image_path).convert("RGB")
+    prompt = (
+        "Her name is Maren. She seems to love outdoor activities.\n\n"
+        "Question: What is the best flirting opening line to start a "
+        "conversation with her on Tinder? Answer:"
+    )
+    inputs = processor(images=image, text=prompt, return_tensors="pt").to(
+        device, dtype=dtype
+    )
+
+    results = {}
+    for name in ("unmerged", "merged"):
+        if name == "unmerged":
+            model = load_unmerged(args.base_model, adapter_path, dtype, device)
+        else:
+            model = Blip2ForConditionalGeneration.from_pretrained(
+                merged_dir,
+                dtype=dtype,
+                device_map={"": 0} if device == "cuda" else None,
+            ).eval()
+        results[name] = token_latency(model, inputs, args.new_tokens, args.repeats)
+        del model
+        if device == "cuda":
+            torch.cuda.empty_cache()
+
+    for name, (prefill, per_token) in results.items():
+        print(
+            f"{name:>8}: prefill {prefill * 1000:7.1f} ms, "
+            f"{per_token * 1000:6.2f} ms/token"
+        )
+    speedup = results["unmerged"][1] / results["merged"][1]
+    print(f"Merged decodes {speedup:.2f}x as fast per token")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""Local cache of prepared (merged, dtype-converted, quantised) model weights.
+
+Every entry point used to call ``from_pretrained`` on the 2.7B checkpoint and
+convert or quantise all of its weights again on each start. ``load_model``
+does that once per model, precision and adapter weights, saves the result as
+a safetensors artifact under ``DEFAULT_ARTIFACT_DIR``, and loads the artifact
+directly on later starts.
+
+Artifacts are keyed by the model name, dtype, quantisation config and the
+SHA-256 of the LoRA adapter weights merged into them, so retraining the
+adapters or changing precision builds a new one. A checkpoint loaded as it is
+stored, without adapters or quantisation, gets no artifact. Formats:
+
+- fp16/bf16/fp32 and bitsandbytes 8-bit (GPU): saved with ``save_pretrained``,
+  the 8-bit weights are stored already quantised and loaded as they are.
+- Dynamic int8 (CPU, see ``cpu_backend``): the int8 weights, scales and zero
+  points of the quantised linear layers are stored as plain tensors next to
+  the float weights. The file is memory-mapped, so the float weights are paged
+  in on use and shared between processes on the same node.
+
+Build ahead of a job array and compare load times:
+    uv run python -m blip2.model_artifacts build --device cpu --precision int8
+    uv run python -m blip2.model_artifacts benchmark --device cpu --precision int8
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import time
+from pathlib import Path
+from typing import Any
+
+import torch
+from peft import PeftModel
+from torch import nn
+from torch.ao.nn.quantized import dynamic as nnqd
+from transformers import (
+    BitsAndBytesConfig,
+    Blip2Config,
+    Blip2ForConditionalGeneration,
+    GenerationConfig,
+)
+
+from blip2.cpu_backend import load_cpu_model
+from blip2.merge_lora import MERGE_INFO_FILE, adapter_digest, find_merged_model
+
+
+DEFAULT_ARTIFACT_DIR = "model_artifacts"
+INFO_FILE = "artifact_info.json"
+WEIGHTS_FILE = "model.safetensors"
+# Bump when the artifact layout changes, old artifacts are then rebuilt
+ARTIFACT_VERSION = 1
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+PRECISIONS = ("int8", *DTYPES)
+BNB_INT8 = {"method": "bitsandbytes", "load_in_8bit": True, "llm_int8_threshold": 6.0}
+DYNAMIC_INT8 = {
+    "method": "dynamic",
+    "dtype": "qint8",
+    "modules": "language_model.model.decoder Linear",
+}
+
+SAFETENSORS_DTYPES = {
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def precision_config(precision: str, device: str) -> tuple[torch.dtype, dict | None]:
+    """Return ``(dtype, quantization)`` of a precision on a device.
+
+    ``int8`` is bitsandbytes 8-bit on GPU and PyTorch dynamic int8 on CPU.
+    """
+    if precision == "int8":
+        if device == "cuda":
+            return torch.float16, BNB_INT8
+        return torch.float32, DYNAMIC_INT8
+    if precision not in DTYPES:
+        raise ValueError(f"Unknown precision {precision!r}, use one of {PRECISIONS}")
+    return DTYPES[precision], None
+
+
+def artifact_key(
+    model_name: str,
+    dtype: torch.dtype,
+    quantization: dict | None,
+    adapter_hash: str | None = None,
+) -> dict[str, Any]:
+    """Everything an artifact's weights depend on."""
+    return {
+        "model": model_name,
+        "dtype": str(dtype).removeprefix("torch."),
+        "quantization": quantization,
+        "adapter_digest": adapter_hash,
+        "version": ARTIFACT_VERSION,
+    }
+
+
+def merged_adapter_digest(adapter_path: str | Path) -> str:
+    """Digest of the adapter weights, also for a merged export of them."""
+    info_path = Path(adapter_path) / MERGE_INFO_FILE
+    if info_path.exists():
+        with open(info_path, encoding="utf-8") as f:
+            return json.load(f)["adapter_digest"]
+    return adapter_digest(adapter_path)
+
+
+def artifact_path(artifact_dir: str | Path, key: dict[str, Any]) -> Path:
+    """Directory of the artifact with ``key``, readable prefix plus a hash."""
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    name = re.sub(r"[^A-Za-z0-9.]+", "-", Path(key["model"]).name).strip("-")
+    precision = "int8" if key["quantization"] else key["dtype"]
+    return Path(artifact_dir) / f"{name}-{precision}-{digest[:16]}"
+
+
+def _mmap_safetensors(path: Path) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """Memory-map a safetensors file, returns ``(tensors, metadata)``.
+
+    The tensors are copy-on-write views of the file mapping, nothing is read
+    until they are used.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+    storage = torch.UntypedStorage.from_file(
+        str(path), shared=False, nbytes=path.stat().st_size
+    )
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        raw = torch.empty(0, dtype=torch.uint8).set_(
+            storage, data_start + begin, (end - begin,)
+        )
+        if (data_start + begin) % dtype.itemsize:
+            # safetensors sorts tensors so this does not happen for files it
+            # writes, copy rather than fail on others
+            raw = raw.clone()
+        tensors[name] = raw.view(dtype).view(info["shape"])
+    return tensors, metadata
+
+
+def _save_dynamic_int8(model: Any, output_dir: Path) -> None:
+    """Save a model quantised by ``cpu_backend.quantize_language_model``."""
+    from safetensors.torch import save_file
+
+    tensors = {}
+    quantized = []
+    for name, module in model.named_modules():
+        if isinstance(module, nnqd.Linear):
+            weight, bias = module._weight_bias()
+            if weight.qscheme() != torch.per_tensor_affine:
+                raise ValueError(f"Unsupported qscheme {weight.qscheme()} in {name}")
+            quantized.append(name)
+            tensors[f"{name}.weight_int8"] = weight.int_repr()
+            tensors[f"{name}.weight_scale"] = torch.tensor(weight.q_scale())
+            tensors[f"{name}.weight_zero_point"] = torch.tensor(weight.q_zero_point())
+            if bias is not None:
+                tensors[f"{name}.bias"] = bias.detach()
+
+    # Tied weights (the LM head) are stored once and re-tied on load
+    seen = set()
+    prefixes = tuple(f"{name}." for name in quantized)
+    for name, tensor in [*model.named_parameters(), *model.named_buffers()]:
+        if name.startswith(prefixes) or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensors[name] = tensor.detach().contiguous()
+
+    model.config.save_pretrained(output_dir)
+    model.generation_config.save_pretrained(output_dir)
+    save_file(
+        tensors,
+        output_dir / WEIGHTS_FILE,
+        metadata={"format": "pt", "quantized_linears": json.dumps(quantized)},
+    )
+
+
+def _set_tensor(model: nn.Module, name: str, tensor: torch.Tensor) -> None:
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attr] = tensor
+
+
+def _load_dynamic_int8(artifact_dir: Path) -> Blip2ForConditionalGeneration:
+    """Load a model saved by ``_save_dynamic_int8`` without initialising weights."""
+    config = Blip2Config.from_pretrained(artifact_dir)
+    with torch.device("meta"):
+        model = Blip2ForConditionalGeneration(config)
+    model.generation_config = GenerationConfig.from_pretrained(artifact_dir)
+    tensors, metadata = _mmap_safetensors(artifact_dir / WEIGHTS_FILE)
+
+    for name in json.loads(metadata["quantized_linears"]):
+        linear = model.get_submodule(name)
+        # Built off the meta device, packed weights need real storage
+        with torch.device("cpu"):
+            qlinear = nnqd.Linear(
+                linear.in_features,
+                linear.out_features,
+                bias_=linear.bias is not None,
+                dtype=torch.qint8,
+            )
+        weight = torch._make_per_tensor_quantized_tensor(
+            tensors.pop(f"{name}.weight_int8"),
+            tensors.pop(f"{name}.weight_scale").item(),
+            tensors.pop(f"{name}.weight_zero_point").item(),
+        )
+        qlinear.set_weight_bias(weight, tensors.pop(f"{name}.bias", None))
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child_name, qlinear)
+
+    for name, tensor in tensors.items():
+        _set_tensor(model, name, tensor)
+    model.tie_weights()
+    missing = [
+        name
+        for name, tensor in [*model.named_parameters(), *model.named_buffers()]
+        if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f"{artifact_dir} is missing {', '.join(missing)}")
+    return model.eval()
+
+
+def _build(
+    model_name: str,
+    key: dict[str, Any],
+    adapter_path: str | Path | None,
+    device: str,
+    output_dir: Path,
+) -> Any:
+    """Prepare the model described by ``key`` and save it to ``output_dir``."""
+    dtype = getattr(torch, key["dtype"])
+    quantization = key["quantization"]
+    if quantization == DYNAMIC_INT8:
+        model = load_cpu_model(model_name, "int8", adapter_path)
+        _save_dynamic_int8(model, output_dir)
+        return model
+
+    source = model_name
+    merged_dir = find_merged_model(adapter_path) if adapter_path else None
+    if merged_dir is not None:
+        source, adapter_path = str(merged_dir), None
+    if adapter_path is not None:
+        # Adapters are merged in float precision, before any quantisation
+        model = Blip2ForConditionalGeneration.from_pretrained(source, dtype=dtype)
+        model = PeftModel.from_pretrained(model, str(adapter_path)).merge_and_unload()
+        if quantization is None:
+            model.save_pretrained(output_dir, safe_serialization=True)
+            return model.to(device).eval()
+        source = str(output_dir / "float")
+        model.save_pretrained(source, safe_serialization=True)
+        del model
+
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        source,
+        dtype=dtype,
+        device_map={"": 0} if device == "cuda" else None,
+        quantization_config=(
+            BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+            if quantization == BNB_INT8
+            else None
+        ),
+    )
+    model.save_pretrained(output_dir, safe_serialization=True)
+    shutil.rmtree(output_dir / "float", ignore_errors=True)
+    return model.eval()
+
+
+def checkpoint_dtype(model_name: str) -> torch.dtype | None:
+    """Dtype the checkpoint's weights are stored in, if its config says."""
+    config = Blip2Config.from_pretrained(model_name)
+    dtype = getattr(config, "dtype", None) or getattr(config, "torch_dtype", None)
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype, None)
+    return dtype if isinstance(dtype, torch.dtype) else None
+
+
+def load_model(
+    model_name: str,
+    device: str,
+    precision: str = "int8",
+    adapter_path: str | Path | None = None,
+    artifact_dir: str | Path = DEFAULT_ARTIFACT_DIR,
+    rebuild: bool = False,
+) -> Any:
+    """Load BLIP-2 in ``precision``, from its artifact once it has one.
+
+    Args:
+        model_name: Base model name or path
+        device: ``cuda`` or ``cpu``
+        precision: ``int8`` (bitsandbytes on GPU, dynamic on CPU), ``fp16``,
+            ``bf16`` or ``fp32``
+        adapter_path: LoRA adapters to merge into the weights
+        artifact_dir: Where artifacts are stored
+        rebuild: Build the artifact again even if it exists
+
+    Without adapters or quantisation, in the dtype the checkpoint is stored
+    in, the artifact would be a copy of the checkpoint, so the model is loaded
+    directly instead.
+
+    Returns:
+        The model in eval mode
+    """
+    dtype, quantization = precision_config(precision, device)
+    if (
+        quantization is None
+        and adapter_path is None
+        and dtype == checkpoint_dtype(model_name)
+    ):
+        print(f"{model_name} is stored in {precision}, loading it without an artifact")
+        return Blip2ForConditionalGeneration.from_pretrained(
+            model_name, dtype=dtype, device_map={"": 0} if device == "cuda" else None
+        ).eval()
+
+    adapter_hash = merged_adapter_digest(adapter_path) if adapter_path else None
+    key = artifact_key(model_name, dtype, quantization, adapter_hash)
+    path = artifact_path(artifact_dir, key)
+
+    start = time.perf_counter()
+    if (path / INFO_FILE).exists() and not rebuild:
+        with open(path / INFO_FILE, encoding="utf-8") as f:
+            info = json.load(f)
+        if quantization == DYNAMIC_INT8:
+            model = _load_dynamic_int8(path)
+        else:
+            model = Blip2ForConditionalGeneration.from_pretrained(
+                path, dtype=dtype, device_map={"": 0} if device == "cuda" else None
+            ).eval()
+        print(
+            f"Loaded {path} in {time.perf_counter() - start:.1f}s "
+            f"(building it took {info['build_seconds']:.1f}s)"
+        )
+    else:
+        print(f"Building model artifact {path}...")
+        # Parallel jobs may build the same artifact, the first rename wins
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        model = _build(model_name, key, adapter_path, device, tmp_path)
+        build_seconds = time.perf_counter() - start
+        with open(tmp_path / INFO_FILE, "w", encoding="utf-8") as f:
+            json.dump({**key, "build_seconds": build_seconds}, f, indent=2)
+        if rebuild:
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            tmp_path.rename(path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"Built {path} in {build_seconds:.1f}s")
+
+    # Caches key on the model name, keep it independent of the artifact path
+    model.name_or_path = model.config.name_or_path = model_name
+    return model
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or benchmark model artifacts.")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--adapter-path", default=None)
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--precision", choices=PRECISIONS, default="int8")
+    parser.add_argument("--artifact-dir", default=DEFAULT_ARTIFACT_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        load_model(
+            args.model_name,
+            args.device,
+            args.precision,
+            args.adapter_path,
+            args.artifact_dir,
+            rebuild=True,
+        )
+        return
+
+    # From scratch the way the loaders did it, then from the artifact
+    start = time.perf_counter()
+    dtype, quantization = precision_config(args.precision, args.device)
+    if quantization == DYNAMIC_INT8:
+        model = load_cpu_model(args.model_name, "int8", args.adapter_path)
+    else:
+        model = Blip2ForConditionalGeneration.from_pretrained(
+            args.model_name,
+            dtype=dtype,
+            device_map={"": 0} if args.device == "cuda" else None,
+            quantization_config=(
+                BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+                if quantization == BNB_INT8
+                else None
+            ),
+        )
+        if args.adapter_path:
+            model = PeftModel.from_pretrained(model, args.adapter_path)
+    from_scratch = time.perf_counter() - start
+    del model
+
+    load_model(
+        args.model_name,
+        args.device,
+        args.precision,
+        args.adapter_path,
+        args.artifact_dir,
+    )
+    start = time.perf_counter()
+    load_model(
+        args.model_name,
+        args.device,
+        args.precision,
+        args.adapter_path,
+        args.artifact_dir,
+    )
+    from_artifact = time.perf_counter() - start
+    print(
+        f"from_pretrained + conversion: {from_scratch:.1f}s, "
+        f"artifact: {from_artifact:.1f}s ({from_scratch / from_artifact:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Run parts of the BLIP-2 forward pass separately.
+
+``Blip2ForConditionalGeneration`` only accepts ``pixel_values``, so every call
+runs the vision encoder and the Q-Former. These helpers split the pipeline
+into its three stages (vision encoder, Q-Former + projection, language model)
+so that precomputed outputs of the earlier stages can be reused.
+"""
+
+from typing import Any
+
+import torch
+from torch.nn import functional as F
+from transformers import Blip2ForConditionalGeneration
+
+
+def unwrap_model(model: Any) -> Blip2ForConditionalGeneration:
+    """Return the underlying BLIP-2 model of a (possibly PEFT-wrapped) model.
+
+    LoRA layers are injected in place, so calling the submodules of the
+    unwrapped model still uses the adapters.
+    """
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return model
+
+
+def pixel_dtype(model: Any) -> torch.dtype:
+    """Dtype ``pixel_values`` must be cast to for the model's vision encoder."""
+    return unwrap_model(model).vision_model.embeddings.patch_embedding.weight.dtype
+
+
+def vision_features(model: Any, pixel_values: torch.Tensor) -> torch.Tensor:
+    """Run the vision encoder and return its last hidden state."""
+    model = unwrap_model(model)
+    return model.vision_model(pixel_values, return_dict=True).last_hidden_state
+
+
+def qformer_features(model: Any, image_embeds: torch.Tensor) -> torch.Tensor:
+    """Run the Q-Former on vision encoder outputs.
+
+    Returns:
+        Tensor of shape ``(batch_size, num_query_tokens, qformer_hidden_size)``,
+        the input of the language projection
+    """
+    model = unwrap_model(model)
+    # Cached features may be stored in a different dtype than the vision
+    # encoder computes in, match what the live vision pass would return
+    patch_embedding = model.vision_model.embeddings.patch_embedding.weight
+    image_embeds = image_embeds.to(patch_embedding.device, patch_embedding.dtype)
+    image_attention_mask = torch.ones(
+        image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device
+    )
+    query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+    query_output = model.qformer(
+        query_embeds=query_tokens,
+        encoder_hidden_states=image_embeds,
+        encoder_attention_mask=image_attention_mask,
+        return_dict=True,
+    ).last_hidden_state
+
+    # Qformer is kept in fp32, we downcast the output back if needed
+    if query_output.dtype != image_embeds.dtype:
+        query_output = query_output.to(image_embeds.dtype)
+    return query_output
+
+
+def query_embeds_from_image_embeds(
+    model: Any, image_embeds: torch.Tensor
+) -> torch.Tensor:
+    """Run the Q-Former and language projection on vision encoder outputs.
+
+    Returns:
+        Tensor of shape ``(batch_size, num_query_tokens, lm_hidden_size)``
+        that replaces the image tokens in the language model input
+    """
+    model = unwrap_model(model)
+    return model.language_projection(qformer_features(model, image_embeds))
+
+
+def merge_query_embeds(
+    model: Any, input_ids: torch.Tensor, query_embeds: torch.Tensor
+) -> torch.Tensor:
+    """Embed ``input_ids`` and put ``query_embeds`` in place of the image tokens."""
+    model = unwrap_model(model)
+    inputs_embeds = model.get_input_embeddings()(input_ids)
+    special_image_mask = (input_ids == model.config.image_token_index).unsqueeze(-1)
+    query_embeds = query_embeds.to(inputs_embeds.device, inputs_embeds.dtype)
+    return inputs_embeds.masked_scatter(special_image_mask, query_embeds)
+
+
+def forward_with_image_embeds(
+    model: Any,
+    image_embeds: torch.Tensor,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor | None = None,
+    labels: torch.Tensor | None = None,
+    num_items_in_batch: int | torch.Tensor | None = None,
+) -> dict[str, torch.Tensor]:
+    """Training forward pass that starts from precomputed vision features.
+
+    Equivalent to ``model(pixel_values=..., input_ids=..., labels=...)`` for
+    decoder-only language models, minus the vision encoder.
+
+    Args:
+        model: BLIP-2 model (or PEFT wrapper)
+        image_embeds: Vision encoder last hidden states
+        input_ids: Prompt token IDs, including the image tokens
+        attention_mask: Attention mask for ``input_ids``
+        labels: Target token IDs, -100 for ignored positions
+        num_items_in_batch: Number of label tokens in the whole gradient
+            accumulation batch. If given, the loss is summed and divided by
+            it instead of averaged, like the Trainer expects.
+
+    Returns:
+        Dict with ``logits`` and, if labels are given, ``loss``
+    """
+    blip2 = unwrap_model(model)
+    query_embeds = query_embeds_from_image_embeds(blip2, image_embeds)
+    inputs_embeds = merge_query_embeds(blip2, input_ids, query_embeds)
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+
+    logits = blip2.language_model(
+        inputs_embeds=inputs_embeds, attention_mask=attention_mask, return_dict=True
+    ).logits
+    outputs = {"logits": logits}
+
+    if labels is not None:
+        # Same loss as Blip2ForConditionalGeneration: the labels are aligned
+        # with the end of the sequence, then shifted by one for next-token
+        labels = labels.to(logits.device)
+        logits = logits[:, -labels.size(1) :, :]
+        shift_logits = logits[..., :-1, :].contiguous()
+        shift_labels = labels[..., 1:].contiguous()
+        loss = F.cross_entropy(
+            shift_logits.view(-1, shift_logits.size(-1)).float(),
+            shift_labels.view(-1),
+            ignore_index=-100,
+            reduction="mean" if num_items_in_batch is None else "sum",
+        )
+        if num_items_in_batch is not None:
+            loss = loss / num_items_in_batch
+        outputs["loss"] = loss
+
+    return outputs
+
+
+def image_prompt_inputs(
+    processor: Any, prompts: list[str], num_query_tokens: int | None = None
+) -> dict[str, torch.Tensor]:
+    """Tokenise prompts with the image tokens in front, without any image.
+
+    Gives the same ``input_ids`` the processor produces for an image and a
+    prompt, for use with precomputed query embeddings. Prompts are padded on
+    the left, ready for generation.
+    """
+    if num_query_tokens is None:
+        num_query_tokens = processor.num_query_tokens
+    tokenizer = processor.tokenizer
+    image_token_id = tokenizer.convert_tokens_to_ids(str(processor.image_token))
+    rows = [
+        [image_token_id] * num_query_tokens + ids
+        for ids in tokenizer(prompts)["input_ids"]
+    ]
+    length = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), length), tokenizer.pad_token_id)
+    attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+    for i, row in enumerate(rows):
+        input_ids[i, length - len(row) :] = torch.tensor(row)
+        attention_mask[i, length - len(row) :] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+def generate_from_query_embeds(
+    model: Any,
+    query_embeds: torch.Tensor,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor | None = None,
+    **generate_kwargs: Any,
+) -> torch.Tensor:
+    """``model.generate`` that starts from precomputed query embeddings.
+
+    Args:
+        model: BLIP-2 model (or PEFT wrapper)
+        query_embeds: Output of ``query_embeds_from_image_embeds``, one row per
+            prompt or a single row shared by all prompts
+        input_ids: Prompt token IDs, including the image tokens
+        attention_mask: Attention mask for ``input_ids``
+        **generate_kwargs: Passed on to the language model's ``generate``
+
+    Returns:
+        Generated token IDs, without the prompt
+    """
+    blip2 = unwrap_model(model)
+    if query_embeds.shape[0] != input_ids.shape[0]:
+        query_embeds = query_embeds.expand(input_ids.shape[0], -1, -1)
+    input_ids = input_ids.to(blip2.device)
+    inputs_embeds = merge_query_embeds(blip2, input_ids, query_embeds)
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    return blip2.language_model.generate(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask.to(blip2.device),
+        **generate_kwargs,
+    )
@@ -0,0 +1,231 @@
+"""Concurrent Ollama client for generating "chosen" opening lines.
+
+``OllamaChatClient`` sends chat requests with asyncio, keeping at most
+``concurrency`` requests in flight. Every request has a timeout and is
+retried with exponential backoff on timeouts, connection errors and server
+errors. Results come back keyed and ordered by profile ID, whatever order the
+answers arrive in.
+
+Measure throughput against a local stand-in server (no Ollama needed) with:
+    uv run python -m blip2.ollama_client --stand-in --concurrency 1 4 8
+"""
+
+import asyncio
+import statistics
+import time
+from collections.abc import Mapping
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+from blip2.profile_reader import profile_sort_key
+
+
+DEFAULT_MODEL = "llama3.1"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, ResponseError):
+        return error.status_code in RETRY_STATUS_CODES
+    return isinstance(error, TimeoutError | ConnectionError | httpx.TransportError)
+
+
+class GenerationStats:
+    """Counters and latencies of the requests sent by a client."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.latencies: list[float] = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.elapsed = 0.0
+
+    def report(self) -> None:
+        done = len(self.latencies)
+        throughput = done / self.elapsed if self.elapsed else 0.0
+        latency = ""
+        if done:
+            p50 = statistics.median(self.latencies)
+            p95 = sorted(self.latencies)[min(done - 1, int(done * 0.95))]
+            latency = f", latency p50 {p50:.2f}s p95 {p95:.2f}s"
+        print(
+            f"Ollama: {done}/{self.requests} answered in {self.elapsed:.1f}s "
+            f"({throughput:.2f} requests/sec, peak {self.peak_in_flight} in flight, "
+            f"{self.retries} retries, {self.failures} failed{latency})"
+        )
+
+
+class OllamaChatClient:
+    """Bounded-concurrency chat client with timeouts and retries.
+
+    Example:
+        >>> client = OllamaChatClient("llama3.1", concurrency=4)
+        >>> lines = client.generate({"12": "Give me an opening line for ..."})
+
+    Args:
+        model: Ollama model to chat with
+        host: Ollama server URL, defaults to ``OLLAMA_HOST`` or localhost
+        concurrency: Maximum number of requests in flight
+        timeout: Seconds before a single attempt is abandoned
+        retries: Extra attempts after a retryable failure
+        backoff: Seconds to wait before the first retry, doubled each time
+    """
+
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        host: str | None = None,
+        concurrency: int = 4,
+        timeout: float = 120.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ) -> None:
+        self.model = model
+        self.host = host
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = GenerationStats()
+
+    async def chat(
+        self, client: AsyncClient, limit: asyncio.Semaphore, prompt: str
+    ) -> str:
+        """Send one prompt, retrying retryable failures.
+
+        Args:
+            client: Open Ollama client to send the request with
+            limit: Semaphore bounding the requests in flight, shared by all
+                calls that should count towards ``concurrency``
+            prompt: User message
+
+        Returns:
+            The answer text
+        """
+        self.stats.requests += 1
+        for attempt in range(self.retries + 1):
+            async with limit:
+                self.stats.in_flight += 1
+                self.stats.peak_in_flight = max(
+                    self.stats.peak_in_flight, self.stats.in_flight
+                )
+                start = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(
+                        client.chat(
+                            self.model, messages=[{"role": "user", "content": prompt}]
+                        ),
+                        self.timeout,
+                    )
+                    self.stats.latencies.append(time.perf_counter() - start)
+                    return response.message.content or ""
+                except Exception as e:
+                    if attempt == self.retries or not _is_retryable(e):
+                        raise
+                    self.stats.retries += 1
+                finally:
+                    self.stats.in_flight -= 1
+            # Back off outside the semaphore, so waiting does not hold a slot
+            await asyncio.sleep(self.backoff * 2**attempt)
+        raise AssertionError("unreachable")
+
+    async def chat_many(self, prompts: Mapping[str, str]) -> dict[str, str]:
+        """Answer all prompts concurrently.
+
+        Args:
+            prompts: Prompt per profile ID
+
+        Returns:
+            Answers ordered by profile ID. Profiles whose request failed
+            after all retries are reported and left out.
+        """
+        self.stats = GenerationStats()
+        limit = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        async with AsyncClient(host=self.host) as client:
+            profile_ids = list(prompts)
+            results = await asyncio.gather(
+                *(self.chat(client, limit, prompts[pid]) for pid in profile_ids),
+                return_exceptions=True,
+            )
+        self.stats.elapsed = time.perf_counter() - start
+
+        answers: dict[str, str] = {}
+        for profile_id, result in sorted(
+            zip(profile_ids, results, strict=True),
+            key=lambda item: profile_sort_key(item[0]),
+        ):
+            if isinstance(result, BaseException):
+                print(f"Warning: No answer for profile {profile_id}: {result!r}")
+                self.stats.failures += 1
+            else:
+                answers[profile_id] = result
+        return answers
+
+    def generate(self, prompts: Mapping[str, str]) -> dict[str, str]:
+        """Blocking version of ``chat_many``."""
+        return asyncio.run(self.chat_many(prompts))
+
+
+def main() -> None:
+    import argparse
+
+    from blip2.ollama_standin import OllamaStandIn
+
+    parser = argparse.ArgumentParser(
+        description="Measure Ollama throughput at several concurrency limits."
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--host", default=None)
+    parser.add_argument(
+        "--stand-in",
+        action="store_true",
+        help="Start a local stand-in server instead of using a real Ollama",
+    )
+    parser.add_argument("--stand-in-latency", type=float, default=0.5)
+    parser.add_argument("--stand-in-parallel", type=int, default=4)
+    parser.add_argument("--stand-in-failure-rate", type=float, default=0.0)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    prompts = {
+        str(i): f"Give me the perfect opening line for profile {i}"
+        for i in range(args.requests)
+    }
+
+    server = None
+    host = args.host
+    if args.stand_in:
+        server = OllamaStandIn(
+            latency=args.stand_in_latency,
+            max_parallel=args.stand_in_parallel,
+            failure_rate=args.stand_in_failure_rate,
+        ).start()
+        host = server.url
+        print(f"Started stand-in Ollama at {host}")
+
+    try:
+        for concurrency in args.concurrency:
+            client = OllamaChatClient(
+                args.model,
+                host=host,
+                concurrency=concurrency,
+                timeout=args.timeout,
+                backoff=0.1 if args.stand_in else 1.0,
+            )
+            answers = client.generate(prompts)
+            assert list(answers) == sorted(answers, key=profile_sort_key)
+            print(f"concurrency={concurrency}: ", end="")
+            client.stats.report()
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
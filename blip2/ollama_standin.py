@@ -0,0 +1,217 @@
+"""Local stand-in for the Ollama chat API.
+
+Answers ``POST /api/chat`` like a real Ollama server, after a configurable
+delay and with at most ``max_parallel`` requests being "generated" at a time
+(like ``OLLAMA_NUM_PARALLEL``), the rest wait in a queue. It can also fail or
+stall a fraction of requests. This makes it possible to test the throughput,
+concurrency limit, timeouts and retries of ``blip2/ollama_client.py`` without
+a GPU or a real model.
+
+Run it on its own with:
+    uv run python -m blip2.ollama_standin --port 11435
+"""
+
+import contextlib
+import json
+import random
+import threading
+import time
+from datetime import UTC, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Self
+
+
+class StandInStats:
+    """Request counters, shared between the handler threads."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.stalled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def enter(self) -> None:
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+
+class OllamaStandIn:
+    """Threaded HTTP server imitating Ollama's ``/api/chat`` endpoint.
+
+    Example:
+        >>> with OllamaStandIn(latency=0.2) as server:
+        ...     client = OllamaChatClient(host=server.url)
+
+    Args:
+        host: Interface to listen on
+        port: Port to listen on, 0 picks a free one
+        latency: Seconds spent "generating" each answer
+        jitter: Random extra latency, up to this many seconds
+        max_parallel: Answers generated at the same time, others queue
+        failure_rate: Fraction of requests answered with HTTP 500
+        stall_rate: Fraction of requests that take ``stall_seconds``, to
+            exercise client timeouts
+        stall_seconds: Latency of stalled requests
+        seed: Seed for jitter, failures and stalls
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.5,
+        jitter: float = 0.0,
+        max_parallel: int = 4,
+        failure_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_seconds: float = 30.0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.slots = threading.Semaphore(max_parallel)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.stats = StandInStats()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def _send_json(self, status: int, body: dict[str, Any]) -> None:
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self) -> None:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"Ollama is running")
+
+            def do_POST(self) -> None:
+                if self.path != "/api/chat":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                status, body = standin.answer(request)
+                # The client may have given up on a stalled request
+                with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+                    self._send_json(status, body)
+
+        return Handler
+
+    def answer(self, request: dict[str, Any]) -> tuple[int, dict[str, Any]]:
+        """Produce the status and body for one chat request."""
+        with self.random_lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            fail = self.random.random() < self.failure_rate
+            stall = self.random.random() < self.stall_rate
+
+        with self.slots:
+            self.stats.enter()
+            try:
+                if stall:
+                    with self.stats.lock:
+                        self.stats.stalled += 1
+                    delay = self.stall_seconds
+                time.sleep(delay)
+            finally:
+                self.stats.leave()
+
+        if fail:
+            with self.stats.lock:
+                self.stats.failed += 1
+            return 500, {"error": "stand-in failure"}
+
+        prompt = request.get("messages", [{}])[-1].get("content", "")
+        return 200, {
+            "model": request.get("model", ""),
+            "created_at": datetime.now(UTC).isoformat(),
+            "message": {
+                "role": "assistant",
+                "content": f"Stand-in opening line for a {len(prompt)} character prompt",
+            },
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int(delay * 1e9),
+        }
+
+    def start(self) -> Self:
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> Self:
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a stand-in Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--max-parallel", type=int, default=4)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = OllamaStandIn(
+        args.host,
+        args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        max_parallel=args.max_parallel,
+        failure_rate=args.failure_rate,
+        stall_rate=args.stall_rate,
+    )
+    print(f"Stand-in Ollama listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+        print(
+            f"Served {server.stats.requests} requests, "
+            f"peak {server.stats.peak_in_flight} in flight"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
 """Prepare dataset for BLIP-2 fine-tuning from collected Tinder profiles.
 
 This script loads profile data and images, formats them for training.
+By default the datasets only store image paths, images are decoded when an
+example is accessed.
 """
 
 import json
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
 from typing import Any
 
 from datasets import Dataset
 from PIL import Image
+from transformers import Blip2Processor
+
+from blip2.feature_cache import CachedFeatureTransform, FeatureCache
+from blip2.image_cache import CachedImageTransform, ImageCache
+from blip2.profile_reader import has_name, iter_profiles
+from blip2.token_cache import TokenCache, TokenCacheTransform
 
 
 def load_profile_data(json_path: str) -> dict[str, Any]:
-    """Load profile data from JSON file."""
+    """Load profile data from JSON file.
+
+    Reads the whole corpus into memory, prefer ``iter_profiles`` for large files.
+    """
     with open(json_path, encoding="utf-8") as f:
         return json.load(f)
 
@@ -63,6 +75,50 @@ def format_profile_text(profile: dict[str, Any]) -> str:
     return " ".join(parts)
 
 
+def find_profile_image_paths(
+    profile_id: str, images_dir: str, max_images: int = 3
+) -> list[Path]:
+    """Find the image files of a profile without decoding them.
+
+    Args:
+        profile_id: Profile ID (folder name)
+        images_dir: Base directory containing image folders
+        max_images: Maximum number of image paths to return
+
+    Returns:
+        List of existing image paths, in order
+    """
+    profile_image_dir = Path(images_dir) / profile_id
+    return [
+        image_path
+        for i in range(max_images)
+        if (image_path := profile_image_dir / f"image_{i}.jpg").exists()
+    ]
+
+
+Transform = Callable[[dict[str, list[Any]]], dict[str, list[Any]]]
+
+
+def decode_images(batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+    """Dataset transform that opens the images of path-backed examples."""
+    batch["image"] = [
+        Image.open(image_path).convert("RGB") for image_path in batch["image_path"]
+    ]
+    return batch
+
+
+class ChainedTransform:
+    """Apply several dataset transforms one after the other."""
+
+    def __init__(self, *transforms: Transform) -> None:
+        self.transforms = transforms
+
+    def __call__(self, batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        for transform in self.transforms:
+            batch = transform(batch)
+        return batch
+
+
 def load_profile_images(
     profile_id: str, images_dir: str, max_images: int = 3
 ) -> list[Image.Image]:
@@ -96,27 +152,38 @@ def load_profile_images(
 
 
 def create_training_examples(
-    profiles_data: dict[str, Any], images_dir: str, max_images: int = 3
-) -> list[dict[str, Any]]:
+    profiles_data: dict[str, Any] | Iterable[tuple[str, dict[str, Any]]],
+    images_dir: str,
+    max_images: int = 3,
+    load_images: bool = True,
+) -> Iterator[dict[str, Any]]:
     """Create training examples from profile data.
 
     Args:
-        profiles_data: Dictionary of profile data
+        profiles_data: Dictionary of profile data, or an iterable of
+            (profile_id, profile) pairs such as ``iter_profiles``
         images_dir: Directory containing profile images
         max_images: Maximum images per profile
+        load_images: Decode the image into the example. If False, the example
+            holds an ``image_path`` instead, see ``decode_images``.
 
-    Returns:
-        List of training examples with image, text, and target
+    Yields:
+        Training examples with image (or image_path), text, and target
     """
-    examples = []
+    if isinstance(profiles_data, dict):
+        profiles_data = profiles_data.items()
 
-    for profile_id, profile in profiles_data.items():
+    for profile_id, profile in profiles_data:
         # Skip if no name (invalid profile)
         if not profile.get("name"):
             continue
 
         # Load images
-        images = load_profile_images(profile_id, images_dir, max_images)
+        images: list[Image.Image] | list[Path]
+        if load_images:
+            images = load_profile_images(profile_id, images_dir, max_images)
+        else:
+            images = find_profile_image_paths(profile_id, images_dir, max_images)
         if not images:
             print(f"Warning: No images found for profile {profile_id}")
             continue
@@ -131,17 +198,37 @@ def create_training_examples(
         # In a real scenario, you'd have labeled data with good/bad opening lines
         target = f"Hey {profile.get('name', 'there')}! I noticed we both seem to enjoy similar things. What's your favorite way to spend a weekend?"
 
-        examples.append(
-            {
-                "profile_id": profile_id,
-                "image": images[0],  # Use first image as primary
-                "text": prompt,
-                "target": target,
-                "profile_text": profile_text,
-            }
-        )
-
-    return examples
+        example: dict[str, Any] = {
+            "profile_id": profile_id,
+            "text": prompt,
+            "target": target,
+            "profile_text": profile_text,
+        }
+        # Use first image as primary
+        if load_images:
+            example["image"] = images[0]
+        else:
+            example["image_path"] = str(images[0])
+            example["image_index"] = int(images[0].stem.removeprefix("image_"))
+        yield example
+
+
+def _generate_lazy_examples(
+    json_path: str,
+    images_dir: str,
+    max_images: int,
+    max_profiles: int | None,
+    source_stamp: tuple[int, int],
+) -> Iterator[dict[str, Any]]:
+    """Generator for ``Dataset.from_generator``.
+
+    ``source_stamp`` is unused here, it only makes the datasets cache
+    fingerprint change whenever the profile file does.
+    """
+    profiles = iter_profiles(json_path, profile_filter=has_name, limit=max_profiles)
+    yield from create_training_examples(
+        profiles, images_dir, max_images, load_images=False
+    )
 
 
 def prepare_dataset(
@@ -149,24 +236,52 @@ def prepare_dataset(
     images_dir: str = "data_collection/profiles/images",
     max_images: int = 1,
     train_split: float = 0.8,
+    max_profiles: int | None = None,
+    lazy_images: bool = True,
+    image_cache: ImageCache | None = None,
+    feature_cache: FeatureCache | None = None,
+    token_cache: TokenCache | None = None,
+    processor: Blip2Processor | None = None,
 ) -> tuple[Dataset, Dataset]:
     """Prepare training and validation datasets.
 
     Args:
-        json_path: Path to profile JSON data
+        json_path: Path to profile JSON (or JSONL) data
         images_dir: Directory containing images
         max_images: Maximum images per profile
         train_split: Fraction of data to use for training
+        max_profiles: Only use the first this many named profiles
+        lazy_images: Only store image paths and decode images on access.
+            If False, every image is decoded and serialised up front.
+        image_cache: Read images from this pre-resized cache instead of
+            decoding the JPEGs. Only used with ``lazy_images``.
+        feature_cache: Add precomputed vision features (``image_embeds``)
+            instead of images. Only used with ``lazy_images``.
+        token_cache: Add pre-tokenised ``prompt_ids`` and ``label_ids``.
+            Only used with ``lazy_images``, requires ``processor``.
+        processor: Processor to tokenise examples missing from ``token_cache``
 
     Returns:
         Tuple of (train_dataset, val_dataset)
     """
-    print("Loading profile data...")
-    profiles_data = load_profile_data(json_path)
-    print(f"Loaded {len(profiles_data)} profiles")
+    if lazy_images:
+        return _prepare_lazy_dataset(
+            json_path,
+            images_dir,
+            max_images,
+            train_split,
+            max_profiles,
+            image_cache,
+            feature_cache,
+            token_cache,
+            processor,
+        )
+
+    print("Streaming profile data...")
+    profiles = iter_profiles(json_path, profile_filter=has_name, limit=max_profiles)
 
     print("Creating training examples...")
-    examples = create_training_examples(profiles_data, images_dir, max_images)
+    examples = list(create_training_examples(profiles, images_dir, max_images))
     print(f"Created {len(examples)} training examples")
 
     if not examples:
@@ -183,6 +298,64 @@ def prepare_dataset(
     return train_dataset, val_dataset
 
 
+def _prepare_lazy_dataset(
+    json_path: str,
+    images_dir: str,
+    max_images: int,
+    train_split: float,
+    max_profiles: int | None,
+    image_cache: ImageCache | None,
+    feature_cache: FeatureCache | None,
+    token_cache: TokenCache | None,
+    processor: Blip2Processor | None,
+) -> tuple[Dataset, Dataset]:
+    """Build path-backed datasets that decode images through a transform."""
+    print("Creating path-backed training examples...")
+    stat = Path(json_path).stat()
+    # from_generator writes the examples to an on-disk Arrow file as they are
+    # produced, so no list of examples is ever built in memory
+    dataset = Dataset.from_generator(
+        _generate_lazy_examples,
+        gen_kwargs={
+            "json_path": json_path,
+            "images_dir": images_dir,
+            "max_images": max_images,
+            "max_profiles": max_profiles,
+            "source_stamp": (stat.st_mtime_ns, stat.st_size),
+        },
+    )
+    assert isinstance(dataset, Dataset)
+    print(f"Created {len(dataset)} training examples")
+
+    if len(dataset) == 0:
+        raise ValueError("No training examples created! Check your data.")
+
+    # Split into train and validation
+    split_idx = int(len(dataset) * train_split)
+    transform: Transform
+    if feature_cache is not None:
+        transform = CachedFeatureTransform(feature_cache)
+    elif image_cache is not None:
+        transform = CachedImageTransform(image_cache)
+    else:
+        transform = decode_images
+    if token_cache is not None:
+        if processor is None:
+            raise ValueError("A processor is required when using a token cache")
+        transform = ChainedTransform(
+            transform, TokenCacheTransform(token_cache, processor)
+        )
+    train_dataset = dataset.select(range(split_idx)).with_transform(transform)
+    val_dataset = dataset.select(range(split_idx, len(dataset))).with_transform(
+        transform
+    )
+
+    print(f"Training examples: {len(train_dataset)}")
+    print(f"Validation examples: {len(val_dataset)}")
+
+    return train_dataset, val_dataset
+
+
 if __name__ == "__main__":
     # Test the dataset preparation
     train_ds, val_ds = prepare_dataset()
@@ -195,4 +368,4 @@ if __name__ == "__main__":
     print(f"Profile text: {sample['profile_text'][:200]}...")
     print(f"Prompt: {sample['text'][:200]}...")
     print(f"Target: {sample['target']}")
-    print(f"Image size: {sample['image'].size}")
+    print(f"Image size: {getattr(sample.get('image'), 'size', None)}")
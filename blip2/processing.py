@@ -0,0 +1,53 @@
+"""Helpers for building BLIP-2 model inputs without the full processor call."""
+
+from typing import Any
+
+from transformers import BatchEncoding, Blip2Processor
+
+
+def image_token_ids(processor: Blip2Processor) -> list[int]:
+    """Token IDs the processor prepends to the text for the query embeddings.
+
+    Empty for processors without ``num_query_tokens``, which use the legacy
+    BLIP-2 input format without image tokens.
+    """
+    if processor.num_query_tokens is None:
+        return []
+    image_token_id = processor.tokenizer.convert_tokens_to_ids(
+        processor.image_token.content
+    )
+    return [image_token_id] * processor.num_query_tokens
+
+
+def encode_text(
+    processor: Blip2Processor,
+    texts: list[str],
+    with_image_tokens: bool = True,
+    return_tensors: str | None = "pt",
+    **tokenizer_kwargs: Any,
+) -> BatchEncoding:
+    """Tokenize prompts the same way ``processor(images=..., text=...)`` does.
+
+    Useful when the pixel values come from somewhere other than the image
+    processor, for example a cache.
+
+    Args:
+        processor: BLIP-2 processor
+        texts: Prompts to tokenize
+        with_image_tokens: Prepend the image tokens like the processor does
+            when images are passed
+        return_tensors: Tensor type of the result
+        **tokenizer_kwargs: Passed on to the tokenizer (padding, truncation...)
+
+    Returns:
+        Encoding with input_ids and attention_mask
+    """
+    encoding = processor.tokenizer(texts, **tokenizer_kwargs)
+    prefix = image_token_ids(processor) if with_image_tokens else []
+    if prefix:
+        # Image tokens go first, before BOS, and are never padded or truncated
+        encoding["input_ids"] = [prefix + ids for ids in encoding["input_ids"]]
+        encoding["attention_mask"] = [
+            [1] * len(prefix) + mask for mask in encoding["attention_mask"]
+        ]
+    return BatchEncoding(dict(encoding), tensor_type=return_tensors)
@@ -0,0 +1,144 @@
+"""Stream profiles from disk without loading the whole corpus.
+
+Supports the ``text_data.json`` layout written by the scraper (one JSON object
+mapping profile IDs to profiles) and a newline-delimited variant where every
+line is a profile object with an extra ``"id"`` key.
+"""
+
+import json
+from collections.abc import Callable, Iterator
+from itertools import islice
+from pathlib import Path
+from typing import Any, TextIO
+
+
+CHUNK_SIZE = 1 << 16
+
+ProfileFilter = Callable[[str, dict[str, Any]], bool]
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    """Read-ahead text buffer used by the incremental JSON object parser."""
+
+    def __init__(self, f: TextIO) -> None:
+        self.f = f
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Read another chunk, dropping consumed text. Returns False at EOF."""
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        self.text = self.text[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def skip_whitespace(self) -> str:
+        """Advance past whitespace and return the next character ("" at EOF)."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        found = self.skip_whitespace()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, got {found!r}")
+        self.pos += 1
+
+    def decode_value(self) -> Any:
+        """Decode the next complete JSON value, reading more input as needed."""
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A value ending exactly at the buffer edge might be a truncated
+            # number, so only trust it once there is more input or none left
+            if end < len(self.text) or self.eof or not self.fill():
+                self.pos = end
+                return value
+
+
+def _iter_json_object(f: TextIO) -> Iterator[tuple[str, dict[str, Any]]]:
+    """Yield the key/value pairs of a top-level JSON object one at a time."""
+    buffer = _Buffer(f)
+    buffer.expect("{")
+    if buffer.skip_whitespace() == "}":
+        return
+    while True:
+        key = buffer.decode_value()
+        buffer.expect(":")
+        yield str(key), buffer.decode_value()
+
+        separator = buffer.skip_whitespace()
+        buffer.pos += 1
+        if separator == "}":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or '}}' at offset {buffer.pos - 1}")
+
+
+def _iter_jsonl(f: TextIO) -> Iterator[tuple[str, dict[str, Any]]]:
+    """Yield ``(id, profile)`` pairs from a newline-delimited file."""
+    for line in f:
+        if not line.strip():
+            continue
+        profile = json.loads(line)
+        profile_id = profile.pop("id")
+        yield str(profile_id), profile
+
+
+def iter_profiles(
+    path: str | Path,
+    profile_filter: ProfileFilter | None = None,
+    limit: int | None = None,
+) -> Iterator[tuple[str, dict[str, Any]]]:
+    """Lazily yield ``(profile_id, profile)`` pairs from a profile file.
+
+    Files ending in ``.jsonl`` or ``.ndjson`` are read line by line, anything
+    else is parsed incrementally as a ``text_data.json`` style object.
+
+    Args:
+        path: Path to the profile file
+        profile_filter: Only yield profiles for which this returns True
+        limit: Stop after yielding this many profiles
+
+    Yields:
+        Tuples of (profile_id, profile dict)
+    """
+    path = Path(path)
+    with open(path, encoding="utf-8") as f:
+        if path.suffix in (".jsonl", ".ndjson"):
+            profiles = _iter_jsonl(f)
+        else:
+            profiles = _iter_json_object(f)
+        if profile_filter is not None:
+            profiles = (
+                (profile_id, profile)
+                for profile_id, profile in profiles
+                if profile_filter(profile_id, profile)
+            )
+        yield from islice(profiles, limit)
+
+
+def has_name(profile_id: str, profile: dict[str, Any]) -> bool:
+    """Filter out profiles without a name (failed scrapes)."""
+    return bool(profile.get("name"))
+
+
+def profile_sort_key(profile_id: str) -> tuple[int, int | str]:
+    """Sort numeric profile IDs numerically, other IDs after them by name."""
+    return (0, int(profile_id)) if profile_id.isdigit() else (1, profile_id)
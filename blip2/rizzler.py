@@ -2,19 +2,241 @@
 # 🖖
 # AI, Machinelearning, DeepLearning, ComputerVision, NLP
 # BLIP-2, Rizzler, Rizz, Flirting, ChatGPT, GPT-4, LLM
-from transformers import Blip2Processor, Blip2QFormerModel
+"""Library entry point: captions, VQA and opening lines on shared models.
 
+Scripts used to load a multi-GB BLIP-2 model when imported. ``Rizzler.get``
+instead returns one instance per model configuration for the whole process,
+and the model is only loaded on the first call that needs it (or on
+``load()``), from the model artifact cache. Importing this module does not
+import torch or transformers.
 
-q_former = (
-    Blip2QFormerModel()
-)  # we need to construct the q-former, probably just use qformer_config
+    >>> rizzler = Rizzler.get()
+    >>> rizzler.caption(["image_0.jpg", "image_1.jpg"])
+    >>> rizzler.answer(["image_0.jpg"], ["What is she doing?"])
+    >>> finetuned = Rizzler.get(adapter_path="./blip2_rizz_finetuned")
+    >>> finetuned.opening_lines(["image_0.jpg"], ["Her name is Maren."])
 
-loaded_data = ...  # load some data which we want to run the model on
+Every method takes a batch and runs it as one ``generate`` call. The vision
+encoder and Q-Former run once per image, their output is kept in a
+``QueryEmbeddingCache``, so captioning an image and then asking about it only
+encodes it once.
+"""
 
-processor = Blip2Processor.from_pretrained(
-    "Salesforce/blip2-opt-2.7b"
-)  # this processes the loaded_data
+import threading
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, ClassVar, Self
 
-model = ...  # here we load our finished trained model
 
-# Run the model on the processed data
+DEFAULT_MODEL = "Salesforce/blip2-opt-2.7b"
+
+
+class Rizzler:
+    """One lazily loaded BLIP-2 model, shared through ``Rizzler.get``.
+
+    Args:
+        model_name: Base BLIP-2 model
+        adapter_path: LoRA adapters to merge in, for the fine-tuned model
+        device: ``cuda`` or ``cpu``
+        precision: ``int8`` (bitsandbytes on GPU, dynamic on CPU), ``fp16``,
+            ``bf16`` or ``fp32``
+    """
+
+    _registry: ClassVar[dict[tuple[str, str | None, str, str], "Rizzler"]] = {}
+    _registry_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL,
+        adapter_path: str | None = None,
+        device: str = "cpu",
+        precision: str = "int8",
+    ) -> None:
+        self.model_name = model_name
+        self.adapter_path = adapter_path
+        self.device = device
+        self.precision = precision
+        # Held while the model generates, pass it as ``model_lock`` to other
+        # users of ``model`` so they take turns with the methods here
+        self.lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._model: Any = None
+        self._processor: Any = None
+        self._embedding_cache: Any = None
+
+    @classmethod
+    def get(
+        cls,
+        model_name: str = DEFAULT_MODEL,
+        adapter_path: str | Path | None = None,
+        device: str | None = None,
+        precision: str = "int8",
+    ) -> Self:
+        """Return the process-wide instance for a model configuration.
+
+        Nothing is loaded until the instance is first used.
+
+        Args:
+            model_name: Base BLIP-2 model
+            adapter_path: LoRA adapters to merge in, for the fine-tuned model
+            device: Defaults to ``cuda`` if available, else ``cpu``
+            precision: ``int8``, ``fp16``, ``bf16`` or ``fp32``
+        """
+        if device is None:
+            import torch
+
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        key = (
+            model_name,
+            str(adapter_path) if adapter_path else None,
+            device,
+            precision,
+        )
+        with cls._registry_lock:
+            if key not in cls._registry:
+                cls._registry[key] = cls(*key)
+            return cls._registry[key]
+
+    @classmethod
+    def clear(cls) -> None:
+        """Forget all instances, their models are freed once unused."""
+        with cls._registry_lock:
+            cls._registry.clear()
+
+    def load(self) -> Self:
+        """Load the model and processor if that has not happened yet."""
+        with self._load_lock:
+            if self._model is not None:
+                return self
+            from transformers import Blip2Processor
+
+            from blip2.cpu_backend import configure_threads
+            from blip2.embedding_cache import QueryEmbeddingCache
+            from blip2.model_artifacts import load_model
+
+            if self.device == "cpu":
+                print(f"Using {configure_threads()} CPU threads")
+            print(f"Loading {self.model_name} ({self.precision}, {self.device})...")
+            self._processor = Blip2Processor.from_pretrained(self.model_name)
+            self._embedding_cache = QueryEmbeddingCache()
+            self._model = load_model(
+                self.model_name, self.device, self.precision, self.adapter_path
+            )
+        return self
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self) -> Any:
+        return self.load()._model
+
+    @property
+    def processor(self) -> Any:
+        return self.load()._processor
+
+    @property
+    def embedding_cache(self) -> Any:
+        return self.load()._embedding_cache
+
+    def generate(
+        self,
+        images: Sequence[Any],
+        prompts: Sequence[str],
+        stop_rules: Any = None,
+        **generate_kwargs: Any,
+    ) -> list[str]:
+        """Continue each prompt about its image, in one ``generate`` call.
+
+        Args:
+            images: Paths, encoded bytes or decoded images, one per prompt
+            prompts: Text following the image tokens, may be empty
+            stop_rules: ``stopping.StopRules``, each prompt stops generating
+                where its line ends and the text is cut there
+            **generate_kwargs: Passed on to ``generate``
+
+        Returns:
+            The generated text of each prompt, without the prompt
+        """
+        import torch
+
+        from blip2.modeling import generate_from_query_embeds, image_prompt_inputs
+        from blip2.stopping import opens_quote
+
+        if len(images) != len(prompts):
+            raise ValueError(f"Got {len(images)} images for {len(prompts)} prompts")
+        if not prompts:
+            return []
+        model, processor = self.model, self.processor
+        quote_open = [opens_quote(prompt) for prompt in prompts]
+        if stop_rules:
+            # Generating from embeddings, the output holds only the new tokens
+            generate_kwargs["stopping_criteria"] = stop_rules.criteria(
+                processor.tokenizer, quote_open=quote_open
+            )
+        with self.lock, torch.no_grad():
+            query_embeds = self._embedding_cache.encode(model, processor, images)
+            outputs = generate_from_query_embeds(
+                model,
+                query_embeds,
+                **image_prompt_inputs(processor, list(prompts)),
+                **generate_kwargs,
+            )
+        texts = processor.batch_decode(outputs, skip_special_tokens=True)
+        if stop_rules:
+            return [
+                stop_rules.trim(text, flag)
+                for text, flag in zip(texts, quote_open, strict=True)
+            ]
+        return [text.strip() for text in texts]
+
+    def caption(
+        self, images: Sequence[Any], max_new_tokens: int = 20, **generate_kwargs: Any
+    ) -> list[str]:
+        """Describe each image."""
+        return self.generate(
+            images, [""] * len(images), max_new_tokens=max_new_tokens, **generate_kwargs
+        )
+
+    def answer(
+        self,
+        images: Sequence[Any],
+        questions: Sequence[str],
+        max_new_tokens: int = 30,
+        **generate_kwargs: Any,
+    ) -> list[str]:
+        """Answer one question about each image, with BLIP-2's VQA prompt."""
+        return self.generate(
+            images,
+            [f"Question: {question} Answer:" for question in questions],
+            max_new_tokens=max_new_tokens,
+            **generate_kwargs,
+        )
+
+    def opening_lines(
+        self,
+        images: Sequence[Any],
+        profile_texts: Sequence[str],
+        max_new_tokens: int = 100,
+        temperature: float = 1.0,
+    ) -> list[str]:
+        """Opening line for each profile, sampled like ``generate_opening_lines``.
+
+        Use an instance with the fine-tuned adapters, the base model was not
+        trained on the prompt.
+        """
+        from blip2.stopping import DEFAULT_STOP_RULES
+        from blip2.test_finetuned import opening_line_prompt
+
+        return self.generate(
+            images,
+            [opening_line_prompt(profile_text) for profile_text in profile_texts],
+            stop_rules=DEFAULT_STOP_RULES,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=temperature,
+            top_p=0.9,
+            num_beams=4,
+            repetition_penalty=1.2,
+        )
@@ -0,0 +1,178 @@
+"""Length-bucketed batching for BLIP-2 fine-tuning.
+
+Profile texts vary a lot in length depending on which sections are filled
+in, and every batch is padded to its longest prompt. ``LengthBucketBatchSampler``
+shuffles the dataset, cuts it into chunks of many batches, sorts each chunk by
+token length and then shuffles the order of the resulting batches. Batches
+hold examples of similar length while the epoch order stays random.
+"""
+
+import math
+import random
+from collections.abc import Iterator, Sequence
+from typing import Any
+
+from datasets import Dataset
+from torch.utils.data import Sampler
+from transformers import Blip2Processor, TrainerCallback
+
+from blip2.token_cache import TokenCache
+
+
+def example_lengths(
+    dataset: Dataset,
+    processor: Blip2Processor,
+    token_cache: TokenCache | None = None,
+    batch_size: int = 1000,
+) -> list[int]:
+    """Number of prompt tokens of every example in the dataset.
+
+    Uses the token cache where possible and tokenises the rest.
+    """
+    # Read the raw columns, without decoding images through the transform
+    raw = dataset.with_format(None).select_columns(["profile_id", "text"])
+    cached = token_cache.prompt_lengths() if token_cache is not None else {}
+
+    lengths: list[int] = []
+    for start in range(0, len(raw), batch_size):
+        rows = raw[start : start + batch_size]
+        missing = [
+            text
+            for profile_id, text in zip(rows["profile_id"], rows["text"], strict=True)
+            if profile_id not in cached
+        ]
+        tokenized = iter(
+            processor.tokenizer(missing, truncation=True)["input_ids"]
+            if missing
+            else []
+        )
+        lengths.extend(
+            cached[profile_id] if profile_id in cached else len(next(tokenized))
+            for profile_id in rows["profile_id"]
+        )
+    return lengths
+
+
+def padding_stats(lengths: Sequence[int], batches: Sequence[list[int]]) -> dict:
+    """Real and padded token counts of a list of batches."""
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    return {
+        "real_tokens": real,
+        "padded_tokens": padded,
+        "padding_ratio": 1 - real / padded if padded else 0.0,
+    }
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    """Yield batches of indices with similar lengths in a random order.
+
+    Every epoch draws a new permutation, so consecutive epochs (and the
+    micro-batches that make up one gradient accumulation step) still see
+    different mixes of examples. Only the last batch of an epoch can be
+    smaller than ``batch_size``, so the number of batches is the same as
+    with plain shuffling.
+
+    Args:
+        lengths: Token length of every example
+        batch_size: Number of examples per batch
+        bucket_batches: Number of batches per sorted chunk. Larger values
+            give tighter batches but less randomness.
+        shuffle: Shuffle examples and batches. If False, batches follow
+            dataset order (used for evaluation).
+        seed: Base seed, combined with the epoch number
+        drop_last: Drop the last incomplete batch
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_batches: int = 50,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ) -> None:
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.history: list[dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _batches(self, rng: random.Random) -> list[list[int]]:
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        # Chunks are a whole number of batches, so sorting within a chunk never
+        # creates extra partial batches
+        chunk_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), chunk_size):
+            chunk = sorted(
+                indices[start : start + chunk_size],
+                key=lambda i: self.lengths[i],
+                reverse=True,
+            )
+            batches.extend(
+                chunk[i : i + self.batch_size]
+                for i in range(0, len(chunk), self.batch_size)
+            )
+
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        batches = self._batches(rng)
+
+        # Padding with plain shuffling, for comparison
+        indices = list(range(len(self.lengths)))
+        rng.shuffle(indices)
+        uniform = [
+            indices[i : i + self.batch_size]
+            for i in range(0, len(indices), self.batch_size)
+        ]
+        stats = padding_stats(self.lengths, batches)
+        stats["uniform_padding_ratio"] = padding_stats(self.lengths, uniform)[
+            "padding_ratio"
+        ]
+        stats["epoch"] = self.epoch
+        self.history.append(stats)
+
+        self.epoch += 1
+        yield from batches
+
+
+class PaddingStatsCallback(TrainerCallback):
+    """Print the padding ratio of the bucketed batches after every epoch."""
+
+    def __init__(self, sampler: LengthBucketBatchSampler) -> None:
+        self.sampler = sampler
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if not self.sampler.history:
+            return
+        stats = self.sampler.history[-1]
+        saved = 1 - stats["padded_tokens"] / (
+            stats["real_tokens"] / (1 - stats["uniform_padding_ratio"])
+        )
+        print(
+            f"Epoch {stats['epoch']}: padding ratio {stats['padding_ratio']:.1%} "
+            f"(uniform shuffling: {stats['uniform_padding_ratio']:.1%}), "
+            f"{saved:.1%} fewer prompt tokens per epoch"
+        )
@@ -0,0 +1,206 @@
+"""Split the annotation job across SLURM array tasks and merge the results.
+
+Profiles are assigned to shards by a SHA-1 hash of the profile ID, so the
+partition only depends on the IDs and the shard count: every run, machine
+and Python process agrees on it (unlike the salted built-in ``hash``). Each
+array task writes its own ``annotations.shard-<i>-of-<n>.jsonl``, and
+``merge_shards`` combines them into one file sorted by profile ID, checking
+that every profile was annotated exactly once by the shard that owns it.
+
+Merge after all array tasks finished:
+    uv run python -m blip2.sharding merge --num-shards 8
+
+Run the whole flow locally, one process per shard:
+    uv run python -m blip2.sharding run-local --num-shards 3 -- python -m blip2.generate_annontations
+"""
+
+import hashlib
+import json
+import os
+from collections.abc import Iterable
+from pathlib import Path
+
+from blip2.annotation_output import iter_annotations
+from blip2.profile_reader import profile_sort_key
+
+
+DEFAULT_OUTPUT = "data_collection/profiles/annotations.jsonl"
+
+
+def shard_of(profile_id: str, num_shards: int) -> int:
+    """Index of the shard that owns a profile."""
+    digest = hashlib.sha1(profile_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def shard_from_env() -> tuple[int, int]:
+    """Read ``(shard_index, num_shards)`` from the SLURM array variables.
+
+    Outside an array job this is ``(0, 1)``, a single shard with everything.
+    Arrays with a step (``--array=0-14:2``) are supported, the task IDs are
+    numbered by their position in the array.
+
+    Raises:
+        ValueError: If the task ID is not one of the array's task IDs, e.g.
+            for a comma separated ``--array=1,4,9`` that is not evenly spaced
+    """
+    if "SLURM_ARRAY_TASK_ID" not in os.environ:
+        return 0, 1
+    task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    task_min = int(os.environ.get("SLURM_ARRAY_TASK_MIN", "0"))
+    task_step = int(os.environ.get("SLURM_ARRAY_TASK_STEP", "1"))
+    num_shards = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    shard_index, offset = divmod(task_id - task_min, task_step)
+    if offset or not 0 <= shard_index < num_shards:
+        raise ValueError(
+            f"Task {task_id} is not in an array of {num_shards} tasks starting at "
+            f"{task_min} with step {task_step}, use --array=<min>-<max>[:<step>]"
+        )
+    return shard_index, num_shards
+
+
+def shard_path(output: str | Path, shard_index: int, num_shards: int) -> Path:
+    """Output file of one shard, next to the merged ``output``.
+
+    With a single shard this is ``output`` itself.
+    """
+    output = Path(output)
+    if num_shards == 1:
+        return output
+    return output.with_name(
+        f"{output.stem}.shard-{shard_index:05d}-of-{num_shards:05d}{output.suffix}"
+    )
+
+
+def merge_shards(
+    output: str | Path,
+    num_shards: int,
+    expected_ids: Iterable[str] | None = None,
+    allow_missing: bool = False,
+) -> dict[str, int]:
+    """Combine the shard files into ``output``, sorted by profile ID.
+
+    Args:
+        output: Merged file to write, the shard files are found next to it
+        num_shards: Number of shards the job was split into
+        expected_ids: Profile IDs that should all be annotated
+        allow_missing: Write the merged file even if coverage is incomplete
+
+    Returns:
+        Counts of ``merged``, ``missing``, ``duplicates`` and ``misplaced``
+        (annotated by a shard that does not own the profile)
+
+    Raises:
+        FileNotFoundError: A shard file does not exist
+        ValueError: Expected profiles are missing and ``allow_missing`` is off
+    """
+    records: dict[str, dict] = {}
+    duplicates = misplaced = 0
+    for shard_index in range(num_shards):
+        path = shard_path(output, shard_index, num_shards)
+        if not path.exists():
+            raise FileNotFoundError(f"Shard {shard_index} output {path} is missing")
+        for record in iter_annotations(path):
+            profile_id = record["profile_id"]
+            if shard_of(profile_id, num_shards) != shard_index:
+                misplaced += 1
+            if profile_id in records:
+                duplicates += 1
+                continue
+            records[profile_id] = record
+
+    missing: list[str] = []
+    if expected_ids is not None:
+        missing = sorted(set(expected_ids) - records.keys(), key=profile_sort_key)
+
+    counts = {
+        "merged": len(records),
+        "missing": len(missing),
+        "duplicates": duplicates,
+        "misplaced": misplaced,
+    }
+    print(
+        f"Merged {len(records)} annotations from {num_shards} shards "
+        f"({len(missing)} missing, {duplicates} duplicates, {misplaced} misplaced)"
+    )
+    if missing:
+        shown = ", ".join(missing[:20]) + (", ..." if len(missing) > 20 else "")
+        print(f"Missing profiles: {shown}")
+        missing_shards = sorted({shard_of(pid, num_shards) for pid in missing})
+        print(f"Rerun shards {missing_shards} to resume them")
+        if not allow_missing:
+            raise ValueError(f"{len(missing)} profiles have no annotation")
+
+    output = Path(output)
+    tmp_path = output.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for profile_id in sorted(records, key=profile_sort_key):
+            f.write(json.dumps(records[profile_id], ensure_ascii=False) + "\n")
+    tmp_path.replace(output)
+    print(f"Saved merged annotations to {output}")
+    return counts
+
+
+def run_local(command: list[str], num_shards: int) -> list[int]:
+    """Run ``command`` once per shard as parallel processes, like an array job.
+
+    Returns:
+        Exit code of every shard
+    """
+    import subprocess
+
+    processes = []
+    for shard_index in range(num_shards):
+        env = {
+            **os.environ,
+            "SLURM_ARRAY_TASK_ID": str(shard_index),
+            "SLURM_ARRAY_TASK_MIN": "0",
+            "SLURM_ARRAY_TASK_STEP": "1",
+            "SLURM_ARRAY_TASK_COUNT": str(num_shards),
+        }
+        processes.append(subprocess.Popen(command, env=env))
+    codes = [process.wait() for process in processes]
+    for shard_index, code in enumerate(codes):
+        print(f"Shard {shard_index}: exit code {code}")
+    return codes
+
+
+def main() -> None:
+    import argparse
+    import sys
+
+    from blip2.profile_reader import iter_profiles
+
+    parser = argparse.ArgumentParser(description="Merge sharded annotation output.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("merge", "run-local"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--num-shards", type=int, required=True)
+        sub.add_argument("--output", default=DEFAULT_OUTPUT)
+        sub.add_argument(
+            "--json-path",
+            default="data_collection/profiles/text_data.json",
+            help="Profiles that must all be annotated",
+        )
+        sub.add_argument("--allow-missing", action="store_true")
+    subparsers.choices["run-local"].add_argument(
+        "shard_command", nargs=argparse.REMAINDER, help="Command to run per shard"
+    )
+    args = parser.parse_args()
+
+    if args.command == "run-local":
+        shard_command = args.shard_command
+        if shard_command and shard_command[0] == "--":
+            shard_command = shard_command[1:]
+        if any(run_local(shard_command, args.num_shards)):
+            sys.exit("Some shards failed, rerun to resume them")
+
+    expected = (profile_id for profile_id, _ in iter_profiles(args.json_path))
+    try:
+        merge_shards(args.output, args.num_shards, expected, args.allow_missing)
+    except (FileNotFoundError, ValueError) as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+"""Assisted (speculative) decoding with a small OPT draft model.
+
+Every generated token is one forward pass of the 2.7B OPT language model,
+and at batch size 1 that pass is bound by reading the weights, not by
+compute. A much smaller OPT model with the same tokenizer proposes
+``num_draft_tokens`` tokens, and the large model checks all of them in a
+single forward pass. Proposals are accepted up to the first one the large
+model disagrees with, plus one token from the large model itself, so every
+verify pass yields at least one token. Greedy decoding gives exactly the
+large model's greedy output. With sampling, speculative sampling (accept
+with probability ``min(1, p / q)``, resample from ``max(p - q, 0)`` on a
+reject) keeps the large model's distribution.
+
+The draft is conditioned on the same visual prefix. It is a BLIP-2 model
+with the vision encoder and Q-Former of the target and a small OPT as
+language model (``build_draft_model``), so it loads, fine-tunes and merges
+like any BLIP-2 checkpoint. Only its language projection is new. Without
+training it the draft cannot read the image, and it guesses less often.
+At inference the vision encoder and Q-Former run once, on the target, and
+each model projects the Q-Former output with its own projection.
+
+``transformers``' assisted generation cannot be used: it hands the draft the
+target's ``input_ids`` only, and generating from the query embeddings the
+target needs ``inputs_embeds``. ``assisted_generate`` runs the draft and
+verify loop on both models' key/value caches instead. It decodes one prompt
+at a time without beam search or repetition penalty, and a batch is decoded
+prompt by prompt.
+
+Build the draft, fine-tune it on the same targets, and benchmark:
+    uv run python -m blip2.speculative build --draft-lm facebook/opt-125m
+    uv run python -m blip2.train_blip2 --model-name ./blip2_draft --output-dir ./blip2_draft_finetuned --train-projection
+    uv run python -m blip2.speculative benchmark --draft-adapter-path ./blip2_draft_finetuned
+    uv run python -m blip2.speculative benchmark --random
+"""
+
+from pathlib import Path
+from typing import Any
+
+import torch
+from transformers import (
+    Blip2Config,
+    Blip2ForConditionalGeneration,
+    DynamicCache,
+    OPTForCausalLM,
+    StoppingCriteriaList,
+)
+
+from blip2.cpu_backend import DEFAULT_PRECISION
+from blip2.model_artifacts import load_model
+from blip2.modeling import (
+    merge_query_embeds,
+    pixel_dtype,
+    qformer_features,
+    unwrap_model,
+    vision_features,
+)
+
+
+DEFAULT_BASE_MODEL = "Salesforce/blip2-opt-2.7b"
+DEFAULT_DRAFT_LM = "facebook/opt-125m"
+DEFAULT_DRAFT_DIR = "./blip2_draft"
+DEFAULT_NUM_DRAFT_TOKENS = 4
+RANDOM_VOCAB_SIZE = 2048
+
+
+class AssistedStats:
+    """Acceptance of drafted tokens over ``assisted_generate`` calls."""
+
+    def __init__(self) -> None:
+        self.lines = 0
+        self.new_tokens = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.target_calls = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_target_call(self) -> float:
+        return self.new_tokens / self.target_calls if self.target_calls else 0.0
+
+    def report(self) -> None:
+        print(
+            f"Assisted decoding: {self.new_tokens} tokens for {self.lines} lines, "
+            f"{self.accepted}/{self.drafted} drafted tokens accepted "
+            f"({self.acceptance_rate:.0%}), "
+            f"{self.tokens_per_target_call:.2f} tokens per target forward pass"
+        )
+
+
+def build_draft_model(
+    target: Any, draft_lm: OPTForCausalLM
+) -> Blip2ForConditionalGeneration:
+    """BLIP-2 model with the image side of ``target`` and ``draft_lm`` as LM.
+
+    The vision encoder, Q-Former and query tokens are copied from the
+    target. The language projection maps the Q-Former output to the draft's
+    hidden size and is freshly initialised, train it with
+    ``train_blip2 --train-projection``.
+    """
+    target = unwrap_model(target)
+    config = Blip2Config(
+        vision_config=target.config.vision_config.to_dict(),
+        qformer_config=target.config.qformer_config.to_dict(),
+        text_config=draft_lm.config.to_dict(),
+        num_query_tokens=target.config.num_query_tokens,
+        image_token_index=target.config.image_token_index,
+    )
+    draft = Blip2ForConditionalGeneration(config).to(draft_lm.dtype).eval()
+    draft.vision_model.load_state_dict(target.vision_model.state_dict())
+    draft.qformer.load_state_dict(target.qformer.state_dict())
+    draft.query_tokens.data.copy_(target.query_tokens.data)
+    draft.language_model.load_state_dict(draft_lm.state_dict())
+    return draft
+
+
+def export_draft_model(
+    base_model_name: str = DEFAULT_BASE_MODEL,
+    draft_lm_name: str = DEFAULT_DRAFT_LM,
+    output_dir: str | Path = DEFAULT_DRAFT_DIR,
+) -> Path:
+    """Build a draft model for ``base_model_name`` and save it with its processor.
+
+    Returns:
+        The output directory
+    """
+    from transformers import Blip2Processor
+
+    output_dir = Path(output_dir)
+    print(f"Building a draft of {base_model_name} with {draft_lm_name}...")
+    target = Blip2ForConditionalGeneration.from_pretrained(base_model_name)
+    draft_lm = OPTForCausalLM.from_pretrained(draft_lm_name)
+    image_token_index = target.config.image_token_index
+    if draft_lm.config.vocab_size <= image_token_index:
+        # The image token only needs a row, its embedding is replaced
+        draft_lm.resize_token_embeddings(image_token_index + 1)
+    draft = build_draft_model(target, draft_lm)
+    draft.save_pretrained(output_dir, safe_serialization=True)
+    # Same tokenizer and image processor as the target
+    Blip2Processor.from_pretrained(base_model_name).save_pretrained(output_dir)
+    print(f"Saved draft model to {output_dir}")
+    return output_dir
+
+
+def load_draft_model(
+    draft_model_name: str,
+    device: str,
+    adapter_path: str | None = None,
+    cpu_precision: str = DEFAULT_PRECISION,
+) -> Any:
+    """Load a draft model, with its fine-tuned adapters merged in.
+
+    On GPU the draft is small enough to stay in fp16, 8-bit matmuls would
+    make it slower. On CPU it uses ``cpu_precision`` like the target.
+    """
+    precision = "fp16" if device == "cuda" else cpu_precision
+    print(f"Loading draft model {draft_model_name} ({precision})...")
+    return load_model(draft_model_name, device, precision, adapter_path)
+
+
+def _probabilities(
+    logits: torch.Tensor, temperature: float, top_p: float
+) -> torch.Tensor:
+    """Sampling distribution after temperature and nucleus filtering."""
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, order = probs.sort(descending=True)
+        # Drop a token once the tokens before it cover top_p, keep the first
+        drop = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        sorted_probs[drop] = 0.0
+        probs = torch.zeros_like(probs).scatter(-1, order, sorted_probs)
+        probs /= probs.sum(dim=-1, keepdim=True)
+    return probs
+
+
+def _truncate(cache: DynamicCache, length: int) -> None:
+    """Drop cached positions after ``length``, e.g. of rejected tokens."""
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+
+class _Decoder:
+    """Language model of one BLIP-2 model with its key/value cache."""
+
+    def __init__(
+        self, model: Any, features: torch.Tensor, prompt_ids: torch.Tensor
+    ) -> None:
+        self.model = unwrap_model(model)
+        self.prompt_length = prompt_ids.shape[1]
+        self.cache = DynamicCache()
+        query_embeds = self.model.language_projection(
+            features.to(self.model.device, pixel_dtype(self.model))
+        )
+        self.inputs_embeds = merge_query_embeds(
+            self.model, prompt_ids.to(self.model.device), query_embeds
+        )
+
+    def prefill(self) -> torch.Tensor:
+        """Run the prompt, returns the logits of the first new token."""
+        return self._forward(inputs_embeds=self.inputs_embeds)[-1]
+
+    def step(self, tokens: list[int]) -> torch.Tensor:
+        """Run the generated tokens not in the cache yet.
+
+        Returns:
+            Logits after each of those tokens, ``(len(pending), vocab_size)``
+        """
+        pending = tokens[self.cache.get_seq_length() - self.prompt_length :]
+        input_ids = torch.tensor([pending], device=self.model.device)
+        return self._forward(input_ids=input_ids)
+
+    def truncate(self, num_tokens: int) -> None:
+        """Keep the prompt and the first ``num_tokens`` generated tokens cached."""
+        _truncate(self.cache, self.prompt_length + num_tokens)
+
+    def _forward(self, **inputs: torch.Tensor) -> torch.Tensor:
+        new_length = next(iter(inputs.values())).shape[1]
+        attention_mask = torch.ones(
+            (1, self.cache.get_seq_length() + new_length),
+            dtype=torch.long,
+            device=self.model.device,
+        )
+        return self.model.language_model(
+            **inputs,
+            attention_mask=attention_mask,
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=True,
+        ).logits[0]
+
+
+def _decode(
+    target: _Decoder,
+    draft: _Decoder,
+    max_new_tokens: int,
+    num_draft_tokens: int,
+    do_sample: bool,
+    temperature: float,
+    top_p: float,
+    eos_token_ids: set[int],
+    stopping_criteria: StoppingCriteriaList | None,
+    stats: AssistedStats,
+) -> list[int]:
+    def pick(logits: torch.Tensor) -> tuple[int, torch.Tensor | None]:
+        if not do_sample:
+            return int(logits.argmax()), None
+        probs = _probabilities(logits, temperature, top_p)
+        return int(torch.multinomial(probs, 1)), probs
+
+    def finished(tokens: list[int]) -> bool:
+        if len(tokens) >= max_new_tokens or eos_token_ids.intersection(tokens):
+            return True
+        return bool(
+            stopping_criteria and stopping_criteria(torch.tensor([tokens]), None).all()
+        )
+
+    draft.prefill()
+    tokens = [pick(target.prefill())[0]]
+    stats.target_calls += 1
+    while not finished(tokens):
+        # Leave room for the token the target adds after the accepted ones
+        k = min(num_draft_tokens, max_new_tokens - len(tokens) - 1)
+        drafted, draft_probs = [], []
+        for _ in range(k):
+            token, probs = pick(draft.step(tokens + drafted)[-1])
+            drafted.append(token)
+            draft_probs.append(probs)
+        target_logits = target.step(tokens + drafted)[-(k + 1) :]
+        stats.target_calls += 1
+        stats.drafted += k
+
+        new_tokens = []
+        for i, token in enumerate(drafted):
+            if not do_sample:
+                best = int(target_logits[i].argmax())
+                new_tokens.append(best)
+                if best != token:
+                    break
+                continue
+            p = _probabilities(target_logits[i], temperature, top_p)
+            # The draft vocabulary may be smaller, it never proposes the rest
+            q = torch.zeros_like(p)
+            q[: draft_probs[i].shape[0]] = draft_probs[i].to(p.device)
+            if torch.rand(()) * q[token] < p[token]:
+                new_tokens.append(token)
+                continue
+            residual = (p - q).clamp(min=0.0)
+            new_tokens.append(int(torch.multinomial(residual / residual.sum(), 1)))
+            break
+        else:
+            new_tokens.append(pick(target_logits[k])[0])
+        stats.accepted += len(new_tokens) - 1
+
+        tokens.extend(new_tokens)
+        target.truncate(len(tokens) - 1)
+        draft.truncate(len(tokens) - 1)
+
+    for i, token in enumerate(tokens):
+        if token in eos_token_ids:
+            tokens = tokens[: i + 1]
+            break
+    return tokens[:max_new_tokens]
+
+
+@torch.no_grad()
+def assisted_generate(
+    model: Any,
+    draft_model: Any,
+    pixel_values: torch.Tensor,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor | None = None,
+    max_new_tokens: int = 100,
+    num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+    do_sample: bool = False,
+    temperature: float = 1.0,
+    top_p: float = 1.0,
+    stopping_criteria: StoppingCriteriaList | None = None,
+    stats: AssistedStats | None = None,
+) -> list[list[int]]:
+    """Generate with ``draft_model`` proposing tokens that ``model`` verifies.
+
+    Args:
+        model: Target BLIP-2 model (or PEFT wrapper)
+        draft_model: Draft model from ``build_draft_model``, with the same
+            vision encoder and Q-Former
+        pixel_values: Processed images, one per prompt
+        input_ids: Prompt token IDs, including the image tokens
+        attention_mask: Attention mask for ``input_ids``, padding is removed
+        max_new_tokens: Maximum number of tokens to generate per prompt
+        num_draft_tokens: Tokens the draft proposes per target forward pass
+        do_sample: Sample instead of greedy decoding
+        temperature: Sampling temperature
+        top_p: Nucleus sampling probability mass
+        stopping_criteria: Checked with the generated tokens of one prompt,
+            e.g. ``StopRules.criteria(tokenizer)``
+        stats: Counts drafted and accepted tokens
+
+    Returns:
+        Generated token IDs of each prompt, without the prompt
+    """
+    target = unwrap_model(model)
+    stats = stats if stats is not None else AssistedStats()
+    eos_token_ids = target.generation_config.eos_token_id
+    if isinstance(eos_token_ids, int):
+        eos_token_ids = [eos_token_ids]
+    features = qformer_features(
+        target,
+        vision_features(target, pixel_values.to(target.device, pixel_dtype(target))),
+    )
+
+    outputs = []
+    for i in range(input_ids.shape[0]):
+        prompt_ids = input_ids[i]
+        if attention_mask is not None:
+            prompt_ids = prompt_ids[attention_mask[i].bool()]
+        prompt_ids = prompt_ids.unsqueeze(0)
+        tokens = _decode(
+            _Decoder(target, features[i : i + 1], prompt_ids),
+            _Decoder(draft_model, features[i : i + 1], prompt_ids),
+            max_new_tokens,
+            num_draft_tokens,
+            do_sample,
+            temperature,
+            top_p,
+            set(eos_token_ids or ()),
+            stopping_criteria,
+            stats,
+        )
+        stats.lines += 1
+        stats.new_tokens += len(tokens)
+        outputs.append(tokens)
+    return outputs
+
+
+def random_models(
+    draft_layers: int = 1,
+) -> tuple[Blip2ForConditionalGeneration, Blip2ForConditionalGeneration]:
+    """Small random-weight target and draft for benchmarks without checkpoints.
+
+    The draft is the target with only its first ``draft_layers`` decoder
+    layers, like a draft distilled from it, so the two agree on part of the
+    tokens.
+    """
+    config = Blip2Config(
+        vision_config={
+            "hidden_size": 64,
+            "intermediate_size": 128,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 4,
+            "image_size": 64,
+            "patch_size": 16,
+        },
+        qformer_config={
+            "hidden_size": 64,
+            "intermediate_size": 128,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 4,
+            "encoder_hidden_size": 64,
+        },
+        # A small vocabulary, so that like in OPT-2.7B most of the compute is
+        # in the decoder layers the draft leaves out, not in the LM head
+        text_config={
+            "model_type": "opt",
+            "hidden_size": 512,
+            "word_embed_proj_dim": 512,
+            "ffn_dim": 2048,
+            "num_hidden_layers": 12,
+            "num_attention_heads": 8,
+            "vocab_size": RANDOM_VOCAB_SIZE,
+        },
+        num_query_tokens=8,
+        image_token_index=RANDOM_VOCAB_SIZE - 1,
+    )
+    target = Blip2ForConditionalGeneration(config).eval()
+    draft_lm = OPTForCausalLM(
+        type(config.text_config)(
+            **{**config.text_config.to_dict(), "num_hidden_layers": draft_layers}
+        )
+    )
+    # The layers the draft does not have are left out
+    draft_lm.load_state_dict(target.language_model.state_dict(), strict=False)
+    draft = build_draft_model(target, draft_lm)
+    draft.language_projection.load_state_dict(target.language_projection.state_dict())
+    return target, draft
+
+
+def main() -> None:
+    import argparse
+    import statistics
+    import time
+
+    from blip2.modeling import (
+        generate_from_query_embeds,
+        query_embeds_from_image_embeds,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Build a draft model, or benchmark assisted decoding."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build")
+    build.add_argument("--base-model", default=DEFAULT_BASE_MODEL)
+    build.add_argument("--draft-lm", default=DEFAULT_DRAFT_LM)
+    build.add_argument("--output-dir", default=DEFAULT_DRAFT_DIR)
+    benchmark = subparsers.add_parser("benchmark")
+    benchmark.add_argument("--base-model", default=DEFAULT_BASE_MODEL)
+    benchmark.add_argument("--adapter-path", default=None)
+    benchmark.add_argument("--draft-model", default=DEFAULT_DRAFT_DIR)
+    benchmark.add_argument("--draft-adapter-path", default=None)
+    benchmark.add_argument(
+        "--image-path", default="data_collection/profiles/images/1/image_1.jpg"
+    )
+    benchmark.add_argument(
+        "--random",
+        action="store_true",
+        help="Small random-weight models instead of the checkpoints",
+    )
+    benchmark.add_argument(
+        "--draft-layers",
+        type=int,
+        default=1,
+        help="Decoder layers of the random draft, its acceptance rate only "
+        "shows the mechanics, not what a trained draft reaches",
+    )
+    benchmark.add_argument("--num-draft-tokens", type=int, nargs="+", default=[2, 4, 6])
+    benchmark.add_argument("--max-new-tokens", type=int, default=48)
+    benchmark.add_argument("--repeats", type=int, default=3)
+    benchmark.add_argument("--sample", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        export_draft_model(args.base_model, args.draft_lm, args.output_dir)
+        return
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.random:
+        torch.manual_seed(0)
+        model, draft_model = random_models(args.draft_layers)
+        model, draft_model = model.to(device), draft_model.to(device)
+        config = model.config
+        image_size = config.vision_config.image_size
+        pixel_values = torch.randn(1, 3, image_size, image_size)
+        prompt = torch.randint(4, config.image_token_index, (24,)).tolist()
+        input_ids = torch.tensor(
+            [[config.image_token_index] * config.num_query_tokens + prompt]
+        )
+    else:
+        from PIL import Image
+        from transformers import Blip2Processor
+
+        from blip2.cpu_backend import configure_threads
+        from blip2.test_finetuned import opening_line_prompt
+
+        if device == "cpu":
+            print(f"Using {configure_threads()} threads")
+        processor = Blip2Processor.from_pretrained(args.base_model)
+        model = load_model(
+            args.base_model,
+            device,
+            "int8" if device == "cuda" else DEFAULT_PRECISION,
+            args.adapter_path,
+        )
+        draft_model = load_draft_model(
+            args.draft_model, device, args.draft_adapter_path
+        )
+        image = Image.open(args.image_path).convert("RGB")
+        inputs = processor(
+            images=image,
+            text=opening_line_prompt("Her name is Maren. She loves hiking."),
+            return_tensors="pt",
+        )
+        pixel_values, input_ids = inputs["pixel_values"], inputs["input_ids"]
+    sampling = {"do_sample": True, "top_p": 0.9} if args.sample else {}
+
+    def timed(generate: Any) -> tuple[float, int]:
+        latencies, lengths = [], []
+        for seed in range(args.repeats):
+            torch.manual_seed(seed)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            lengths.append(generate())
+            if device == "cuda":
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+        return statistics.mean(latencies), statistics.mean(lengths)
+
+    @torch.no_grad()
+    def plain() -> int:
+        blip2 = unwrap_model(model)
+        query_embeds = query_embeds_from_image_embeds(
+            blip2,
+            vision_features(blip2, pixel_values.to(device, pixel_dtype(blip2))),
+        )
+        outputs = generate_from_query_embeds(
+            blip2,
+            query_embeds,
+            input_ids,
+            max_new_tokens=args.max_new_tokens,
+            num_beams=1,
+            **sampling,
+        )
+        return outputs.shape[1]
+
+    timed(plain)  # warm up
+    latency, length = timed(plain)
+    print(
+        f"{'plain':>10}: {latency:.2f}s per line, {length:.0f} tokens, "
+        f"{latency / length * 1000:.1f} ms/token"
+    )
+    for num_draft_tokens in args.num_draft_tokens:
+        stats = AssistedStats()
+
+        def assisted(
+            num_draft_tokens: int = num_draft_tokens, stats: AssistedStats = stats
+        ) -> int:
+            (tokens,) = assisted_generate(
+                model,
+                draft_model,
+                pixel_values,
+                input_ids,
+                max_new_tokens=args.max_new_tokens,
+                num_draft_tokens=num_draft_tokens,
+                stats=stats,
+                **sampling,
+            )
+            return len(tokens)
+
+        assisted_latency, length = timed(assisted)
+        print(
+            f"{f'k={num_draft_tokens}':>10}: {assisted_latency:.2f}s per line, "
+            f"{length:.0f} tokens, "
+            f"{assisted_latency / length * 1000:.1f} ms/token, "
+            f"{stats.acceptance_rate:.0%} of drafted tokens accepted, "
+            f"{stats.tokens_per_target_call:.2f} tokens per target pass, "
+            f"{latency / assisted_latency:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
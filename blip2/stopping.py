@@ -0,0 +1,247 @@
+"""Stop generating once an opening line is complete.
+
+An opening line is one or two sentences, but generation runs until EOS or
+``max_new_tokens`` (100 in ``generate_opening_lines``), and the model rarely
+emits EOS: it starts a second line, a new "Question:", or rambles on, and
+most of the decode budget goes to tokens that are thrown away.
+
+``StopRules`` describes where a line ends: at a newline, after a number of
+sentences, when a quote closes, or after a token budget. ``criteria`` turns
+the rules into a ``StoppingCriteria`` that ``generate`` checks after every
+token, per sequence: a sequence (or beam) that is done is finished like on
+EOS, and ``generate`` returns as soon as every sequence in the batch is done.
+Finished rows are only padded while the rest of the batch decodes. ``trim``
+cuts the decoded text at the same place, since a sentence end is only
+recognised on the token after it.
+
+Compare generated tokens and latency with and without the rules:
+    uv run python -m blip2.stopping --batch-size 4
+"""
+
+import re
+from collections.abc import Sequence
+from typing import Any
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+# Sentence punctuation, with closing quotes/brackets, followed by whitespace
+SENTENCE_END = re.compile(r"[.!?]+[\"”')\]]*(?=\s)")
+QUOTES = re.compile(r"[\"“”]")
+OPEN_QUOTES = ('"', "“")
+
+
+def opens_quote(prompt: str) -> bool:
+    """Whether the prompt ends inside a quote the answer has to close."""
+    return prompt.rstrip().endswith(OPEN_QUOTES)
+
+
+class StopRules:
+    """Where a generated opening line ends.
+
+    Args:
+        newline: End at the first line break after some text
+        max_sentences: End after this many sentences, ``None`` for no limit
+        close_quote: End when a quote closes, the one left open by the prompt
+            or the first one the answer opens
+        max_tokens: Per-sequence budget of generated tokens, ``None`` for none
+            (``max_new_tokens`` still applies to the whole batch)
+    """
+
+    def __init__(
+        self,
+        newline: bool = True,
+        max_sentences: int | None = 2,
+        close_quote: bool = True,
+        max_tokens: int | None = None,
+    ) -> None:
+        self.newline = newline
+        self.max_sentences = max_sentences
+        self.close_quote = close_quote
+        self.max_tokens = max_tokens
+
+    def end(self, text: str, quote_open: bool = False) -> int | None:
+        """Index where the line in ``text`` ends, ``None`` if it goes on.
+
+        Args:
+            text: Generated text so far, without the prompt
+            quote_open: The prompt ended inside a quote
+        """
+        ends = []
+        if self.newline:
+            start = len(text) - len(text.lstrip())
+            newline = text.find("\n", start)
+            if newline >= 0:
+                ends.append(newline)
+        if self.max_sentences:
+            for i, match in enumerate(SENTENCE_END.finditer(text), 1):
+                if i == self.max_sentences:
+                    ends.append(match.end())
+                    break
+        if self.close_quote:
+            inside = quote_open
+            for match in QUOTES.finditer(text):
+                if match.group() == "“" or (match.group() == '"' and not inside):
+                    inside = True
+                elif inside:
+                    # A quote opened by the prompt is not part of the answer,
+                    # so neither is its closing quote
+                    ends.append(match.start() if quote_open else match.end())
+                    break
+        return min(ends, default=None)
+
+    def trim(self, text: str, quote_open: bool = False) -> str:
+        """Cut ``text`` where the line ends."""
+        end = self.end(text, quote_open)
+        return (text if end is None else text[:end]).strip()
+
+    def criteria(
+        self,
+        tokenizer: Any,
+        prompt_length: int = 0,
+        quote_open: bool | Sequence[bool] = False,
+    ) -> StoppingCriteriaList:
+        """Stopping criteria for one ``generate`` call.
+
+        Args:
+            tokenizer: Tokenizer to decode the generated tokens with
+            prompt_length: Tokens in front of the generated ones in the
+                ``input_ids`` that ``generate`` checks: the prompt length when
+                ``input_ids`` are passed, 0 when generating from
+                ``inputs_embeds`` only
+            quote_open: Whether each prompt ended inside a quote, see
+                ``opens_quote``
+        """
+        return StoppingCriteriaList(
+            [_LineEndCriteria(self, tokenizer, prompt_length, quote_open)]
+        )
+
+
+class _LineEndCriteria(StoppingCriteria):
+    def __init__(
+        self,
+        rules: StopRules,
+        tokenizer: Any,
+        prompt_length: int,
+        quote_open: bool | Sequence[bool],
+    ) -> None:
+        self.rules = rules
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.quote_open = quote_open
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any
+    ) -> torch.BoolTensor:
+        generated = input_ids[:, self.prompt_length :]
+        texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        if isinstance(self.quote_open, bool):
+            quote_open = [self.quote_open] * len(texts)
+        else:
+            # Beams and repeated candidates come as consecutive rows per prompt
+            rows_per_prompt = len(texts) // len(self.quote_open)
+            quote_open = [
+                flag for flag in self.quote_open for _ in range(rows_per_prompt)
+            ]
+        done = [
+            self.rules.end(text, flag) is not None
+            for text, flag in zip(texts, quote_open, strict=True)
+        ]
+        if (
+            self.rules.max_tokens is not None
+            and generated.shape[1] >= self.rules.max_tokens
+        ):
+            done = [True] * len(done)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+DEFAULT_STOP_RULES = StopRules()
+
+
+def main() -> None:
+    import argparse
+    import statistics
+    import time
+
+    from PIL import Image
+
+    from blip2.modeling import pixel_dtype
+    from blip2.test_finetuned import load_finetuned_model, opening_line_prompt
+
+    parser = argparse.ArgumentParser(
+        description="Measure generated tokens and latency with stopping rules."
+    )
+    parser.add_argument("--base-model", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--adapter-path", default="./blip2_rizz_finetuned")
+    parser.add_argument(
+        "--image-path", default="data_collection/profiles/images/1/image_1.jpg"
+    )
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    parser.add_argument("--max-sentences", type=int, default=2)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, processor = load_finetuned_model(args.base_model, args.adapter_path, device)
+    profile_texts = [
+        "Her name is Maren. She seems to love outdoor activities.",
+        "Her name is Ida. She has a dog and loves hiking.",
+        "Her name is Sofie. She drinks socially on weekends.",
+        "Her name is Nora. She sometimes works out.",
+    ]
+    prompts = [
+        opening_line_prompt(profile_texts[i % len(profile_texts)])
+        for i in range(args.batch_size)
+    ]
+    image = Image.open(args.image_path).convert("RGB")
+    inputs = processor(
+        images=[image] * len(prompts),
+        text=prompts,
+        padding=True,
+        padding_side="left",
+        return_tensors="pt",
+    ).to(device, dtype=pixel_dtype(model))
+    prompt_length = inputs["input_ids"].shape[1]
+    pad_token_id = processor.tokenizer.pad_token_id
+    rules = StopRules(max_sentences=args.max_sentences)
+
+    for name, stopping_criteria in (
+        ("no stopping rules", None),
+        ("stopping rules", rules.criteria(processor.tokenizer, prompt_length)),
+    ):
+        tokens, steps, latencies = [], [], []
+        for seed in range(args.repeats):
+            torch.manual_seed(seed)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=args.max_new_tokens,
+                    do_sample=True,
+                    temperature=1.0,
+                    top_p=0.9,
+                    num_beams=4,
+                    repetition_penalty=1.2,
+                    stopping_criteria=stopping_criteria,
+                )
+            if device == "cuda":
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+            generated = outputs[:, prompt_length:]
+            tokens.extend((generated != pad_token_id).sum(dim=1).tolist())
+            steps.append(generated.shape[1])
+        print(
+            f"{name}: {statistics.mean(tokens):.1f} tokens per line, "
+            f"{statistics.mean(steps):.1f} decode steps per batch, "
+            f"{statistics.mean(latencies):.2f}s per batch of {len(prompts)}"
+        )
+        answers = processor.batch_decode(generated, skip_special_tokens=True)
+        print(f"  e.g. {rules.trim(answers[0])!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,36 +11,43 @@ from transformers import (
 )
 
 
-qformer_config = Blip2QFormerConfig()
-vision_config = Blip2VisionConfig()  # Image encoder Keep this
-text_config = OPTConfig()  # Language model - Keep this
+def main() -> None:
+    # Randomly initialised BLIP-2 built from the default configs, nothing is
+    # constructed until the script is run
+    qformer_config = Blip2QFormerConfig()
+    vision_config = Blip2VisionConfig()  # Image encoder Keep this
+    text_config = OPTConfig()  # Language model - Keep this
 
-configuration = Blip2Config.from_text_vision_configs(
-    vision_config, qformer_config, text_config
-)  # Blip2Config()
+    configuration = Blip2Config.from_text_vision_configs(
+        vision_config, qformer_config, text_config
+    )  # Blip2Config()
 
-model = Blip2ForConditionalGeneration(configuration)
+    model = Blip2ForConditionalGeneration(configuration)
 
-processor = Blip2Processor.from_pretrained("Salesforce/blip2-flan-t5-xl")
+    processor = Blip2Processor.from_pretrained("Salesforce/blip2-flan-t5-xl")
 
-url = "https://static.wikia.nocookie.net/dreamworks/images/3/34/Fiona_Profile.jpg/revision/latest?cb=20231223034631"
-image = Image.open(requests.get(url, stream=True).raw)
+    url = "https://static.wikia.nocookie.net/dreamworks/images/3/34/Fiona_Profile.jpg/revision/latest?cb=20231223034631"
+    image = Image.open(requests.get(url, stream=True).raw)
 
-prompt = "Here is her profile description: - Princess, - Loves Shrekians, - Has a human form, - 25 y.o, - Rich, - Loves a true man, - Long Term. Give me an opening line for this person"
-inputs = processor(images=image, text=prompt, return_tensors="pt").to(
-    "gpu", torch.float16
-)
+    prompt = "Here is her profile description: - Princess, - Loves Shrekians, - Has a human form, - 25 y.o, - Rich, - Loves a true man, - Long Term. Give me an opening line for this person"
+    inputs = processor(images=image, text=prompt, return_tensors="pt").to(
+        "gpu", torch.float16
+    )
+
+    # outputs = model(**inputs)
+
+    generated_ids_qa = model.generate(**inputs)
 
-# outputs = model(**inputs)
+    full_response = processor.decode(generated_ids_qa[0], skip_special_tokens=True)
+    print(f"Full response: '{full_response}'")
 
-generated_ids_qa = model.generate(**inputs)
+    # Extract just the answer part
+    if "Answer:" in full_response:
+        answer = full_response.split("Answer:")[-1].strip()
+        print(f"Extracted answer: '{answer}'")
+    else:
+        print("No 'Answer:' found in response")
 
-full_response = processor.batch_decode(generated_ids_qa, skip_special_tokens=True)[0]
-print(f"Full response: '{full_response}'")
 
-# Extract just the answer part
-if "Answer:" in full_response:
-    answer = full_response.split("Answer:")[-1].strip()
-    print(f"Extracted answer: '{answer}'")
-else:
-    print("No 'Answer:' found in response")
+if __name__ == "__main__":
+    main()
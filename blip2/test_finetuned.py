@@ -3,42 +3,74 @@
 This script loads the fine-tuned model and generates opening lines for profiles.
 """
 
+import copy
+from collections.abc import Sequence
+
 import torch
 from peft import PeftModel
 from PIL import Image
-from transformers import (
-    BitsAndBytesConfig,
-    Blip2ForConditionalGeneration,
-    Blip2Processor,
+from transformers import Blip2Processor
+
+from blip2.cpu_backend import DEFAULT_PRECISION, configure_threads
+from blip2.model_artifacts import load_model
+from blip2.modeling import (
+    merge_query_embeds,
+    pixel_dtype,
+    query_embeds_from_image_embeds,
+    unwrap_model,
+    vision_features,
+)
+from blip2.speculative import (
+    DEFAULT_NUM_DRAFT_TOKENS,
+    assisted_generate,
+    load_draft_model,
 )
+from blip2.stopping import DEFAULT_STOP_RULES, StopRules
 
 
-def load_finetuned_model(base_model_name: str, adapter_path: str, device: str):
+def load_finetuned_model(
+    base_model_name: str,
+    adapter_path: str,
+    device: str,
+    use_merged: bool = True,
+    cpu_precision: str = DEFAULT_PRECISION,
+):
     """Load the base model with fine-tuned LoRA adapters.
 
+    The adapters are merged into the weights (using the export of
+    ``python -m blip2.merge_lora export`` if there is one), so no adapter
+    matmuls run at inference. The merged, quantised model is cached as an
+    artifact by ``model_artifacts.load_model`` and loaded directly on later
+    starts. On GPU it is 8-bit bitsandbytes, on CPU ``cpu_precision``.
+
     Args:
         base_model_name: Name of the base BLIP-2 model
-        adapter_path: Path to the fine-tuned LoRA adapters
+        adapter_path: Path to the fine-tuned LoRA adapters, or to a merged export
         device: Device to load the model on ('cuda' or 'cpu')
+        use_merged: Merge the adapters, on GPU they are otherwise applied as
+            a separate ``PeftModel`` on top of the 8-bit base model
+        cpu_precision: ``int8``, ``bf16`` or ``fp32``, only used on CPU
 
     Returns:
         Tuple of (model, processor)
     """
     print("Loading processor...")
-    processor = Blip2Processor.from_pretrained(base_model_name)
+    # Same PIL resize as the image cache the model may have been trained on
+    processor = Blip2Processor.from_pretrained(base_model_name, use_fast=False)
 
-    # Configure quantization
-    bnb_config = BitsAndBytesConfig(
-        load_in_8bit=True,
-        llm_int8_threshold=6.0,
-    )
+    if device == "cpu":
+        threads = configure_threads()
+        print(f"Loading {cpu_precision} model for CPU on {threads} threads...")
+        model = load_model(base_model_name, device, cpu_precision, adapter_path)
+        return model, processor
+
+    if use_merged:
+        print("Loading merged model...")
+        model = load_model(base_model_name, device, "int8", adapter_path)
+        return model, processor
 
     print("Loading base model...")
-    model = Blip2ForConditionalGeneration.from_pretrained(
-        base_model_name,
-        quantization_config=bnb_config,
-        device_map={"": 0} if device == "cuda" else None,
-    )
+    model = load_model(base_model_name, device, "int8")
 
     print("Loading LoRA adapters...")
     model = PeftModel.from_pretrained(model, adapter_path)
@@ -47,74 +79,274 @@ def load_finetuned_model(base_model_name: str, adapter_path: str, device: str):
     return model, processor
 
 
+def opening_line_prompt(profile_text: str) -> str:
+    """The prompt the adapters were trained on, see ``prepare_dataset``."""
+    return f"{profile_text}\n\nQuestion: What is the best flirting opening line to start a conversation with her on Tinder? Answer:"
+
+
+def generate_opening_lines(
+    model,
+    processor,
+    images: list[str | Image.Image],
+    profile_texts: list[str],
+    device: str,
+    max_new_tokens: int = 100,
+    temperature: float = 1.0,
+    stop_rules: StopRules | None = DEFAULT_STOP_RULES,
+    draft_model=None,
+    num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+) -> list[str]:
+    """Generate opening lines for several profiles in one ``generate`` call.
+
+    Args:
+        model: Fine-tuned BLIP-2 model
+        processor: BLIP-2 processor
+        images: Path to or loaded image of each profile
+        profile_texts: Text description of each profile
+        device: Device to run inference on
+        max_new_tokens: Maximum number of tokens to generate
+        temperature: Sampling temperature (higher = more creative)
+        stop_rules: Where a line ends, each profile stops generating there
+        draft_model: Draft model from ``blip2.speculative`` for assisted
+            decoding. Profiles are then decoded one at a time and sampled
+            without beam search and repetition penalty.
+        num_draft_tokens: Tokens the draft proposes per step of ``model``
+
+    Returns:
+        Generated opening line per profile
+    """
+    # Load images
+    images = [
+        image.convert("RGB")
+        if isinstance(image, Image.Image)
+        else Image.open(image).convert("RGB")
+        for image in images
+    ]
+
+    # Create prompts
+    prompts = [opening_line_prompt(profile_text) for profile_text in profile_texts]
+
+    # Process inputs. Pad on the left so every prompt ends where generation starts
+    dtype = pixel_dtype(model)
+    inputs = processor(
+        images=images,
+        text=prompts,
+        padding=True,
+        padding_side="left",
+        return_tensors="pt",
+    ).to(device, dtype=dtype)
+    prompt_length = inputs["input_ids"].shape[1]
+
+    if draft_model is not None:
+        outputs = assisted_generate(
+            model,
+            draft_model,
+            inputs["pixel_values"],
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            max_new_tokens=max_new_tokens,
+            num_draft_tokens=num_draft_tokens,
+            do_sample=True,
+            temperature=temperature,
+            top_p=0.9,
+            stopping_criteria=(
+                stop_rules.criteria(processor.tokenizer) if stop_rules else None
+            ),
+        )
+        answers = processor.batch_decode(outputs, skip_special_tokens=True)
+    else:
+        # Generate
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                temperature=temperature,
+                top_p=0.9,
+                num_beams=4,
+                repetition_penalty=1.2,
+                stopping_criteria=(
+                    stop_rules.criteria(processor.tokenizer, prompt_length)
+                    if stop_rules
+                    else None
+                ),
+            )
+
+        # Decode only the answers, the output starts with the prompts
+        answers = processor.batch_decode(
+            outputs[:, prompt_length:], skip_special_tokens=True
+        )
+    if stop_rules:
+        return [stop_rules.trim(answer) for answer in answers]
+    return [answer.strip() for answer in answers]
+
+
 def generate_opening_line(
     model,
     processor,
-    image_path: str,
+    image_path: str | Image.Image,
     profile_text: str,
     device: str,
     max_new_tokens: int = 100,
     temperature: float = 1.0,
+    stop_rules: StopRules | None = DEFAULT_STOP_RULES,
+    draft_model=None,
 ) -> str:
     """Generate an opening line for a profile.
 
     Args:
         model: Fine-tuned BLIP-2 model
         processor: BLIP-2 processor
-        image_path: Path to profile image
+        image_path: Path to profile image, or the already loaded image
         profile_text: Text description of the profile
         device: Device to run inference on
         max_new_tokens: Maximum number of tokens to generate
         temperature: Sampling temperature (higher = more creative)
+        stop_rules: Where the line ends, generation stops there
+        draft_model: Draft model for assisted decoding, see
+            ``generate_opening_lines``
 
     Returns:
         Generated opening line
     """
+    return generate_opening_lines(
+        model,
+        processor,
+        [image_path],
+        [profile_text],
+        device,
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        stop_rules=stop_rules,
+        draft_model=draft_model,
+    )[0]
+
+
+def generate_opening_line_candidates(
+    model,
+    processor,
+    image_path: str | Image.Image,
+    profile_text: str,
+    device: str,
+    num_candidates: int = 4,
+    temperature: float | Sequence[float] = 1.0,
+    max_new_tokens: int = 100,
+    stop_rules: StopRules | None = DEFAULT_STOP_RULES,
+) -> list[str]:
+    """Generate several opening lines for one profile, encoding it only once.
+
+    The image goes through the vision encoder and Q-Former once and the prompt
+    is prefilled once. Every candidate decodes from a copy of that KV cache.
+    Candidates are sampled without beam search, the beams of a single search
+    tend to end up as near-identical lines.
+
+    Args:
+        model: Fine-tuned BLIP-2 model
+        processor: BLIP-2 processor
+        image_path: Path to profile image, or the already loaded image
+        profile_text: Text description of the profile
+        device: Device to run inference on
+        num_candidates: Number of opening lines to generate
+        temperature: Sampling temperature, or one per candidate (then
+            ``num_candidates`` is ignored)
+        max_new_tokens: Maximum number of tokens to generate
+        stop_rules: Where a line ends, each candidate stops generating there
+
+    Returns:
+        Generated opening lines, in the order of the temperatures
+    """
+    if isinstance(temperature, int | float):
+        temperatures = [float(temperature)] * num_candidates
+    else:
+        temperatures = list(temperature)
+
     # Load image
-    image = Image.open(image_path).convert("RGB")
+    if isinstance(image_path, Image.Image):
+        image = image_path.convert("RGB")
+    else:
+        image = Image.open(image_path).convert("RGB")
 
     # Create prompt
-    prompt = f"{profile_text}\n\nQuestion: What is the best flirting opening line to start a conversation with her on Tinder? Answer:"
+    prompt = opening_line_prompt(profile_text)
 
     # Process inputs
-    dtype = torch.float16 if device == "cuda" else torch.float32
+    dtype = pixel_dtype(model)
     inputs = processor(images=image, text=prompt, return_tensors="pt").to(
         device, dtype=dtype
     )
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
 
-    # Generate
+    blip2 = unwrap_model(model)
+    answers = [""] * len(temperatures)
     with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=True,
-            temperature=temperature,
-            top_p=0.9,
-            num_beams=4,
-            repetition_penalty=1.2,
+        # Encode the image once
+        query_embeds = query_embeds_from_image_embeds(
+            blip2, vision_features(blip2, inputs["pixel_values"])
         )
+        inputs_embeds = merge_query_embeds(blip2, input_ids, query_embeds)
+
+        # Prefill all but the last prompt token, generate feeds that one
+        # itself and continues from the cache
+        prefix_cache = blip2.language_model(
+            inputs_embeds=inputs_embeds[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            use_cache=True,
+        ).past_key_values
 
-    # Decode
-    generated_text = processor.batch_decode(outputs, skip_special_tokens=True)[
-        0
-    ].strip()
+        # One decode per distinct temperature, with a row per candidate
+        groups: dict[float, list[int]] = {}
+        for i, t in enumerate(temperatures):
+            groups.setdefault(t, []).append(i)
+        for t, indices in groups.items():
+            cache = copy.deepcopy(prefix_cache)
+            cache.batch_repeat_interleave(len(indices))
+            outputs = blip2.language_model.generate(
+                input_ids=input_ids.expand(len(indices), -1),
+                attention_mask=attention_mask.expand(len(indices), -1),
+                past_key_values=cache,
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                temperature=t,
+                top_p=0.9,
+                repetition_penalty=1.2,
+                stopping_criteria=(
+                    stop_rules.criteria(processor.tokenizer, input_ids.shape[1])
+                    if stop_rules
+                    else None
+                ),
+            )
+            decoded = processor.batch_decode(
+                outputs[:, input_ids.shape[1] :], skip_special_tokens=True
+            )
+            for i, answer in zip(indices, decoded, strict=True):
+                answers[i] = stop_rules.trim(answer) if stop_rules else answer.strip()
 
-    return generated_text
+    return answers
 
 
 def main():
     """Main inference function."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Test the fine-tuned model.")
+    parser.add_argument(
+        "--server",
+        default=None,
+        help="URL of a running blip2.inference_server, instead of loading the model",
+    )
+    parser.add_argument(
+        "--draft-model",
+        default=None,
+        help="Draft model for assisted decoding, see blip2.speculative",
+    )
+    parser.add_argument("--draft-adapter-path", default=None)
+    args = parser.parse_args()
+
     # Configuration
     base_model_name = "Salesforce/blip2-opt-2.7b"
     adapter_path = "./blip2_rizz_finetuned"
 
-    # Device setup
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
-
-    # Load model
-    model, processor = load_finetuned_model(base_model_name, adapter_path, device)
-
     # Example profile
     profile_text = (
         "Her name is Maren. "
@@ -124,37 +356,72 @@ def main():
     )
     image_path = "data_collection/profiles/images/1/image_1.jpg"
 
+    if args.server:
+        from blip2.inference_server import InferenceClient
+
+        print(f"Using inference server at {args.server}")
+        client = InferenceClient(args.server).wait_until_ready()
+
+        def generate_candidates(temperatures: list[float]) -> list[str]:
+            return [
+                client.generate_opening_line(
+                    profile_text, image_path=image_path, temperature=t
+                )
+                for t in temperatures
+            ]
+    else:
+        # Device setup
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"Using device: {device}")
+
+        # Load model
+        model, processor = load_finetuned_model(base_model_name, adapter_path, device)
+
+        if args.draft_model:
+            draft_model = load_draft_model(
+                args.draft_model, device, args.draft_adapter_path
+            )
+
+            def generate_candidates(temperatures: list[float]) -> list[str]:
+                return [
+                    generate_opening_line(
+                        model,
+                        processor,
+                        image_path,
+                        profile_text,
+                        device,
+                        temperature=temperature,
+                        draft_model=draft_model,
+                    )
+                    for temperature in temperatures
+                ]
+        else:
+
+            def generate_candidates(temperatures: list[float]) -> list[str]:
+                # The image is encoded and the prompt prefilled once for all of them
+                return generate_opening_line_candidates(
+                    model,
+                    processor,
+                    image_path,
+                    profile_text,
+                    device,
+                    temperature=temperatures,
+                )
+
     print("\n" + "=" * 60)
     print("Testing fine-tuned model")
     print("=" * 60)
     print(f"\nProfile: {profile_text}")
     print(f"Image: {image_path}")
-    print("\nGenerating opening line...")
-
-    # Generate opening line
-    opening_line = generate_opening_line(
-        model=model,
-        processor=processor,
-        image_path=image_path,
-        profile_text=profile_text,
-        device=device,
-        temperature=1.0,
-    )
+    print("\nGenerating opening line and alternatives...")
+
+    # One opening line and three variations at a higher temperature for more variety
+    opening_line, *alternatives = generate_candidates([1.0, 1.2, 1.2, 1.2])
 
     print(f"\nGenerated opening line:\n{opening_line}")
     print("\n" + "=" * 60)
 
-    # Generate a few more variations
-    print("\nGenerating alternative opening lines...")
-    for i in range(3):
-        alt_line = generate_opening_line(
-            model=model,
-            processor=processor,
-            image_path=image_path,
-            profile_text=profile_text,
-            device=device,
-            temperature=1.2,  # Higher temperature for more variety
-        )
+    for i, alt_line in enumerate(alternatives):
         print(f"\nAlternative {i + 1}:\n{alt_line}")
 
 
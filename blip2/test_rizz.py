@@ -1,45 +1,23 @@
-import torch
 from PIL import Image
-from transformers import (
-    BitsAndBytesConfig,
-    Blip2ForConditionalGeneration,
-    Blip2Processor,
-)
 
+from blip2.rizzler import Rizzler
+from blip2.stopping import StopRules
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Using device: {device}")
-dtype = torch.float16 if device == "cuda" else torch.float32
 
-print("Loading model...")
-processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
-model = Blip2ForConditionalGeneration.from_pretrained(
-    "Salesforce/blip2-opt-2.7b",
-    dtype=dtype,
-    device_map={"": 0} if device == "cuda" else None,
-    quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0),
-)
+IMAGE_PATH = "data_collection/profiles/images/1/image_1.jpg"
 
-image_path = "data_collection/profiles/images/1/image_1.jpg"
-image = Image.open(image_path).convert("RGB")
 
+def ask_questions(
+    rizzler: Rizzler, image: Image.Image, questions: list[str]
+) -> list[str]:
+    """Answer every question about the image in one batched ``generate`` call.
 
-print("Testing image captioning...")
-# First test: Image captioning
-inputs_caption = processor(images=image, return_tensors="pt").to(device, dtype=dtype)
-generated_ids_caption = model.generate(**inputs_caption, max_new_tokens=20)
-caption = processor.batch_decode(generated_ids_caption, skip_special_tokens=True)[0].strip()
-print(f"Caption: '{caption}'")
-
-print("\nTesting question answering...\n")
-
-
-def ask_question(question: str) -> str:
-    inputs = processor(images=image, text=question, return_tensors="pt").to(
-        device=device, dtype=dtype
-    )
-    out_ids = model.generate(
-        **inputs,
+    The image only goes through the vision encoder and Q-Former once.
+    """
+    return rizzler.generate(
+        [image] * len(questions),
+        questions,
+        stop_rules=StopRules(max_sentences=3),
         do_sample=True,
         num_beams=4,
         max_length=256,
@@ -52,10 +30,6 @@ def ask_question(question: str) -> str:
         length_penalty=0.9,  # TODO: Play with shorter or longer answers
     )
 
-    answer = processor.batch_decode(out_ids, skip_special_tokens=True)[0].strip()
-
-    return answer
-
 
 description = """\
 Gender: Female;\
@@ -85,24 +59,51 @@ questions = [
 ]
 
 
-for i, question in enumerate(questions):
-    print(f"Question {i + 1}\n")
+def main() -> None:
+    # 8-bit bitsandbytes on GPU, dynamic int8 on CPU, loaded on first use
+    rizzler = Rizzler.get("Salesforce/blip2-opt-2.7b")
+    print(f"Using device: {rizzler.device}")
+
+    image = Image.open(IMAGE_PATH).convert("RGB")
+
+    print("Testing image captioning...")
+    # First test: Image captioning
+    caption = rizzler.caption([image], max_new_tokens=20)[0]
+    print(f"Caption: '{caption}'")
+
+    print("\nTesting question answering...\n")
+
+    # Each question without and with a natural description, all in one batch
+    answers = ask_questions(
+        rizzler,
+        image,
+        [
+            prompt
+            for question in questions
+            for prompt in (question, f"{natural_description} {question}")
+        ],
+    )
+
+    for i in range(len(questions)):
+        print(f"Question {i + 1}\n")
+
+        print("Without description:")
+        print(answers[2 * i])
+        print("-" * 10)
+
+        # print("With description:")
+        # answer = ask_question(
+        #     f"{description} {question}"
+        # )  # add description to each question
+        # print(answer)
+        # print("-" * 10)
+
+        print("With a natural description:")
+        print(answers[2 * i + 1])
+        print("\n" + "=" * 20 + "\n")
 
-    print("Without description:")
-    answer = ask_question(question)
-    print(answer)
-    print("-" * 10)
+    rizzler.embedding_cache.report()
 
-    # print("With description:")
-    # answer = ask_question(
-    #     f"{description} {question}"
-    # )  # add description to each question
-    # print(answer)
-    # print("-" * 10)
 
-    print("With a natural description:")
-    answer = ask_question(
-        f"{natural_description} {question}"
-    )  # add description to each question
-    print(answer)
-    print("\n" + "=" * 20 + "\n")
+if __name__ == "__main__":
+    main()
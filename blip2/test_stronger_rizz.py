@@ -1,33 +1,19 @@
 import torch
 from PIL import Image
-from transformers import Blip2ForConditionalGeneration, Blip2Processor
 
+from blip2.rizzler import Rizzler
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-dtype = torch.float16 if torch.cuda.is_available() else torch.float32
 
-processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-6.7b-coco")
-model = Blip2ForConditionalGeneration.from_pretrained(
-    "Salesforce/blip2-opt-6.7b-coco", dtype=dtype
-).to(device)
+MODEL_NAME = "Salesforce/blip2-opt-6.7b-coco"
+IMAGE_PATH = "data_collection/profiles/images/1/image_1.jpg"
 
-image_path = "data_collection/profiles/images/1/image_1.jpg"
-raw_image = Image.open(image_path).convert("RGB")
 
-print("Testing stronger rizz...")
-print("Unconditional image captioning...")
-inputs = processor(raw_image, return_tensors="pt").to(device, dtype)
-out = model.generate(**inputs)
-print(processor.decode(out[0], skip_special_tokens=True))
-
-print("\n" + "=" * 20 + "\n")
-print("Conditional image captioning...")
-
-
-def ask_question(question: str) -> str:
-    inputs = processor(raw_image, question, return_tensors="pt").to(device, dtype)
-    out = model.generate(
-        **inputs,
+def ask_question(rizzler: Rizzler, image: Image.Image, question: str) -> str:
+    # Every question is about the same image, it only goes through the vision
+    # encoder and Q-Former on the first one
+    return rizzler.generate(
+        [image],
+        [question],
         do_sample=True,
         num_beams=1,
         max_length=120,
@@ -38,11 +24,7 @@ def ask_question(question: str) -> str:
         repetition_penalty=1.2,
         no_repeat_ngram_size=2,
         length_penalty=1.0,  # TODO: Play with shorter or longer answers
-    )
-
-    answer = processor.decode(out[0], skip_special_tokens=True)
-
-    return answer
+    )[0]
 
 
 description = """\
@@ -73,24 +55,47 @@ questions = [
     # "What are some fun date ideas?",
 ]
 
-for i, question in enumerate(questions):
-    print(f"Question {i + 1}\n")
-
-    # print("Without description:")
-    # answer = ask_question(question)
-    # print(answer)
-    # print("-" * 10)
-
-    # print("With description:")
-    # answer = ask_question(
-    #     f"{description} {question}"
-    # )  # add description to each question
-    # print(answer)
-    # print("-" * 10)
-
-    print("With a natural description:")
-    answer = ask_question(
-        f"{natural_description} {question}"
-    )  # add description to each question
-    print(answer)
+
+def main() -> None:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Full precision, loaded on first use
+    rizzler = Rizzler.get(
+        MODEL_NAME, device=device, precision="fp16" if device == "cuda" else "fp32"
+    )
+
+    raw_image = Image.open(IMAGE_PATH).convert("RGB")
+
+    print("Testing stronger rizz...")
+    print("Unconditional image captioning...")
+    print(rizzler.caption([raw_image])[0])
+
     print("\n" + "=" * 20 + "\n")
+    print("Conditional image captioning...")
+
+    for i, question in enumerate(questions):
+        print(f"Question {i + 1}\n")
+
+        # print("Without description:")
+        # answer = ask_question(rizzler, raw_image, question)
+        # print(answer)
+        # print("-" * 10)
+
+        # print("With description:")
+        # answer = ask_question(
+        #     f"{description} {question}"
+        # )  # add description to each question
+        # print(answer)
+        # print("-" * 10)
+
+        print("With a natural description:")
+        answer = ask_question(
+            rizzler, raw_image, f"{natural_description} {question}"
+        )  # add description to each question
+        print(answer)
+        print("\n" + "=" * 20 + "\n")
+
+    rizzler.embedding_cache.report()
+
+
+if __name__ == "__main__":
+    main()
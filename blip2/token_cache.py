@@ -0,0 +1,270 @@
+"""Pre-tokenised prompt/target corpus for the BLIP-2 collate path.
+
+``build_token_cache`` tokenises every prompt and target once and stores the
+token IDs back to back in flat int32 files, with int64 offset arrays marking
+where each example starts. Labels are stored with the loss masking already
+applied. During training ``TokenCacheTransform`` attaches zero-copy views of
+the token IDs to each example and ``pad_token_batch`` only pads them, so the
+tokenizer never runs inside the training loop.
+
+Build the cache with:
+    uv run python -m blip2.token_cache
+"""
+
+import hashlib
+import json
+from collections.abc import Iterable, Sequence
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from transformers import BatchEncoding, Blip2Processor
+
+from blip2.processing import image_token_ids
+
+
+DEFAULT_TOKEN_DIR = "data_collection/profiles/token_cache"
+INDEX_FILE = "index.json"
+ARRAY_FILES = {
+    "prompt_ids": ("prompt_ids.bin", np.int32),
+    "prompt_offsets": ("prompt_offsets.bin", np.int64),
+    "label_ids": ("label_ids.bin", np.int32),
+    "label_offsets": ("label_offsets.bin", np.int64),
+}
+
+
+def example_digest(text: str, target: str) -> str:
+    """Fingerprint of an example's text, to detect stale cache rows."""
+    return hashlib.sha1(f"{text}\0{target}".encode()).hexdigest()
+
+
+def tokenize_example(
+    processor: Blip2Processor, text: str, target: str
+) -> tuple[list[int], list[int]]:
+    """Tokenise one example like the collate function does for a batch.
+
+    Returns:
+        Prompt IDs (without image tokens) and label IDs (pad tokens as -100)
+    """
+    tokenizer = processor.tokenizer
+    prompt_ids = tokenizer(text, truncation=True)["input_ids"]
+    label_ids = tokenizer(target, truncation=True)["input_ids"]
+    label_ids = [-100 if i == tokenizer.pad_token_id else i for i in label_ids]
+    return prompt_ids, label_ids
+
+
+class TokenCache:
+    """Read access to a corpus written by ``build_token_cache``."""
+
+    def __init__(self, token_dir: str | Path = DEFAULT_TOKEN_DIR) -> None:
+        self.token_dir = Path(token_dir)
+        with open(self.token_dir / INDEX_FILE, encoding="utf-8") as f:
+            self.index: dict[str, Any] = json.load(f)
+        self._arrays: dict[str, np.memmap] = {}
+
+    @staticmethod
+    def exists(token_dir: str | Path = DEFAULT_TOKEN_DIR) -> bool:
+        return (Path(token_dir) / INDEX_FILE).exists()
+
+    def _array(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            file_name, dtype = ARRAY_FILES[name]
+            path = self.token_dir / file_name
+            if path.stat().st_size == 0:
+                return np.zeros(0, dtype=dtype)
+            self._arrays[name] = np.memmap(path, dtype=dtype, mode="r")
+        return self._arrays[name]
+
+    def __len__(self) -> int:
+        return len(self.index["entries"])
+
+    def lookup(
+        self, profile_id: str, text: str, target: str
+    ) -> tuple[np.ndarray, np.ndarray] | None:
+        """Return views of the prompt and label IDs, or None if not cached.
+
+        Rows whose text changed since the cache was built count as missing.
+        """
+        entry = self.index["entries"].get(profile_id)
+        if entry is None or entry["digest"] != example_digest(text, target):
+            return None
+        row = entry["row"]
+        prompt_offsets = self._array("prompt_offsets")
+        label_offsets = self._array("label_offsets")
+        prompt_ids = self._array("prompt_ids")[
+            prompt_offsets[row] : prompt_offsets[row + 1]
+        ]
+        label_ids = self._array("label_ids")[
+            label_offsets[row] : label_offsets[row + 1]
+        ]
+        return prompt_ids, label_ids
+
+    def prompt_lengths(self) -> dict[str, int]:
+        """Number of prompt tokens of every cached example, by profile ID."""
+        offsets = self._array("prompt_offsets")
+        return {
+            profile_id: int(offsets[entry["row"] + 1] - offsets[entry["row"]])
+            for profile_id, entry in self.index["entries"].items()
+        }
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Reopen the memmaps lazily in DataLoader workers
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+
+class TokenCacheTransform:
+    """Dataset transform that adds ``prompt_ids`` and ``label_ids`` to examples.
+
+    Examples missing from the cache (or changed since) are tokenised on the
+    fly, so a stale cache only costs speed, never correctness.
+    """
+
+    def __init__(self, cache: TokenCache, processor: Blip2Processor) -> None:
+        self.cache = cache
+        self.processor = processor
+
+    def __call__(self, batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        batch["prompt_ids"] = []
+        batch["label_ids"] = []
+        for profile_id, text, target in zip(
+            batch["profile_id"], batch["text"], batch["target"], strict=True
+        ):
+            cached = self.cache.lookup(profile_id, text, target)
+            if cached is None:
+                cached = tokenize_example(self.processor, text, target)
+            batch["prompt_ids"].append(cached[0])
+            batch["label_ids"].append(cached[1])
+        return batch
+
+
+def _pad(
+    sequences: Sequence[Sequence[int]], pad_value: int, padding_side: str
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Pad sequences into a tensor and return it with its attention mask."""
+    max_length = max(len(sequence) for sequence in sequences)
+    padded = torch.full((len(sequences), max_length), pad_value, dtype=torch.long)
+    mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        values = torch.from_numpy(np.array(sequence, dtype=np.int64))
+        if padding_side == "left":
+            padded[i, max_length - len(values) :] = values
+            mask[i, max_length - len(values) :] = 1
+        else:
+            padded[i, : len(values)] = values
+            mask[i, : len(values)] = 1
+    return padded, mask
+
+
+def pad_token_batch(
+    processor: Blip2Processor,
+    prompt_ids: Sequence[Sequence[int]],
+    label_ids: Sequence[Sequence[int]],
+) -> BatchEncoding:
+    """Pad pre-tokenised prompts and labels into model inputs.
+
+    Produces the same ``input_ids``, ``attention_mask`` and ``labels`` as
+    running the processor on the text of the batch.
+    """
+    tokenizer = processor.tokenizer
+    input_ids, attention_mask = _pad(
+        prompt_ids, tokenizer.pad_token_id, tokenizer.padding_side
+    )
+    labels, _ = _pad(label_ids, -100, tokenizer.padding_side)
+
+    # Image tokens go first, before BOS, and are never padded
+    prefix = torch.tensor(image_token_ids(processor), dtype=torch.long)
+    if len(prefix):
+        prefix = prefix.expand(len(prompt_ids), -1)
+        input_ids = torch.cat([prefix, input_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix), attention_mask], dim=1)
+
+    return BatchEncoding(
+        {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+    )
+
+
+def build_token_cache(
+    examples: Iterable[dict[str, Any]],
+    processor: Blip2Processor,
+    token_dir: str | Path = DEFAULT_TOKEN_DIR,
+) -> TokenCache:
+    """Tokenise all examples and write the flat token arrays.
+
+    The cache is rebuilt from scratch, examples are written one at a time so
+    memory use does not grow with the corpus.
+
+    Args:
+        examples: Examples with ``profile_id``, ``text`` and ``target``, for
+            instance from ``create_training_examples(..., load_images=False)``
+        processor: Processor whose tokenizer to use
+        token_dir: Directory to write the arrays and index to
+
+    Returns:
+        The new token cache
+    """
+    token_dir = Path(token_dir)
+    token_dir.mkdir(parents=True, exist_ok=True)
+
+    entries: dict[str, dict[str, Any]] = {}
+    prompt_end = label_end = 0
+    with ExitStack() as stack:
+        files = {
+            name: stack.enter_context(open(token_dir / file_name, "wb"))
+            for name, (file_name, _) in ARRAY_FILES.items()
+        }
+        files["prompt_offsets"].write(np.int64(0).tobytes())
+        files["label_offsets"].write(np.int64(0).tobytes())
+        for example in examples:
+            prompt_ids, label_ids = tokenize_example(
+                processor, example["text"], example["target"]
+            )
+            files["prompt_ids"].write(np.asarray(prompt_ids, np.int32).tobytes())
+            files["label_ids"].write(np.asarray(label_ids, np.int32).tobytes())
+            prompt_end += len(prompt_ids)
+            label_end += len(label_ids)
+            files["prompt_offsets"].write(np.int64(prompt_end).tobytes())
+            files["label_offsets"].write(np.int64(label_end).tobytes())
+
+            entries[example["profile_id"]] = {
+                "row": len(entries),
+                "digest": example_digest(example["text"], example["target"]),
+            }
+
+    index = {
+        "tokenizer": processor.tokenizer.name_or_path,
+        "entries": entries,
+    }
+    with open(token_dir / INDEX_FILE, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+
+    print(f"Tokenised {len(entries)} examples ({prompt_end} prompt tokens)")
+    return TokenCache(token_dir)
+
+
+def main() -> None:
+    import argparse
+
+    from blip2.prepare_dataset import create_training_examples
+    from blip2.profile_reader import has_name, iter_profiles
+
+    parser = argparse.ArgumentParser(description="Pre-tokenise the training corpus.")
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument(
+        "--json-path", default="data_collection/profiles/text_data.json"
+    )
+    parser.add_argument("--images-dir", default="data_collection/profiles/images")
+    parser.add_argument("--token-dir", default=DEFAULT_TOKEN_DIR)
+    args = parser.parse_args()
+
+    processor = Blip2Processor.from_pretrained(args.model_name)
+    profiles = iter_profiles(args.json_path, profile_filter=has_name)
+    examples = create_training_examples(profiles, args.images_dir, load_images=False)
+    build_token_cache(examples, processor, args.token_dir)
+
+
+if __name__ == "__main__":
+    main()
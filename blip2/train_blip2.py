@@ -14,7 +14,17 @@ from transformers import (
     TrainingArguments,
 )
 
+from blip2.feature_cache import DEFAULT_FEATURE_DIR, FeatureCache
+from blip2.image_cache import DEFAULT_CACHE_DIR, ImageCache
+from blip2.modeling import forward_with_image_embeds
 from blip2.prepare_dataset import prepare_dataset
+from blip2.processing import encode_text
+from blip2.sampler import (
+    LengthBucketBatchSampler,
+    PaddingStatsCallback,
+    example_lengths,
+)
+from blip2.token_cache import DEFAULT_TOKEN_DIR, TokenCache, pad_token_batch
 
 
 def print_trainable_parameters(model):
@@ -32,91 +42,232 @@ def print_trainable_parameters(model):
     )
 
 
-def collate_fn(batch, processor, device):
-    """Custom collate function to process images and text for BLIP-2."""
-    images = [item["image"] for item in batch]
-    texts = [item["text"] for item in batch]
-    targets = [item["target"] for item in batch]
+def collate_fn(batch, processor, image_cache=None, feature_cache=None):
+    """Custom collate function to process images and text for BLIP-2.
+
+    Runs in the DataLoader worker processes, so it returns CPU tensors and
+    the trainer moves each batch to the device in the training step.
+
+    With an ``image_cache``, the items hold pre-resized uint8 images and only
+    the text goes through the processor. With a ``feature_cache``, the items
+    hold precomputed vision features which are passed on as ``image_embeds``.
+    Items with pre-tokenised ``prompt_ids``/``label_ids`` (see
+    ``blip2/token_cache.py``) are only padded.
+    """
+    # Process text
+    if "prompt_ids" in batch[0]:
+        inputs = pad_token_batch(
+            processor,
+            [item["prompt_ids"] for item in batch],
+            [item["label_ids"] for item in batch],
+        )
+    else:
+        texts = [item["text"] for item in batch]
+        targets = [item["target"] for item in batch]
+        inputs = encode_text(processor, texts, padding=True, truncation=True)
 
-    # Process inputs
-    inputs = processor(
-        images=images, text=texts, return_tensors="pt", padding=True, truncation=True
-    ).to(device)
+        # Process labels (targets)
+        labels = processor(
+            text=targets, return_tensors="pt", padding=True, truncation=True
+        ).input_ids
 
-    # Process labels (targets)
-    labels = processor(
-        text=targets, return_tensors="pt", padding=True, truncation=True
-    ).input_ids.to(device)
+        # Replace padding token id with -100 so it's ignored in loss
+        labels[labels == processor.tokenizer.pad_token_id] = -100
 
-    # Replace padding token id with -100 so it's ignored in loss
-    labels[labels == processor.tokenizer.pad_token_id] = -100
+        inputs["labels"] = labels
 
-    inputs["labels"] = labels
+    # Process images
+    if feature_cache is not None:
+        inputs["image_embeds"] = feature_cache.image_embeds(
+            [item["image_embeds"] for item in batch]
+        )
+    elif image_cache is not None:
+        images = [item["image"] for item in batch]
+        inputs["pixel_values"] = image_cache.pixel_values(images)
+    else:
+        images = [item["image"] for item in batch]
+        inputs["pixel_values"] = processor.image_processor(
+            images, return_tensors="pt"
+        ).pixel_values
 
     return inputs
 
 
 class BLIP2Trainer(Trainer):
-    """Custom Trainer for BLIP-2 with proper collation."""
-
-    def __init__(self, *args, processor=None, **kwargs):
+    """Custom Trainer for BLIP-2 with proper collation.
+
+    Given a ``feature_cache``, training skips the vision encoder and feeds the
+    cached features straight into the Q-Former. With ``group_by_length``,
+    training batches are drawn by a ``LengthBucketBatchSampler`` (lengths from
+    ``token_cache`` where available) and the padding ratio is printed after
+    every epoch.
+    """
+
+    def __init__(
+        self,
+        *args,
+        processor=None,
+        image_cache=None,
+        feature_cache=None,
+        token_cache=None,
+        group_by_length=True,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         self.processor = processor
-
-    def get_train_dataloader(self):
-        """Override to use custom collate function."""
+        self.group_by_length = group_by_length
+        self.image_cache = image_cache
+        self.feature_cache = feature_cache
+        self.token_cache = token_cache
+        self.length_sampler = None
+
+    def compute_loss(
+        self, model, inputs, return_outputs=False, num_items_in_batch=None
+    ):
+        """Compute the loss from cached vision features if the batch has them."""
+        if "image_embeds" not in inputs:
+            return super().compute_loss(
+                model,
+                inputs,
+                return_outputs=return_outputs,
+                num_items_in_batch=num_items_in_batch,
+            )
+
+        if not self.model_accepts_loss_kwargs:
+            num_items_in_batch = None
+        outputs = forward_with_image_embeds(
+            model, **inputs, num_items_in_batch=num_items_in_batch
+        )
+        return (outputs["loss"], outputs) if return_outputs else outputs["loss"]
+
+    def _prepare_input(self, data):
+        """Copy pinned batches to the device without blocking the host."""
+        if (
+            isinstance(data, torch.Tensor)
+            and data.is_pinned()
+            and not self.is_deepspeed_enabled
+        ):
+            return data.to(self.args.device, non_blocking=True)
+        return super()._prepare_input(data)
+
+    def _dataloader(self, dataset, **kwargs):
+        """DataLoader that collates in ``dataloader_num_workers`` processes."""
         from functools import partial
 
         from torch.utils.data import DataLoader
 
-        collate = partial(collate_fn, processor=self.processor, device=self.args.device)
+        collate = partial(
+            collate_fn,
+            processor=self.processor,
+            image_cache=self.image_cache,
+            feature_cache=self.feature_cache,
+        )
+        num_workers = self.args.dataloader_num_workers
         return DataLoader(
-            self.train_dataset,
-            batch_size=self.args.per_device_train_batch_size,
+            dataset,
             collate_fn=collate,
-            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory and torch.cuda.is_available(),
+            prefetch_factor=self.args.dataloader_prefetch_factor
+            if num_workers > 0
+            else None,
+            persistent_workers=self.args.dataloader_persistent_workers
+            and num_workers > 0,
+            **kwargs,
         )
 
-    def get_eval_dataloader(self, eval_dataset=None):
+    def get_train_dataloader(self):
         """Override to use custom collate function."""
-        from functools import partial
-
-        from torch.utils.data import DataLoader
+        if not self.group_by_length:
+            return self._dataloader(
+                self.train_dataset,
+                batch_size=self.args.per_device_train_batch_size,
+                shuffle=True,
+            )
+
+        if self.length_sampler is None:
+            print("Measuring example lengths for bucketing...")
+            lengths = example_lengths(
+                self.train_dataset, self.processor, self.token_cache
+            )
+            self.length_sampler = LengthBucketBatchSampler(
+                lengths,
+                batch_size=self.args.per_device_train_batch_size,
+                seed=self.args.seed,
+                drop_last=self.args.dataloader_drop_last,
+            )
+            self.add_callback(PaddingStatsCallback(self.length_sampler))
+        return self._dataloader(self.train_dataset, batch_sampler=self.length_sampler)
 
+    def get_eval_dataloader(self, eval_dataset=None):
+        """Override to use custom collate function."""
         eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
-        collate = partial(collate_fn, processor=self.processor, device=self.args.device)
-        return DataLoader(
-            eval_dataset,
-            batch_size=self.args.per_device_eval_batch_size,
-            collate_fn=collate,
+        return self._dataloader(
+            eval_dataset, batch_size=self.args.per_device_eval_batch_size
         )
 
 
 def main():
     """Main training function."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fine-tune BLIP-2 with LoRA.")
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=4,
+        help="DataLoader worker processes that decode and collate batches",
+    )
+    parser.add_argument(
+        "--prefetch-factor",
+        type=int,
+        default=2,
+        help="Batches each worker prepares ahead of the training step",
+    )
+    parser.add_argument(
+        "--no-group-by-length",
+        dest="group_by_length",
+        action="store_false",
+        help="Shuffle training examples instead of batching similar lengths",
+    )
+    parser.add_argument("--model-name", default="Salesforce/blip2-opt-2.7b")
+    parser.add_argument("--output-dir", default="./blip2_rizz_finetuned")
+    parser.add_argument(
+        "--train-projection",
+        action="store_true",
+        help="Also train the language projection, needed for draft models "
+        "built with blip2.speculative",
+    )
+    args = parser.parse_args()
+
     # Configuration
-    model_name = "Salesforce/blip2-opt-2.7b"
-    output_dir = "./blip2_rizz_finetuned"
+    model_name = args.model_name
+    output_dir = args.output_dir
+    image_cache_dir = DEFAULT_CACHE_DIR  # Built with `python -m blip2.image_cache`
+    feature_dir = DEFAULT_FEATURE_DIR  # Built with `python -m blip2.feature_cache`
+    token_dir = DEFAULT_TOKEN_DIR  # Built with `python -m blip2.token_cache`
 
     # Device setup
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
 
-    # Load processor
+    # Load processor. The PIL backend resizes like the image cache does, so
+    # cached and uncached runs train on the same pixels
     print("Loading processor...")
-    processor = Blip2Processor.from_pretrained(model_name)
-
-    # Configure 8-bit quantization for memory efficiency
-    bnb_config = BitsAndBytesConfig(
-        load_in_8bit=True,
-        llm_int8_threshold=6.0,
-    )
+    processor = Blip2Processor.from_pretrained(model_name, use_fast=False)
 
-    # Load model with quantization
+    # Load model with 8-bit quantization for memory efficiency. bitsandbytes
+    # needs a GPU, so CPU runs train in fp32. So do draft models: their
+    # language projection is trained, and 8-bit weights cannot be
     print("Loading model...")
+    quantize = device == "cuda" and not args.train_projection
     model = Blip2ForConditionalGeneration.from_pretrained(
         model_name,
-        quantization_config=bnb_config,
+        quantization_config=(
+            BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+            if quantize
+            else None
+        ),
         device_map={"": 0} if device == "cuda" else None,
     )
 
@@ -136,6 +287,9 @@ def main():
         lora_dropout=0.05,
         bias="none",
         task_type="SEQ_2_SEQ_LM",
+        # A draft model's projection is untrained, it is trained fully and
+        # saved with the adapters
+        modules_to_save=["language_projection"] if args.train_projection else None,
     )
 
     # Apply LoRA to model
@@ -145,7 +299,24 @@ def main():
 
     # Load dataset
     print("\nLoading dataset...")
-    train_dataset, val_dataset = prepare_dataset()
+    image_cache = None
+    if ImageCache.exists(image_cache_dir):
+        image_cache = ImageCache(image_cache_dir)
+        print(f"Using image cache at {image_cache_dir} ({len(image_cache)} images)")
+    feature_cache = None
+    if FeatureCache.exists(feature_dir):
+        feature_cache = FeatureCache(feature_dir)
+        print(f"Using cached vision features at {feature_dir} ({len(feature_cache)})")
+    token_cache = None
+    if TokenCache.exists(token_dir):
+        token_cache = TokenCache(token_dir)
+        print(f"Using pre-tokenised corpus at {token_dir} ({len(token_cache)})")
+    train_dataset, val_dataset = prepare_dataset(
+        image_cache=image_cache,
+        feature_cache=feature_cache,
+        token_cache=token_cache,
+        processor=processor,
+    )
 
     # Training arguments
     training_args = TrainingArguments(
@@ -166,6 +337,9 @@ def main():
         load_best_model_at_end=True,
         report_to="none",  # Disable wandb/tensorboard
         remove_unused_columns=False,  # Important for custom datasets
+        dataloader_num_workers=args.num_workers,
+        dataloader_prefetch_factor=args.prefetch_factor if args.num_workers else None,
+        dataloader_pin_memory=device == "cuda",
     )
 
     # Initialize trainer
@@ -176,6 +350,10 @@ def main():
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         processor=processor,
+        image_cache=image_cache,
+        feature_cache=feature_cache,
+        token_cache=token_cache,
+        group_by_length=args.group_by_length,  # Batch similar lengths
     )
 
     # Train!
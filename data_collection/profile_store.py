@@ -0,0 +1,403 @@
+"""SQLite-backed storage for scraped profiles.
+
+Replaces the old pattern of loading ``text_data.json``, adding one profile and
+writing the whole file back. Every profile is a handful of row inserts in a
+WAL-mode database, so the cost of saving a profile does not depend on how many
+profiles are already stored. ``export_json`` writes the legacy JSON layout that
+``blip2/prepare_dataset.py`` reads.
+"""
+
+import json
+import sqlite3
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any, Self
+
+
+DEFAULT_DB_PATH = Path("data_collection/profiles/profiles.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    about_me TEXT,
+    anthem TEXT,
+    complete INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+CREATE TABLE IF NOT EXISTS essentials (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (profile_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS basics (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (profile_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lifestyle (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (profile_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS interests (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (profile_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    image_index INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (profile_id, image_index)
+) WITHOUT ROWID;
+"""
+
+_LIST_TABLES = ("essentials", "interests")
+_DICT_TABLES = ("basics", "lifestyle")
+
+
+def _iter_grouped(
+    conn: sqlite3.Connection, table: str, columns: str
+) -> Iterator[tuple[int, list[tuple]]]:
+    """Yield ``(profile_id, rows)`` for a child table, ordered by profile."""
+    order = "image_index" if table == "images" else "position"
+    cursor = conn.execute(
+        f"SELECT profile_id, {columns} FROM {table} ORDER BY profile_id, {order}"
+    )
+    current_id: int | None = None
+    rows: list[tuple] = []
+    for profile_id, *values in cursor:
+        if profile_id != current_id:
+            if current_id is not None:
+                yield current_id, rows
+            current_id, rows = profile_id, []
+        rows.append(tuple(values))
+    if current_id is not None:
+        yield current_id, rows
+
+
+class ProfileStore:
+    """Append-friendly profile database.
+
+    Example:
+        >>> store = ProfileStore("profiles.db")
+        >>> profile_id = store.allocate_id()
+        >>> store.save_profile(profile_id, {"name": "Maren"}, ["images/0/image_0.jpg"])
+    """
+
+    def __init__(self, db_path: str | Path = DEFAULT_DB_PATH) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def _begin(self) -> None:
+        # IMMEDIATE takes the write lock up front, so two scrapers sharing the
+        # same database can never hand out the same ID
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def seed_last_id(self, last_id: int) -> None:
+        """Make sure newly allocated IDs continue after ``last_id``.
+
+        Used to carry over the counter from the legacy ``.last_id`` file.
+        """
+        self._begin()
+        try:
+            row = self.conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'profiles'"
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('profiles', ?)",
+                    (last_id,),
+                )
+            elif row[0] < last_id:
+                self.conn.execute(
+                    "UPDATE sqlite_sequence SET seq = ? WHERE name = 'profiles'",
+                    (last_id,),
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def allocate_id(self) -> int:
+        """Reserve and return a new profile ID.
+
+        The profile row is created empty and marked incomplete until
+        ``save_profile`` is called, so images can be downloaded into the ID's
+        folder before the text data is scraped. IDs start at 0 in a fresh
+        store, like the legacy scraper's did.
+        """
+        self._begin()
+        try:
+            # SQLite would start at 1, so the ID is chosen explicitly. The
+            # insert moves ``sqlite_sequence`` along with it
+            profile_id = self.last_id() + 1
+            self.conn.execute("INSERT INTO profiles (id) VALUES (?)", (profile_id,))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return profile_id
+
+    def last_id(self) -> int:
+        """Return the most recently allocated ID, or -1 if none has been."""
+        row = self.conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'profiles'"
+        ).fetchone()
+        return -1 if row is None else int(row[0])
+
+    def _write_profile(
+        self,
+        profile_id: int,
+        data: dict[str, Any],
+        image_paths: list[str] | None,
+    ) -> None:
+        self.conn.execute(
+            "INSERT INTO profiles (id, name, about_me, anthem, complete)"
+            " VALUES (?, ?, ?, ?, 1)"
+            " ON CONFLICT(id) DO UPDATE SET name = excluded.name,"
+            " about_me = excluded.about_me, anthem = excluded.anthem, complete = 1",
+            (profile_id, data.get("name"), data.get("about_me"), data.get("anthem")),
+        )
+        # Re-saving a profile replaces its child rows instead of appending to them
+        for table in (*_LIST_TABLES, *_DICT_TABLES):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE profile_id = ?", (profile_id,)
+            )
+
+        for table in _LIST_TABLES:
+            self.conn.executemany(
+                f"INSERT INTO {table} (profile_id, position, value) VALUES (?, ?, ?)",
+                [
+                    (profile_id, position, str(value))
+                    for position, value in enumerate(data.get(table) or [])
+                ],
+            )
+        for table in _DICT_TABLES:
+            self.conn.executemany(
+                f"INSERT INTO {table} (profile_id, position, key, value)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (profile_id, position, str(key), str(value))
+                    for position, (key, value) in enumerate(
+                        (data.get(table) or {}).items()
+                    )
+                ],
+            )
+        if image_paths is not None:
+            self.conn.execute("DELETE FROM images WHERE profile_id = ?", (profile_id,))
+            self.conn.executemany(
+                "INSERT INTO images (profile_id, image_index, path) VALUES (?, ?, ?)",
+                [(profile_id, idx, str(path)) for idx, path in enumerate(image_paths)],
+            )
+
+    def save_profile(
+        self,
+        profile_id: int,
+        data: dict[str, Any],
+        image_paths: list[str] | None = None,
+    ) -> None:
+        """Store the scraped data for a profile in a single transaction.
+
+        Args:
+            profile_id: ID returned by ``allocate_id``
+            data: Profile dict in the ``text_data.json`` layout
+            image_paths: Local paths of the downloaded images, in order
+        """
+        self._begin()
+        try:
+            self._write_profile(profile_id, data, image_paths)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def import_json(self, json_path: str | Path) -> int:
+        """Bulk import a legacy ``text_data.json`` file, keeping its IDs.
+
+        Returns:
+            Number of imported profiles
+        """
+        with open(json_path, encoding="utf-8") as f:
+            all_data: dict[str, dict[str, Any]] = json.load(f)
+
+        self._begin()
+        try:
+            for profile_id, data in all_data.items():
+                self._write_profile(int(profile_id), data, None)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(all_data)
+
+    def iter_profiles(
+        self, include_images: bool = False
+    ) -> Iterator[tuple[str, dict[str, Any]]]:
+        """Yield ``(profile_id, profile)`` pairs for all complete profiles.
+
+        Child tables are merged in a single ordered pass each, so memory use
+        stays bounded by one profile regardless of the size of the store.
+        """
+        read_conn = sqlite3.connect(self.db_path)
+        try:
+            read_conn.execute("BEGIN")
+            base = read_conn.execute(
+                "SELECT id, name, about_me, anthem FROM profiles"
+                " WHERE complete = 1 ORDER BY id"
+            )
+            # Each child table gets its own cursor on the same snapshot
+            children: dict[str, Iterator[tuple[int, list[tuple]]]] = {
+                table: _iter_grouped(read_conn, table, "value")
+                for table in _LIST_TABLES
+            }
+            children.update(
+                {
+                    table: _iter_grouped(read_conn, table, "key, value")
+                    for table in _DICT_TABLES
+                }
+            )
+            if include_images:
+                children["images"] = _iter_grouped(read_conn, "images", "path")
+            pending: dict[str, tuple[int, list[tuple]] | None] = {
+                table: next(it, None) for table, it in children.items()
+            }
+
+            for profile_id, name, about_me, anthem in base:
+                rows: dict[str, list[tuple]] = {}
+                for table, it in children.items():
+                    # Skip rows for incomplete profiles
+                    head = pending[table]
+                    while head is not None and head[0] < profile_id:
+                        head = next(it, None)
+                    if head is not None and head[0] == profile_id:
+                        rows[table] = head[1]
+                        head = next(it, None)
+                    else:
+                        rows[table] = []
+                    pending[table] = head
+
+                profile: dict[str, Any] = {
+                    "name": name,
+                    "about_me": about_me,
+                    "essentials": [value for (value,) in rows["essentials"]],
+                    "basics": dict(rows["basics"]),
+                    "lifestyle": dict(rows["lifestyle"]),
+                    "interests": [value for (value,) in rows["interests"]],
+                    "anthem": anthem,
+                }
+                if include_images:
+                    profile["image_paths"] = [path for (path,) in rows["images"]]
+                yield str(profile_id), profile
+        finally:
+            read_conn.close()
+
+    def export_json(self, json_path: str | Path) -> int:
+        """Write all complete profiles to the legacy ``text_data.json`` layout.
+
+        Profiles are written one at a time, so the export never holds the
+        whole corpus in memory.
+
+        Returns:
+            Number of exported profiles
+        """
+        json_path = Path(json_path)
+        json_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = json_path.with_suffix(json_path.suffix + ".tmp")
+
+        count = 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("{")
+            for profile_id, profile in self.iter_profiles():
+                f.write(",\n" if count else "\n")
+                f.write(f"    {json.dumps(profile_id)}: ")
+                body = json.dumps(profile, ensure_ascii=False, indent=4)
+                f.write(body.replace("\n", "\n    "))
+                count += 1
+            f.write("\n}\n" if count else "}\n")
+        tmp_path.replace(json_path)
+        return count
+
+    def export_jsonl(self, jsonl_path: str | Path) -> int:
+        """Write all complete profiles as one JSON object per line.
+
+        Every line holds the profile fields plus its ``"id"``, the
+        newline-delimited layout read by ``blip2.profile_reader``.
+
+        Returns:
+            Number of exported profiles
+        """
+        jsonl_path = Path(jsonl_path)
+        jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = jsonl_path.with_suffix(jsonl_path.suffix + ".tmp")
+
+        count = 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for profile_id, profile in self.iter_profiles():
+                f.write(json.dumps({"id": profile_id, **profile}, ensure_ascii=False))
+                f.write("\n")
+                count += 1
+        tmp_path.replace(jsonl_path)
+        return count
+
+    def __len__(self) -> int:
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM profiles WHERE complete = 1"
+        ).fetchone()
+        return int(row[0])
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default=str(DEFAULT_DB_PATH))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser(
+        "export", help="Export to text_data.json (or .jsonl)"
+    )
+    export_parser.add_argument(
+        "--output", default="data_collection/profiles/text_data.json"
+    )
+    import_parser = subparsers.add_parser("import", help="Import a text_data.json")
+    import_parser.add_argument(
+        "--input", default="data_collection/profiles/text_data.json"
+    )
+    args = parser.parse_args()
+
+    with ProfileStore(args.db) as store:
+        if args.command == "export":
+            if args.output.endswith((".jsonl", ".ndjson")):
+                count = store.export_jsonl(args.output)
+            else:
+                count = store.export_json(args.output)
+            print(f"Exported {count} profiles to {args.output}")
+        else:
+            count = store.import_json(args.input)
+            print(f"Imported {count} profiles from {args.input}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import html
-import json
 import os
 import re
 import time
@@ -15,6 +14,8 @@ from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.remote.webelement import WebElement
 
+from data_collection.profile_store import DEFAULT_DB_PATH, ProfileStore
+
 
 load_dotenv(dotenv_path="data_collection/.env")
 
@@ -25,10 +26,11 @@ PROFILE_FOLDER = os.getenv(
 )  # Replace with your Firefox profile folder name
 WIN_USERNAME = os.getenv("WIN_USERNAME", "your-windows-username")
 LAST_ID_PATH = Path("data_collection/profiles/.last_id")
+JSON_FILE_PATH = Path("data_collection/profiles/text_data.json")
 
 
-def read_last_id() -> int:
-    """Read the last used user ID from the .last_id file."""
+def read_legacy_last_id() -> int:
+    """Read the last used user ID from the legacy .last_id file."""
     if LAST_ID_PATH.exists():
         with open(LAST_ID_PATH, encoding="utf-8") as f:
             return int(f.read().strip())
@@ -36,14 +38,13 @@ def read_last_id() -> int:
         return -1  # Default value if the file does not exist
 
 
-def write_last_id(last_id: int) -> None:
-    """Write the last used user ID to the .last_id file."""
-    with open(LAST_ID_PATH, "w", encoding="utf-8") as f:
-        f.write(str(last_id))
-
-
-# Get the last used user ID from the .last_id file
-last_user_id: int = read_last_id()
+# Profile IDs are allocated by the store, seeded from the legacy .last_id file
+# so IDs keep counting from where the JSON-based scraper stopped
+profile_store = ProfileStore(DEFAULT_DB_PATH)
+if len(profile_store) == 0 and JSON_FILE_PATH.exists():
+    # One-time migration of profiles scraped before the store existed
+    profile_store.import_json(JSON_FILE_PATH)
+profile_store.seed_last_id(read_legacy_last_id())
 
 options = Options()
 
@@ -321,10 +322,9 @@ def scrape_one_gyatt_or_potential_partner() -> None:
     photo_urls = get_all_them_photos()
 
     # Download photos
-    new_last_user_id = read_last_id() + 1
-    write_last_id(new_last_user_id)
+    new_last_user_id = profile_store.allocate_id()
 
-    download_images(photo_urls, new_last_user_id)
+    image_paths = download_images(photo_urls, new_last_user_id)
 
     # Open more details to access About Me and Essentials
     open_more_details()
@@ -381,27 +381,10 @@ def scrape_one_gyatt_or_potential_partner() -> None:
         "anthem": anthem,
     }
 
-    # Save data to JSON
-    output_path = Path("data_collection/profiles/")
-    output_path.mkdir(parents=True, exist_ok=True)
-    json_file_path = output_path / "text_data.json"
-
-    # If the file does not exist, create it with an empty dict
-    if not json_file_path.exists():
-        with open(json_file_path, "w", encoding="utf-8") as f:
-            json.dump({}, f)
-
-    # Write the new data into the JSON file
-    # TODO: Make it more efficient by not loading the whole file every time
-    # Such as using a database (SQLite, etc.)
-    with open(json_file_path, "r+", encoding="utf-8") as f:
-        all_data = json.load(f)
-        all_data[new_last_user_id] = data
-        f.seek(0)
-        json.dump(all_data, f, ensure_ascii=False, indent=4)
-        f.truncate()
-
-    print(f"Data for {name} saved to {json_file_path}")
+    # Save data to the profile store
+    profile_store.save_profile(new_last_user_id, data, image_paths)
+
+    print(f"Data for {name} saved to {profile_store.db_path}")
     print("*" * 20)
 
 
@@ -435,22 +418,31 @@ def scrape_website(
             profiles_to_scrape.value -= 1
 
 
-def download_images(urls: list[str], id: int):
-    """Download images from the given URLs and save them locally."""
+def download_images(urls: list[str], id: int) -> list[str]:
+    """Download images from the given URLs and save them locally.
+
+    Returns:
+        Local paths of the successfully downloaded images
+    """
     save_path = Path(f"data_collection/profiles/images/{id}")
     save_path.mkdir(parents=True, exist_ok=True)
+    image_paths: list[str] = []
 
     for idx, url in enumerate(urls):
         if url is None:
             continue
         try:
             image_data = requests.get(url).content
-            with open(save_path / f"image_{idx}.jpg", "wb") as img_file:
+            image_path = save_path / f"image_{idx}.jpg"
+            with open(image_path, "wb") as img_file:
                 img_file.write(image_data)
+            image_paths.append(str(image_path))
             # print(f"Downloaded image {idx} from {url}")
         except Exception as e:
             print(f"Failed to download image from {url}: {e}")
 
+    return image_paths
+
 
 class LikeStrategy:
     """Class to encapsulate like strategies."""
@@ -518,6 +510,11 @@ def main() -> None:
 
     print("Scraping completed.")
 
+    # Export the legacy JSON layout read by blip2/prepare_dataset.py
+    count = profile_store.export_json(JSON_FILE_PATH)
+    print(f"Exported {count} profiles to {JSON_FILE_PATH}")
+    profile_store.close()
+
     # Always quit the driver
     driver.quit()
 